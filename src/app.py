@@ -84,7 +84,10 @@ if _DEBUG is False:
 # Value of option threads of uwsgi is to set 1 over,
 # the Collector object is created as much as that vlaue.
 # Solved Issue - run uwsgi with lazy-apps option.
-Collector()
+# The parse processes of CollectPipeline are spawned and import this module
+# as __mp_main__, they must not start the Collector.
+if __name__ != '__mp_main__':
+    Collector()
 
 
 if __name__ == '__main__':
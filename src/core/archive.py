@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import datetime
+import json
+import os
+import sqlalchemy
+import threading
+import zlib
+
+from pysp.serror import SCDebug
+
+from core.config import BillConfig
+from core.helper import DateTool
+
+
+class ColdArchive(SCDebug):
+    '''
+    Cold tier of stock_day, the years older than db.stock.archive_years are
+    moved out of the store into read-only compressed blocks,
+    <folder.stock>/<code>.arc/<year>.blk. A block is a zlib compressed JSON
+    of the columns, the integer columns are delta-encoded and stamp is
+    restored from day. meta.json has 'until', the first day of the hot tier.
+    '''
+    class Error(Exception):
+        pass
+
+    BLOCK_CACHE_SIZE = 16
+    _blocks = collections.OrderedDict()
+    _blocks_lock = threading.Lock()
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    @classmethod
+    def factory(cls, code):
+        folder = BillConfig().get_value('_config.db.stock_folder')
+        return cls(f'{folder}/{code}.arc')
+
+    @classmethod
+    def get_years(cls):
+        return int(BillConfig().get_value('db.stock.archive_years', 0) or 0)
+
+    @classmethod
+    def is_enabled(cls):
+        return cls.get_years() > 0
+
+    @classmethod
+    def horizon(cls, now=None):
+        '''
+        :return:    The first day of the hot tier, integer of YYYYMMDD.
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+        return (now.year - cls.get_years()) * 10000 + 101
+
+    def _meta_file(self):
+        return f'{self.folder}/meta.json'
+
+    def _block_file(self, year):
+        return f'{self.folder}/{year}.blk'
+
+    def get_meta(self):
+        try:
+            with open(self._meta_file()) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {'until': 0, 'years': []}
+
+    def _set_meta(self, meta):
+        tmpfile = self._meta_file() + '.tmp'
+        with open(tmpfile, 'w') as fd:
+            json.dump(meta, fd)
+        os.replace(tmpfile, self._meta_file())
+
+    def until(self):
+        return self.get_meta()['until']
+
+    @classmethod
+    def _delta(cls, values):
+        prev = 0
+        deltas = []
+        for v in values:
+            if v is None:
+                deltas.append(None)
+                continue
+            deltas.append(v - prev)
+            prev = v
+        return deltas
+
+    @classmethod
+    def _undelta(cls, deltas):
+        prev = 0
+        values = []
+        for d in deltas:
+            if d is None:
+                values.append(None)
+                continue
+            prev += d
+            values.append(prev)
+        return values
+
+    @classmethod
+    def encode(cls, rows):
+        '''
+        :param rows:    List of dict, the rows of stock_day in order of day.
+        :return:        Bytes of the block.
+        '''
+        colnames = [x for x in rows[0].keys() if x != 'stamp']
+        block = {'rows': len(rows), 'columns': {}, 'deltas': []}
+        for colname in colnames:
+            values = [x[colname] for x in rows]
+            if all([type(x) is int for x in values if x is not None]):
+                values = cls._delta(values)
+                block['deltas'].append(colname)
+            block['columns'][colname] = values
+        return zlib.compress(json.dumps(block).encode('utf-8'), 9)
+
+    @classmethod
+    def decode(cls, data):
+        '''
+        :return:    Dict of the column lists, stamp is restored from day.
+        '''
+        block = json.loads(zlib.decompress(data).decode('utf-8'))
+        columns = block['columns']
+        for colname in block['deltas']:
+            columns[colname] = cls._undelta(columns[colname])
+        columns['stamp'] = [DateTool.to_stamp(x) for x in columns['day']]
+        return columns
+
+    def read_block(self, year):
+        bfile = self._block_file(year)
+        key = (bfile, os.path.getmtime(bfile))
+        with self._blocks_lock:
+            if key in self._blocks:
+                self._blocks.move_to_end(key)
+                return self._blocks[key]
+        with open(bfile, 'rb') as fd:
+            columns = self.decode(fd.read())
+        with self._blocks_lock:
+            self._blocks[key] = columns
+            while len(self._blocks) > self.BLOCK_CACHE_SIZE:
+                self._blocks.popitem(last=False)
+        return columns
+
+    def write_block(self, year, rows):
+        os.makedirs(self.folder, exist_ok=True)
+        tmpfile = self._block_file(year) + '.tmp'
+        with open(tmpfile, 'wb') as fd:
+            fd.write(self.encode(rows))
+        os.replace(tmpfile, self._block_file(year))
+
+    def load(self, colnames, sday, eday):
+        '''
+        :param colnames:    list of Column name.
+        :param sday:        Start day, integer of YYYYMMDD.
+        :param eday:        End day, integer of YYYYMMDD.
+        :return:            List of list, the rows in the range.
+        '''
+        fields = []
+        for year in self.get_meta()['years']:
+            if year < sday // 10000 or year > eday // 10000:
+                continue
+            columns = self.read_block(year)
+            for i, day in enumerate(columns['day']):
+                if sday <= day <= eday:
+                    fields.append([columns[x][i] for x in colnames])
+        return fields
+
+    def archive(self, sidb, until=None):
+        '''
+        Move the rows of stock_day before the horizon into the blocks.
+        The blocks are written before the rows are deleted,
+        and the rows are merged by column if the year was already archived.
+        :return:    Count of the archived rows.
+        '''
+        until = self.horizon() if until is None else until
+        table = sidb.get_table('stock_day')
+        wheres = sidb.stock_day_filter(table) + [table.c.day < until]
+        colnames = [x.name for x in table.c if x.name != 'code']
+        sql = sqlalchemy.sql.select([table.c[x] for x in colnames]).\
+            where(sqlalchemy.and_(*wheres)).order_by(table.c.day.asc())
+        rows = [dict(zip(colnames, x)) for x in sidb.session.query(sql).all()]
+        sidb.session.commit()
+        if not rows:
+            return 0
+
+        meta = self.get_meta()
+        years = collections.OrderedDict()
+        for row in rows:
+            years.setdefault(row['day'] // 10000, []).append(row)
+        for year, yrows in years.items():
+            if year in meta['years']:
+                merged = {}
+                columns = self.read_block(year)
+                for i, day in enumerate(columns['day']):
+                    merged[day] = {x: columns[x][i] for x in colnames}
+                # A partial row, e.g. a backfilled candle, keeps the
+                # archived values of the columns it does not have.
+                for row in yrows:
+                    prev = merged.get(row['day'], {})
+                    merged[row['day']] = {
+                        x: prev.get(x) if row[x] is None else row[x]
+                        for x in colnames}
+                yrows = [merged[x] for x in sorted(merged.keys())]
+            self.write_block(year, yrows)
+        meta['years'] = sorted(set(meta['years']) | set(years.keys()))
+        meta['until'] = max(meta['until'], until)
+        self._set_meta(meta)
+
+        sidb.session.execute(sqlalchemy.delete(table).where(
+                                                sqlalchemy.and_(*wheres)))
+        sidb.session.commit()
+        sidb.compact()
+        self.dprint(f'Archived {self.folder}: {len(rows)} rows')
+        return len(rows)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures
+import datetime
+import functools
+import os
+import sqlalchemy
+import threading
+import time
+
+from pysp.sbasic import SFile
+from pysp.sconf import SConfig
+from pysp.serror import SCDebug
+from pysp.ssql import SSimpleDB
+
+from core.codedir import CodeDirectory
+from core.config import BillConfig
+from core.finance import DataCollection, StockDayMerge, StockItemDB, \
+    StockQuery
+from core.helper import DateTool
+from core.pipeline import CollectPipeline
+
+
+class BackfillDB(SSimpleDB):
+    '''
+    The progress table of StockBackfill, a row of each code and stream.
+    The engine opens a connection of each statement, so the rows are
+    read and written by the worker threads.
+    '''
+    class Error(Exception):
+        pass
+
+    def __init__(self, db_file=None):
+        bcfg = BillConfig()
+        base = bcfg.get_value('folder.base', './')
+        self.db_file = db_file or bcfg.get_value('backfill.file', None) or \
+            f'{base}/backfill.sqlite3'
+        SFile.mkdir(os.path.dirname(os.path.abspath(self.db_file)))
+        config = SConfig(bcfg.get_value('_config.db.backfill_yml'))
+        super(BackfillDB, self).__init__(self.db_file, config)
+        self.session.close()
+        self.table = self.get_table('progress')
+        self.colnames = [x.name for x in self.table.c]
+
+    @classmethod
+    def to_key(cls, code, stream):
+        return f'{code}.{stream}'
+
+    def get(self, code, stream):
+        '''
+        :return:    Dict of the progress, None if it is not started.
+        '''
+        sql = sqlalchemy.sql.select([self.table]).where(
+            self.table.c.key == self.to_key(code, stream))
+        row = self.engine.execute(sql).first()
+        return None if row is None else dict(zip(self.colnames, row))
+
+    def put(self, progress):
+        progress['key'] = self.to_key(progress['code'], progress['stream'])
+        progress['stamp'] = time.time()
+        sql = self.table.insert().prefix_with('OR REPLACE')
+        self.engine.execute(sql, progress)
+
+    def list(self, codes=None):
+        sql = sqlalchemy.sql.select([self.table]).order_by(self.table.c.key)
+        if codes is not None:
+            sql = sql.where(self.table.c.code.in_(codes))
+        return [dict(zip(self.colnames, x))
+                for x in self.engine.execute(sql).fetchall()]
+
+    def remove(self, codes=None):
+        sql = self.table.delete()
+        if codes is not None:
+            sql = sql.where(self.table.c.code.in_(codes))
+        return self.engine.execute(sql).rowcount
+
+
+class StockBackfill(SCDebug):
+    '''
+    Seed the history of the codes back to the horizon, the streams of a
+    code go in order, the candles first to have the rows of the late
+    columns, and the codes go in parallel. The progress of each stream is
+    checkpointed in BackfillDB after each stored page, so an interrupted
+    backfill goes on from the page of the checkpoint. The new days since
+    the checkpoint move the pages back, so it goes on by the oldest day,
+    the pages of the days already stored are skipped. A page stored again
+    is not a harm, StockItemDB.update_days() writes the changes only.
+    '''
+    DEBUG = True
+    WORKERS = 4
+    REPORT_SECONDS = 10
+    # stream: (provider name, chunk)
+    STREAMS = collections.OrderedDict([
+        ('candle',      ('naver', 'day')),
+        ('investor',    ('naver', 'dayinvestor')),
+        ('short',       ('krx', 'shortstock')),
+    ])
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, since, **kwargs):
+        '''
+        :param since:   The horizon, the date to backfill back to.
+        :param workers: The codes in parallel, default is backfill.workers.
+        :param pdb:     BackfillDB of the progress.
+        '''
+        bcfg = BillConfig()
+        self.horizon = DateTool.to_day(since)
+        self.workers = int(kwargs.get('workers', None) or
+                           bcfg.get_value('backfill.workers', self.WORKERS))
+        self.report_seconds = int(bcfg.get_value('backfill.report_seconds',
+                                                 self.REPORT_SECONDS))
+        self.pdb = kwargs.get('pdb', None) or BackfillDB()
+        self.today = DateTool.to_day(datetime.date.today())
+        self.lock = threading.Lock()
+        self.fractions = {}
+        self.stats = {'pages': 0, 'rows': 0, 'codes': 0, 'failed': 0}
+        self.stamp = time.time()
+        self.report_stamp = self.stamp
+        self.fraction_start = None
+
+    @classmethod
+    def _ordinal(cls, day):
+        return datetime.date(day//10000, day//100 % 100, day % 100).toordinal()
+
+    def get_fraction(self, progress):
+        '''
+        :return:    The done part of the stream, by the days back to the
+                    horizon.
+        '''
+        if progress['done']:
+            return 1.0
+        if not progress['oldest']:
+            return 0.0
+        span = self._ordinal(self.today) - self._ordinal(self.horizon)
+        done = self._ordinal(self.today) - self._ordinal(progress['oldest'])
+        return min(1.0, max(0.0, done/span)) if span > 0 else 1.0
+
+    def start_progress(self, code, stream):
+        '''
+        :return:    Dict of the progress to go on, the stored one if exists.
+        '''
+        progress = self.pdb.get(code, stream)
+        if progress is None:
+            return {'code': code, 'stream': stream, 'horizon': self.horizon,
+                    'page': 0, 'oldest': None, 'rows': 0, 'done': False}
+        if progress['done'] and self.horizon < progress['horizon'] and \
+                (progress['oldest'] or self.today) > self.horizon:
+            # The older horizon than the last one.
+            progress['done'] = False
+        progress['horizon'] = self.horizon
+        return progress
+
+    def _update(self, progress, pages=0, rows=0):
+        with self.lock:
+            self.fractions[(progress['code'], progress['stream'])] = \
+                self.get_fraction(progress)
+            self.stats['pages'] += pages
+            self.stats['rows'] += rows
+            if time.time() - self.report_stamp >= self.report_seconds:
+                self.report_stamp = time.time()
+                self.iprint(self.report())
+
+    def _store(self, progress, state, pages):
+        '''
+        The writer stage of CollectPipeline, each page is stored and
+        checkpointed. The pages of no older day than the checkpoint are
+        skipped until a page is stored. It stops at the page over the
+        horizon or at the end of the history, the page of no day, the same
+        days as the previous page or no older day after the stored page.
+        :param state:   Dict of the run, the page and the days of the last
+                        page and stored, True if a page is stored.
+        :return:        Count of the pages to go on.
+        '''
+        with StockItemDB.checkout(progress['code']) as sidb:
+            for i, rows in enumerate(pages):
+                state['page'] += 1
+                days = sorted([DateTool.to_day(x['stamp']) for x in rows])
+                last, state['days'] = state['days'], days
+                older = not progress['oldest'] or \
+                    min(days or [0]) < progress['oldest']
+                if not days or days == last or \
+                        (state['stored'] and not older):
+                    progress['done'] = True
+                    self.pdb.put(progress)
+                    self._update(progress)
+                    return i
+                if not older:
+                    continue
+                merge = StockDayMerge()
+                merge.add(rows)
+                count = sidb.update_days(merge.items)
+                StockQuery.invalidate(sidb, since=min(days))
+                state['stored'] = True
+                progress['page'] = state['page']
+                progress['oldest'] = min(days)
+                progress['rows'] += count
+                progress['done'] = min(days) <= self.horizon
+                self.pdb.put(progress)
+                self._update(progress, pages=1, rows=count)
+                if progress['done']:
+                    return i
+        return len(pages)
+
+    def get_chunk_funcs(self, code, stream):
+        pname, chunk = self.STREAMS[stream]
+        sp = DataCollection.factory_provider(code, pname)
+        return DataCollection.get_chunk_funcs(sp, chunk)
+
+    def backfill_stream(self, code, stream, **kwargs):
+        '''
+        :param fetch:   fetch(page=page), default is of the provider.
+        :param parse:   parse(raw), default is of the provider.
+        :return:        Dict of the progress of the stream.
+        '''
+        progress = self.start_progress(code, stream)
+        self._update(progress)
+        if progress['done']:
+            return progress
+        if 'fetch' in kwargs:
+            fetch, parse = kwargs['fetch'], kwargs['parse']
+        else:
+            fetch, parse = self.get_chunk_funcs(code, stream)
+        # It goes on from the page of the checkpoint, the days of it are
+        # the same or moved back by the new days.
+        start = max(progress['page'], 1)
+        state = {'page': start - 1, 'days': None, 'stored': False}
+        CollectPipeline().run(
+            fetch=fetch, parse=parse,
+            store=functools.partial(self._store, progress, state),
+            start=start)
+        return progress
+
+    def backfill_code(self, code):
+        '''
+        :return:    True if all streams of the code are done.
+        '''
+        try:
+            done = True
+            for stream in self.STREAMS.keys():
+                progress = self.backfill_stream(code, stream)
+                done = done and progress['done']
+            DataCollection.sync_code(code)
+        except Exception as e:
+            self.eprint(f'{code}: Failed To Backfill: {e}')
+            done = False
+        with self.lock:
+            self.stats['codes' if done else 'failed'] += 1
+        return done
+
+    def run(self, codes=None):
+        '''
+        :param codes:   List of code, default is all codes of KRX.
+        :return:        Dict of the codes and the done of them.
+        '''
+        if codes is None:
+            codes = [CodeDirectory.to_code(x['short_code'])
+                     for x in CodeDirectory().list()]
+        for code in codes:
+            for stream in self.STREAMS.keys():
+                progress = self.pdb.get(code, stream)
+                self.fractions[(code, stream)] = 0.0 if progress is None \
+                    else self.get_fraction(self.start_progress(code, stream))
+        self.stamp = time.time()
+        self.fraction_start = self.get_total_fraction()
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.workers) as pool:
+            report = dict(zip(codes, pool.map(self.backfill_code, codes)))
+        self.iprint(self.report())
+        return report
+
+    def get_total_fraction(self):
+        if not self.fractions:
+            return 1.0
+        return sum(self.fractions.values()) / len(self.fractions)
+
+    def report(self):
+        '''
+        :return:    String of the progress, the throughput and ETA.
+        '''
+        elapsed = time.time() - self.stamp
+        fraction = self.get_total_fraction()
+        gained = fraction - (self.fraction_start or 0.0)
+        eta = elapsed * (1.0 - fraction) / gained if gained > 0 else None
+        return '{:.1f}% codes={} failed={} pages={} rows={} ' \
+            '{:.2f} pages/s {:.1f} rows/s ETA {}'.format(
+                fraction*100, self.stats['codes'], self.stats['failed'],
+                self.stats['pages'], self.stats['rows'],
+                self.stats['pages']/elapsed if elapsed else 0.0,
+                self.stats['rows']/elapsed if elapsed else 0.0,
+                '-' if eta is None else
+                str(datetime.timedelta(seconds=int(eta))))
+
+
+if __name__ == '__main__':
+    import sys
+
+    def usage():
+        '''
+    Usage: backfill run <since> [-j <workers>] [<code> ...]
+           backfill status [<code> ...]
+           backfill reset [<code> ...]
+        run     Backfill the codes back to since, YYYY.MM.DD, it goes on
+                from the checkpoints of the last run.
+        status  Show the checkpoints.
+        reset   Remove the checkpoints to start again from the first page.
+        All codes of KRX if no code is given.
+        '''
+        print(usage.__doc__)
+        exit(-1)
+
+    if len(sys.argv) < 2 or sys.argv[1] not in ['run', 'status', 'reset']:
+        usage()
+    command, args = sys.argv[1], sys.argv[2:]
+    if command == 'run':
+        if not args:
+            usage()
+        since, args = args[0], args[1:]
+        workers = None
+        if args[:1] == ['-j']:
+            if len(args) < 2:
+                usage()
+            workers, args = int(args[1]), args[2:]
+        StockBackfill(since, workers=workers).run(args or None)
+    elif command == 'status':
+        for p in BackfillDB().list(args or None):
+            print('{key:16} horizon={horizon} page={page} oldest={oldest} '
+                  'rows={rows} done={done}'.format(**p))
+    else:
+        print(f'Removed: {BackfillDB().remove(args or None)}')
@@ -1,6 +1,9 @@
 
 import atexit
+import bisect
 import codecs
+import collections
+import contextlib
 import glob
 import hashlib
 import os
@@ -12,7 +15,8 @@ from pysp.serror import SDebug
 from pysp.sjson import SJson
 
 from core.config import BillConfig
-from core.model import QueryData
+from core.helper import DateTool
+from core.model import ColumnData, QueryData
 
 
 @atexit.register
@@ -62,6 +66,9 @@ class FCache(SDebug, metaclass=SSingleton):
                     os.remove(cfpath)
                 if v['stamp'] < time.time():
                     continue
+                if type(v['value']) is ColumnData:
+                    # The arrays are written as the layout of JSON.
+                    v = dict(v, value=v['value'].to_dict())
                 with codecs.open(cfpath, mode='w', encoding='utf-8') as fd:
                     try:
                         fd.write(SJson.to_serial(v, indent=2))
@@ -145,7 +152,8 @@ class FCache(SDebug, metaclass=SSingleton):
         if cast and hasattr(cast, '__call__'):
             data = cast(data)
         # Delete Cache, QueryData.fields is 0
-        if type(data) is QueryData and len(data.fields) == 0:
+        if (type(data) is QueryData and len(data.fields) == 0) or \
+                (type(data) is ColumnData and data.get_count() == 0):
             self.clear(self.hash(key))
         self.dprint(f'Cache@{fg_hit} "{key}"')
         return data
@@ -155,3 +163,179 @@ class FCache(SDebug, metaclass=SSingleton):
         with self.lock:
             self._cache = \
                 {k: v for k, v in self._cache.items() if v['stamp'] >= cstamp}
+
+
+class LruCache(object):
+    '''
+    The base of the in-memory caches of an entry by key, the recent
+    MAX_KEYS entries are kept for DURATION. A key is loaded under the lock
+    of it, and the load is not stored if the key is invalidated meanwhile,
+    by the generation of the key. The lock and the generation of a key are
+    dropped with the last loader of it, so they do not grow with the keys.
+    An entry is a dict with 'stamp', the time it expires.
+    '''
+    DURATION = 900
+    MAX_KEYS = 64
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        # key: [lock, count of the loaders]
+        self._locks = {}
+        self._gens = {}
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def loading(self, key):
+        '''
+        with self.loading(key) as gen:
+            ...
+        :return:    The generation of the key to store the loaded entry.
+        '''
+        with self.lock:
+            if key not in self._locks:
+                self._locks[key] = [threading.Lock(), 0]
+                self._gens[key] = 0
+            klock = self._locks[key]
+            klock[1] += 1
+        try:
+            with klock[0]:
+                with self.lock:
+                    gen = self._gens[key]
+                yield gen
+        finally:
+            with self.lock:
+                klock[1] -= 1
+                if klock[1] == 0:
+                    del self._locks[key]
+                    del self._gens[key]
+
+    def get_entry(self, key):
+        '''
+        :return:    The entry of the key, None if it is not or expired.
+        '''
+        with self.lock:
+            entry = self._entries.get(key, None)
+            if entry is None or entry['stamp'] < time.time():
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put_entry(self, key, entry, gen):
+        '''
+        :return:    True if it is stored, the key is not invalidated since
+                    the generation.
+        '''
+        with self.lock:
+            if self._gens.get(key, 0) != gen:
+                return False
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.MAX_KEYS:
+                self._entries.popitem(last=False)
+            return True
+
+    def invalidate_keys(self, match, update=None):
+        '''
+        :param match:   match(key) is True for the keys to invalidate.
+        :param update:  update(entry) returns the entry to keep of the key,
+                        None drops it. The entries are dropped by default.
+        '''
+        with self.lock:
+            for key in [x for x in self._gens.keys() if match(x)]:
+                self._gens[key] += 1
+            for key in [x for x in self._entries.keys() if match(x)]:
+                entry = None if update is None else update(self._entries[key])
+                if entry is None:
+                    del self._entries[key]
+                else:
+                    self._entries[key] = entry
+
+
+class RangeCache(LruCache, SDebug, metaclass=SSingleton):
+    '''
+    In-memory columns of the rows of each key, a code of a store, with the
+    widest range of days and the set of columns loaded. A narrower range
+    or fewer columns are sliced from it, a wider range loads the days out
+    of the cached range only and a new column loads the columns again.
+    '''
+
+    def invalidate(self, key=None):
+        '''
+        The rows of the key are changed, the entry is dropped and a load in
+        progress is not stored. All keys if it is None.
+        '''
+        self.invalidate_keys(lambda x: key is None or x == key)
+
+    def _load(self, load, colnames, sday, eday):
+        '''
+        :return:    List of the integer days and dict of the columns.
+        '''
+        fields = load(colnames, sday, eday)
+        columns = dict(zip(colnames, [list(x) for x in zip(*fields)])) \
+            if fields else {x: [] for x in colnames}
+        days = [DateTool.to_day(x) for x in columns['stamp']]
+        return days, columns
+
+    def get(self, key, colnames, sday, eday, load):
+        '''
+        :param colnames:    List of column name.
+        :param sday:        Start day, integer of YYYYMMDD.
+        :param eday:        End day, integer of YYYYMMDD.
+        :param load:        load(colnames, sday, eday) returns the rows of
+                            the range in order of the day, 'stamp' is
+                            given in colnames.
+        :return:            List of list, the rows of colnames.
+        '''
+        columns = self.get_columns(key, colnames, sday, eday, load)
+        return [list(x) for x in zip(*columns)]
+
+    def get_columns(self, key, colnames, sday, eday, load):
+        '''
+        :return:    List of the columns of colnames, get() without the rows.
+        '''
+        with self.loading(key) as gen:
+            entry = self.get_entry(key)
+            if entry is None or \
+                    not all([x in entry['columns'] for x in colnames]):
+                loadnames = list(entry['columns'].keys()) if entry else []
+                for x in ['stamp'] + colnames:
+                    if x not in loadnames:
+                        loadnames.append(x)
+                lsday, leday = sday, eday
+                if entry:
+                    lsday, leday = min(sday, entry['sday']), \
+                        max(eday, entry['eday'])
+                days, columns = self._load(load, loadnames, lsday, leday)
+                entry = {'sday': lsday, 'eday': leday, 'days': days,
+                         'columns': columns,
+                         'stamp': time.time() + self.DURATION}
+                self.dprint(f'Load {key} {lsday}~{leday} {loadnames}')
+            else:
+                entry = self._extend(entry, load, sday, eday)
+            self.put_entry(key, entry, gen)
+        days = entry['days']
+        lo = bisect.bisect_left(days, sday)
+        hi = bisect.bisect_right(days, eday)
+        return [entry['columns'][c][lo:hi] for c in colnames]
+
+    def _extend(self, entry, load, sday, eday):
+        '''
+        :return:    The entry with the days out of the cached range.
+        '''
+        if entry['sday'] <= sday and eday <= entry['eday']:
+            return entry
+        colnames = list(entry['columns'].keys())
+        days, columns = entry['days'], entry['columns']
+        if sday < entry['sday']:
+            hdays, head = self._load(load, colnames, sday, entry['sday']-1)
+            days = hdays + days
+            columns = {x: head[x] + columns[x] for x in colnames}
+        if eday > entry['eday']:
+            tdays, tail = self._load(load, colnames, entry['eday']+1, eday)
+            days = days + tdays
+            columns = {x: columns[x] + tail[x] for x in colnames}
+        self.dprint(f'Extend {entry["sday"]}~{entry["eday"]} to '
+                    f'{min(sday, entry["sday"])}~{max(eday, entry["eday"])}')
+        return dict(entry, sday=min(sday, entry['sday']),
+                    eday=max(eday, entry['eday']), days=days,
+                    columns=columns)
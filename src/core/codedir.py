@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import json
+import os
+import threading
+import time
+
+from pysp.sbasic import SSingleton
+from pysp.serror import SCDebug
+
+from core.config import BillConfig
+from core.connect import FKrx
+
+
+class CodeDirectory(SCDebug, metaclass=SSingleton):
+    '''
+    Directory of the codes of KRX, FKrx.get_chunk('list'), indexed by the
+    short code, the full code and the name. It is stored in a compact form,
+    the rows of COLUMNS, and refreshed with the diff of the list.
+    A code is the short code without 'A', e.g. '035720'.
+    The search is the prefix of the sorted keys, the code, the name and the
+    choseong, the initial consonants of the Hangul name.
+    '''
+    COLUMNS = ['short_code', 'full_code', 'codeName', 'marketName']
+    REFRESH_SECONDS = 3600
+    SEARCH_LIMIT = 20
+    CHOSEONG = ['ㄱ', 'ㄲ', 'ㄴ', 'ㄷ', 'ㄸ', 'ㄹ', 'ㅁ', 'ㅂ', 'ㅃ', 'ㅅ',
+                'ㅆ', 'ㅇ', 'ㅈ', 'ㅉ', 'ㅊ', 'ㅋ', 'ㅌ', 'ㅍ', 'ㅎ']
+
+    class Error(Exception):
+        pass
+
+    def __init__(self):
+        bcfg = BillConfig()
+        base = bcfg.get_value('folder.base', './')
+        self.file = bcfg.get_value('krx.codedir_file', None) or \
+            f'{base}/codedir.json'
+        self.refresh_seconds = int(bcfg.get_value('krx.codedir_refresh',
+                                                  self.REFRESH_SECONDS))
+        self.lock = threading.RLock()
+        self.refresh_lock = threading.Lock()
+        self.stamp = 0
+        self.version = 0
+        self.rows = {}
+        self.by_fullcode = {}
+        self.by_name = {}
+        self.by_market = {}
+        self._keys = {}
+        self._keys_version = None
+        self.load()
+
+    @classmethod
+    def to_code(cls, code):
+        code = str(code)
+        return code[1:] if code[:1] == 'A' else code
+
+    @classmethod
+    def to_choseong(cls, word):
+        '''
+        :return:    The initial consonants of the Hangul syllables,
+                    the other characters are kept.
+        '''
+        chars = []
+        for ch in word:
+            idx = ord(ch) - 0xAC00
+            chars.append(cls.CHOSEONG[idx // 588] if 0 <= idx < 11172 else ch)
+        return ''.join(chars)
+
+    def load(self):
+        try:
+            with open(self.file) as fd:
+                data = json.load(fd)
+        except (IOError, ValueError):
+            return False
+        with self.lock:
+            self._keys_version = None
+            self.stamp = data['stamp']
+            self.version = data['version']
+            self.rows = {}
+            self.by_fullcode = {}
+            self.by_name = {}
+            self.by_market = {}
+            for row in data['rows']:
+                self._add(row)
+        return True
+
+    def store(self):
+        with self.lock:
+            data = {
+                'stamp':    self.stamp,
+                'version':  self.version,
+                'columns':  self.COLUMNS,
+                'rows':     [self.rows[x] for x in sorted(self.rows.keys())],
+            }
+        os.makedirs(os.path.dirname(os.path.abspath(self.file)),
+                    exist_ok=True)
+        tmpfile = self.file + '.tmp'
+        with open(tmpfile, 'w') as fd:
+            json.dump(data, fd, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmpfile, self.file)
+
+    def _add(self, row):
+        code = self.to_code(row[0])
+        self.rows[code] = row
+        self.by_fullcode[row[1]] = code
+        self.by_name[row[2]] = code
+        self.by_market.setdefault(row[3], set()).add(code)
+
+    def _remove(self, code):
+        row = self.rows.pop(code)
+        self.by_fullcode.pop(row[1], None)
+        if self.by_name.get(row[2]) == code:
+            self.by_name.pop(row[2])
+        self.by_market.get(row[3], set()).discard(code)
+
+    def apply(self, items):
+        '''
+        Apply the diff of the list to the indexes.
+        :param items:   List of dict, the list of FKrx.get_chunk('list').
+        :return:        Dict of the added, removed and changed codes.
+        '''
+        rows = {}
+        for item in items:
+            row = [item.get(x) for x in self.COLUMNS]
+            rows[self.to_code(row[0])] = row
+        with self.lock:
+            added = [x for x in rows if x not in self.rows]
+            removed = [x for x in self.rows if x not in rows]
+            changed = [x for x in rows
+                       if x in self.rows and self.rows[x] != rows[x]]
+            for code in removed + changed:
+                self._remove(code)
+            for code in added + changed:
+                self._add(rows[code])
+            if added or removed or changed:
+                self.version += 1
+            self.stamp = time.time()
+        return {'added': added, 'removed': removed, 'changed': changed}
+
+    def _is_fresh(self):
+        with self.lock:
+            return bool(self.rows) and \
+                self.stamp + self.refresh_seconds > time.time()
+
+    def refresh(self, force=False):
+        '''
+        The list is fetched out of the lock, the readers go on with the rows
+        and only the diff is applied under the lock.
+        :return:    Dict of the diff or None if it is not expired.
+        '''
+        if not force and self._is_fresh():
+            return None
+        # A thread fetches the list, the others do not wait for it unless
+        # there is no row yet.
+        if not self.refresh_lock.acquire(blocking=not self.rows):
+            return None
+        try:
+            if not force and self._is_fresh():
+                return None
+            try:
+                items = FKrx.get_chunk('list')
+            except Exception as e:
+                if not self.rows:
+                    raise
+                # The stored directory is used until the next refresh.
+                self.eprint(f'Failed To Refresh: {e}')
+                with self.lock:
+                    self.stamp = time.time()
+                return None
+            diff = self.apply(items)
+            self.store()
+        finally:
+            self.refresh_lock.release()
+        self.dprint(f'Refresh: {dict((k, len(v)) for k, v in diff.items())}')
+        return diff
+
+    def get(self, code):
+        '''
+        :return:    Dict of the item of the code, None if it is unknown.
+        '''
+        self.refresh()
+        row = self.rows.get(self.to_code(code), None)
+        return None if row is None else dict(zip(self.COLUMNS, row))
+
+    def get_fullcode(self, code):
+        item = self.get(code)
+        if item is None:
+            raise self.Error(f'Unknown Short Code: {code}')
+        return item['full_code']
+
+    def get_name(self, code):
+        item = self.get(code)
+        return None if item is None else item['codeName']
+
+    def find_name(self, name):
+        '''
+        :return:    The code of the name, None if it is unknown.
+        '''
+        self.refresh()
+        return self.by_name.get(name, None)
+
+    def find_fullcode(self, fullcode):
+        self.refresh()
+        return self.by_fullcode.get(fullcode, None)
+
+    def list(self, market=None):
+        '''
+        :param market:  marketName to filter, e.g. KOSPI or KOSDAQ.
+        :return:        List of dict, the same items as the list of FKrx.
+        '''
+        self.refresh()
+        with self.lock:
+            if market is None:
+                codes = self.rows.keys()
+            else:
+                codes = self.by_market.get(market, set())
+            rows = sorted([self.rows[x] for x in codes],
+                          key=lambda x: (x[2], x[0]))
+            return [dict(zip(self.COLUMNS, x)) for x in rows]
+
+    def _get_keys(self):
+        '''
+        :return:    Dict of the sorted list of (key, code),
+                    it is built again if the version is changed.
+        '''
+        with self.lock:
+            if self._keys_version == (self.version, len(self.rows)):
+                return self._keys
+            keys = {'code': [], 'name': [], 'choseong': []}
+            for code, row in self.rows.items():
+                name = row[2].lower()
+                keys['code'].append((code, code))
+                keys['name'].append((name, code))
+                keys['choseong'].append((self.to_choseong(name), code))
+            for v in keys.values():
+                v.sort()
+            self._keys = keys
+            self._keys_version = (self.version, len(self.rows))
+            return keys
+
+    def search(self, query, market=None, limit=SEARCH_LIMIT):
+        '''
+        :param query:   The prefix of the code, the name or the choseong,
+                        the short code with 'A' is the code.
+        :param market:  marketName to filter.
+        :param limit:   The maximum count of the items.
+        :return:        List of dict, the code matches first and
+                        the names in order.
+        '''
+        query = query.strip().lower()
+        if query[:1] == 'a' and query[1:2].isdigit():
+            query = query[1:]
+        if not query:
+            return []
+        self.refresh()
+        with self.lock:
+            keys = self._get_keys()
+            codes = []
+            for kind in ['code', 'name', 'choseong']:
+                pool = keys[kind]
+                idx = bisect.bisect_left(pool, (query, ''))
+                while idx < len(pool) and len(codes) < limit and \
+                        pool[idx][0].startswith(query):
+                    code = pool[idx][1]
+                    idx += 1
+                    if code in codes:
+                        continue
+                    if market and self.rows[code][3] != market:
+                        continue
+                    codes.append(code)
+            return [dict(zip(self.COLUMNS, self.rows[x])) for x in codes]
+
+    def markets(self):
+        self.refresh()
+        return sorted([k for k, v in self.by_market.items() if v])
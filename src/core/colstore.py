@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import glob
+import json
+import numpy
+import os
+import sqlalchemy
+
+from pysp.serror import SCDebug
+
+from core.config import BillConfig
+from core.helper import DateTool
+
+
+class ColumnStore(SCDebug):
+    '''
+    Columnar copy of stock_day next to the SQLite file of a code.
+    <folder.stock>/<code>.col/ has a fixed-width array file per column and
+    day, the integer date index as YYYYMMDD, that are read through
+    numpy.memmap. meta.json has the count of valid rows and the generation
+    of the files, an append and a rebuild write a new generation and the
+    previous one is kept until the next, so a reader of the previous meta
+    still sees consistent arrays of any process.
+    '''
+    class Error(Exception):
+        pass
+
+    INDEX = 'day'
+    COLUMNS = {
+        'start':        'i8',
+        'end':          'i8',
+        'high':         'i8',
+        'low':          'i8',
+        'volume':       'i8',
+        'foreigner':    'i8',
+        'frate':        'f8',
+        'institute':    'i8',
+        'person':       'i8',
+        'short':        'i8',
+        'shortamount':  'i8',
+    }
+    NULL_INT = numpy.iinfo('i8').min
+    # The recent rows are rewritten at every sync,
+    # the investor and the short stock of them arrive late.
+    RESYNC_ROWS = 20
+    # The meta is read again, when the generation is removed meanwhile.
+    RETRIES = 3
+
+    def __init__(self, folder):
+        self.folder = folder
+
+    @classmethod
+    def factory(cls, code):
+        folder = BillConfig().get_value('_config.db.stock_folder')
+        return cls(f'{folder}/{code}.col')
+
+    @classmethod
+    def is_enabled(cls):
+        return BillConfig().get_value('db.stock.colstore', False) is True
+
+    @classmethod
+    def is_supported(cls, colnames):
+        return all([x == 'stamp' or x in cls.COLUMNS for x in colnames])
+
+    def _meta_file(self):
+        return f'{self.folder}/meta.json'
+
+    def _column_file(self, colname, gen):
+        return f'{self.folder}/{colname}.{gen}.bin'
+
+    def _dtype(self, colname):
+        return 'i4' if colname == self.INDEX else self.COLUMNS[colname]
+
+    def get_meta(self):
+        try:
+            with open(self._meta_file()) as fd:
+                return json.load(fd)
+        except (IOError, ValueError):
+            return {'rows': 0, 'gen': 0}
+
+    def _set_meta(self, meta):
+        tmpfile = self._meta_file() + '.tmp'
+        with open(tmpfile, 'w') as fd:
+            json.dump(meta, fd)
+        os.replace(tmpfile, self._meta_file())
+
+    def exists(self):
+        return self.get_meta()['rows'] > 0
+
+    def _memmap(self, colname, meta):
+        return numpy.memmap(self._column_file(colname, meta['gen']),
+                            dtype=self._dtype(colname), mode='r',
+                            shape=(meta['rows'],))
+
+    def load(self, colnames, sday, eday):
+        '''
+        :param colnames:    list of Column name, 'stamp' is the date index.
+        :param sday:        Start day, integer of YYYYMMDD.
+        :param eday:        End day, integer of YYYYMMDD.
+        :return:            Dict of the arrays sliced from the memory map.
+        '''
+        for _ in range(self.RETRIES):
+            meta = self.get_meta()
+            if meta['rows'] == 0:
+                raise self.Error(f'Empty Store: {self.folder}')
+            try:
+                return self._load(colnames, sday, eday, meta)
+            except FileNotFoundError:
+                self.dprint(f'Removed Generation {self.folder}: {meta}')
+        raise self.Error(f'Busy Store: {self.folder}')
+
+    def _load(self, colnames, sday, eday, meta):
+        days = self._memmap(self.INDEX, meta)
+        sidx = numpy.searchsorted(days, sday, side='left')
+        eidx = numpy.searchsorted(days, eday, side='right')
+        arrays = {}
+        for colname in colnames:
+            if colname == 'stamp':
+                arrays[colname] = days[sidx:eidx]
+                continue
+            arrays[colname] = self._memmap(colname, meta)[sidx:eidx]
+        return arrays
+
+    def to_fields(self, colnames, arrays):
+        '''
+        :return:    List of list, the same rows as it is read from SQLite.
+        '''
+        columns = []
+        for colname in colnames:
+            array = arrays[colname]
+            if colname == 'stamp':
+                to_stamp = DateTool.to_stamp
+                columns.append([to_stamp(x) for x in array.tolist()])
+            elif array.dtype.kind == 'f':
+                columns.append([None if x != x else x for x in array.tolist()])
+            else:
+                null = self.NULL_INT
+                columns.append([None if x == null else x
+                                for x in array.tolist()])
+        return [list(x) for x in zip(*columns)]
+
+    def _to_arrays(self, rows):
+        days = numpy.array([x[self.INDEX] for x in rows], dtype='i4')
+        arrays = {self.INDEX: days}
+        for colname, dtype in self.COLUMNS.items():
+            null = numpy.nan if dtype[0] == 'f' else self.NULL_INT
+            values = [null if x[colname] is None else x[colname] for x in rows]
+            arrays[colname] = numpy.array(values, dtype=dtype)
+        return arrays
+
+    def _write(self, arrays, meta):
+        '''
+        Write the arrays as the next generation of meta, the generations
+        before the one of meta are removed.
+        '''
+        os.makedirs(self.folder, exist_ok=True)
+        gen = meta['gen'] + 1
+        for colname, array in arrays.items():
+            # A writer of the other process does not leave a torn file.
+            cfile = self._column_file(colname, gen)
+            tmpfile = f'{cfile}.{os.getpid()}.tmp'
+            with open(tmpfile, 'wb') as fd:
+                fd.write(array.tobytes())
+            os.replace(tmpfile, cfile)
+        self._set_meta({'rows': len(arrays[self.INDEX]), 'gen': gen})
+        for cfile in glob.glob(f'{self.folder}/*.bin'):
+            if int(cfile.split('.')[-2]) < meta['gen']:
+                os.remove(cfile)
+
+    def append(self, rows, keep):
+        '''
+        :param rows:    List of dict, the rows after the kept rows,
+                        day and the columns of COLUMNS.
+        :param keep:    Count of the rows to keep from the beginning.
+        '''
+        meta = self.get_meta()
+        if keep > meta['rows']:
+            raise self.Error(f'Out Of Range: {keep} > {meta["rows"]}')
+        arrays = self._to_arrays(rows)
+        if keep > 0:
+            for colname, array in arrays.items():
+                kept = self._memmap(colname, meta)[:keep]
+                arrays[colname] = numpy.concatenate([kept, array])
+        self._write(arrays, meta)
+
+    def rebuild(self, rows):
+        '''
+        :param rows:    List of dict, all rows of stock_day in order of day.
+        '''
+        self._write(self._to_arrays(rows), self.get_meta())
+
+    def sync(self, sidb):
+        '''
+        Append the new rows of stock_day and rewrite the recent rows and
+        the rows from the dirty day of stock_version, the first day written
+        after the last sync. If the older rows are inserted or removed,
+        all rows are rebuilt.
+        '''
+        table = sidb.get_table('stock_day')
+        colnames = [self.INDEX] + list(self.COLUMNS.keys())
+        columns = [table.c[x] for x in colnames]
+        wheres = sidb.stock_day_filter(table)
+
+        def select(*conds):
+            sql = sqlalchemy.sql.select(columns).\
+                where(sqlalchemy.and_(*(wheres + list(conds)))).\
+                order_by(table.c.day.asc())
+            return [dict(zip(colnames, x))
+                    for x in sidb.session.query(sql).all()]
+
+        meta = self.get_meta()
+        dirty, revision = sidb.get_dirty()
+        keep = max(0, meta['rows'] - self.RESYNC_ROWS)
+        if keep > 0:
+            days = self._memmap(self.INDEX, meta)
+            if dirty is not None:
+                keep = min(keep, int(numpy.searchsorted(days, dirty)))
+        if keep > 0:
+            day = int(days[keep])
+            sql = sqlalchemy.sql.select([sqlalchemy.func.count()]).\
+                where(sqlalchemy.and_(table.c.day < day, *wheres))
+            if sidb.session.query(sql).scalar() == keep:
+                rows = select(table.c.day >= day)
+                self.append(rows, keep)
+                sidb.clear_dirty(revision)
+                self.dprint(f'Sync {self.folder}: {keep}+{len(rows)}')
+                return
+        rows = select()
+        self.rebuild(rows)
+        sidb.clear_dirty(revision)
+        self.dprint(f'Rebuild {self.folder}: {len(rows)}')
@@ -1,4 +1,3 @@
-
 import os
 
 from pysp.sbasic import SSingleton
@@ -18,3 +17,12 @@ class BillConfig(SConfig, metaclass=SSingleton):
         self.set_value('_config.db.stock_yml', stock_yml)
         stock_folder = self.get_value('folder.stock', './')
         self.set_value('_config.db.stock_folder', stock_folder)
+        stock_multi_yml = f'{self.config_folder}/db/stock_multi.yml'
+        self.set_value('_config.db.stock_multi_yml', stock_multi_yml)
+        backend = self.get_value('db.stock.backend', 'file')
+        self.set_value('_config.db.stock_backend', backend)
+        multi_file = self.get_value('db.stock.multi_file',
+                                    f'{stock_folder}/../stock.sqlite3')
+        self.set_value('_config.db.stock_multi_file', multi_file)
+        backfill_yml = f'{self.config_folder}/db/backfill.yml'
+        self.set_value('_config.db.backfill_yml', backfill_yml)
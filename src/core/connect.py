@@ -3,6 +3,8 @@
 import datetime
 import html2text
 import requests
+import threading
+import urllib.parse
 
 from pysp.serror import SCDebug
 from pysp.sjson import SJson
@@ -10,15 +12,35 @@ from pysp.sjson import SJson
 from core.helper import Helper
 from core.model import StockDayShort, StockDayInvestor, StockDay
 from core.cache import FCache
-# from core.finance import BillConfig
+from core.config import BillConfig
+from core.tradeday import TradeCalendar
 
 
 class Http(SCDebug):
     DEBUG = True
+    HOST_LIMIT = 2
+    _semaphores = {}
+    _semaphores_lock = threading.Lock()
 
     class Error(Exception):
         pass
 
+    @classmethod
+    def get_semaphore(cls, url):
+        '''
+        :return:    Semaphore of the host of url, the concurrent requests to
+                    a host are limited by collect.host_limit or collect.hosts.
+        '''
+        host = urllib.parse.urlsplit(url).hostname
+        with cls._semaphores_lock:
+            if host not in cls._semaphores:
+                bcfg = BillConfig()
+                limit = bcfg.get_value('collect.host_limit', cls.HOST_LIMIT)
+                hosts = bcfg.get_value('collect.hosts', None) or {}
+                limit = int(hosts.get(host, limit))
+                cls._semaphores[host] = threading.BoundedSemaphore(limit)
+            return cls._semaphores[host]
+
     @classmethod
     def do_method(cls, method, url, **kwargs):
         text = kwargs.get('text', False)
@@ -26,21 +48,26 @@ class Http(SCDebug):
         params = kwargs.get('params', {})
         headers = kwargs.get('headers', {})
         try:
-            r = method(url, params=params, headers=headers)
+            with cls.get_semaphore(url):
+                r = method(url, params=params, headers=headers)
         except requests.exceptions.ConnectionError as e:
             raise cls.Error('Failed To Connect: {err}'.format(err=str(e)))
 
         if r.status_code == 200:
             if text:
-                h = html2text.HTML2Text()
-                h.ignore_links = True
-                return h.handle(r.text)
+                return cls.to_text(r.text)
             if json:
                 return SJson.to_deserial(r.text)
             return r.text
 
         raise cls.Error('Unknown HTTP Status: {err}'.format(err=r.status_code))
 
+    @classmethod
+    def to_text(cls, html):
+        h = html2text.HTML2Text()
+        h.ignore_links = True
+        return h.handle(html)
+
     @classmethod
     def get(cls, url, **kwargs):
         cls.dprint(f'Http.get: {url} {kwargs}')
@@ -66,6 +93,8 @@ class Http(SCDebug):
         :param json (bool):     Return a json objeect.
         :param text (bool):     Return a text.
         :param duration (int):  It is the cache's duration time. Unit is msec.
+        :param intraday (bool): The data is changed only in the market hours
+                                of KRX, it is cached until the next open.
         '''
         def gathering():
             return _method_func.get(method)(url, **kwargs)
@@ -75,6 +104,8 @@ class Http(SCDebug):
             'POST': cls.post,
         }
         duration = kwargs.get('duration', None)
+        if duration and kwargs.get('intraday', False):
+            duration = max(duration, TradeCalendar().seconds_to_open())
         cachekey = cls._proxy_key(method, url, **kwargs)
         params = {}
         if duration:
@@ -100,6 +131,19 @@ class FSpHelper(SCDebug):
     def get_chunk(cls, key, **kwargs):
         raise NotImplementedError('Verify Implemented Function: get_chunk()')
 
+    @classmethod
+    def fetch_chunk(cls, key, **kwargs):
+        '''
+        :return:    The raw page of get_chunk(), parse_chunk() turns it
+                    into the rows. The raw page is picklable, so it is
+                    parsed on the other process.
+        '''
+        raise NotImplementedError('Verify Implemented Function: fetch_chunk()')
+
+    @classmethod
+    def parse_chunk(cls, key, raw):
+        raise NotImplementedError('Verify Implemented Function: parse_chunk()')
+
 
 class FDaum(FSpHelper):
     BASE_URL = 'http://finance-service.daum.net/item'
@@ -192,11 +236,22 @@ class FNaver(FSpHelper):
         }
         return GET_CHUNK.get(key)(**kwargs)
 
+    @classmethod
+    def fetch_chunk(cls, key, **kwargs):
+        return Http.get(cls.get_url(key, **kwargs))
+
+    @classmethod
+    def parse_chunk(cls, key, raw):
+        PARSE_CHUNK = {
+            'day':          cls._parse_day,
+            'dayinvestor':  cls._parser_investor,
+        }
+        return PARSE_CHUNK.get(key)(Http.to_text(raw))
+
     @classmethod
     def _get_chunk_day(cls, **kwargs):
         def gathering():
-            chunk = Http.get(url, text=True)
-            return cls._parse_day(chunk)
+            return cls.parse_chunk('day', cls.fetch_chunk('day', **kwargs))
 
         url = cls.get_url('day', **kwargs)
         return FCache().caching(url, gathering,
@@ -205,8 +260,8 @@ class FNaver(FSpHelper):
     @classmethod
     def _get_chunk_investor(cls, **kwargs):
         def gathering():
-            chunk = Http.get(url, text=True)
-            return cls._parser_investor(chunk)
+            return cls.parse_chunk('dayinvestor',
+                                   cls.fetch_chunk('dayinvestor', **kwargs))
 
         url = cls.get_url('dayinvestor', **kwargs)
         return FCache().caching(url, gathering,
@@ -359,6 +414,20 @@ class FKrx(FSpHelper):
 
         return FCache().caching(cls.URL['query'], gathering)
 
+    @classmethod
+    def fetch_chunk(cls, key, **kwargs):
+        FETCH_CHUNK = {
+            'shortstock':   cls._fetch_chunk_shortstock,
+        }
+        return FETCH_CHUNK.get(key)(**kwargs)
+
+    @classmethod
+    def parse_chunk(cls, key, raw):
+        PARSE_CHUNK = {
+            'shortstock':   cls._parse_shortstock,
+        }
+        return PARSE_CHUNK.get(key)(raw)
+
     @classmethod
     def _get_chunk_shortstock(cls, **kwargs):
         '''
@@ -368,67 +437,80 @@ class FKrx(FSpHelper):
 
         :return         list of list or list of StockDayShort
         '''
-        page = kwargs.get('page', 1)
+        def gathering():
+            return cls._parse_shortstock(
+                cls._fetch_chunk_shortstock(**kwargs))
+
+        sdate, edate = cls._get_range_shortstock(kwargs.get('page', 1))
+        keywords = ['krx.short.stock', kwargs.get('fcode'),
+                    kwargs.get('scode'), sdate, edate]
+        return FCache().caching(','.join(keywords), gathering,
+                                duration=600, cast=StockDayShort.cast)
+
+    @classmethod
+    def _get_range_shortstock(cls, page):
+        '''
+        :return:    (sdate, edate) of the page, a year of each page.
+        '''
         now = datetime.datetime.now()
         delta = datetime.timedelta(days=((page-1)*365))
         sdate = (now - delta).strftime('%Y%m%d')
         edate = (now - delta - datetime.timedelta(days=364)).strftime('%Y%m%d')
+        return sdate, edate
 
-        fullcode = kwargs.get('fcode')
-        shortcode = kwargs.get('scode')
-        keywords = ['krx.short.stock', fullcode, shortcode, sdate, edate]
-
-        def gathering():
-            params = {
-                'bld':  'SRT/02/02010100/srt02010100',
-                'name': 'form',
-            }
-            url = cls.URL.get('otp')
-            key = Http.get(url, params=params)
-
-            cls.dprint(f'####### S:{sdate} E:{edate}')
-            params = {
-                'isu_cd':       fullcode,
-                'isu_srt_cd':   shortcode,
-                'strt_dd':      edate,
-                'end_dd':       sdate,
-                'pagePath':     '/contents/SRT/02/02010100/SRT02010100.jsp',
-                'code':         key,
-            }
-            pkwargs = {
-                'params': params,
-                'json': True
-            }
-            url = cls.URL.get('query')
-            data = Http.post(url, **pkwargs)
-            days = []
-            # {
-            #   "block1": [
-            #     {
-            #       "totCnt": "241",
-            #       "rn": "1",
-            #       "trd_dd": "2019/02/14",
-            #       "isu_cd": "KR7035720002",
-            #       "isu_abbrv": "\uce74\uce74\uc624",
-            #       "cvsrtsell_trdvol": "75,749",
-            #       "str_const_val1": "-",
-            #       "cvsrtsell_trdval": "7,475,106,600",
-            #       "str_const_val2": "-"
-            #     },
-            # }
-            if type(data) is dict and 'block1' in data:
-                for item in data['block1']:
-                    amount = item['str_const_val1'].replace(',', '')
-                    days.append(StockDayShort(
-                        stamp=item['trd_dd'],
-                        short=int(item['cvsrtsell_trdvol'].replace(',', '')),
-                        shortamount=None if amount == '-' else int(amount)))
-            for day in days:
-                cls.dprint(day)
-            return days
+    @classmethod
+    def _fetch_chunk_shortstock(cls, **kwargs):
+        sdate, edate = cls._get_range_shortstock(kwargs.get('page', 1))
+        params = {
+            'bld':  'SRT/02/02010100/srt02010100',
+            'name': 'form',
+        }
+        url = cls.URL.get('otp')
+        key = Http.get(url, params=params)
+
+        cls.dprint(f'####### S:{sdate} E:{edate}')
+        params = {
+            'isu_cd':       kwargs.get('fcode'),
+            'isu_srt_cd':   kwargs.get('scode'),
+            'strt_dd':      edate,
+            'end_dd':       sdate,
+            'pagePath':     '/contents/SRT/02/02010100/SRT02010100.jsp',
+            'code':         key,
+        }
+        pkwargs = {
+            'params': params,
+            'json': True
+        }
+        url = cls.URL.get('query')
+        return Http.post(url, **pkwargs)
 
-        return FCache().caching(','.join(keywords), gathering,
-                                duration=600, cast=StockDayShort.cast)
+    @classmethod
+    def _parse_shortstock(cls, data):
+        days = []
+        # {
+        #   "block1": [
+        #     {
+        #       "totCnt": "241",
+        #       "rn": "1",
+        #       "trd_dd": "2019/02/14",
+        #       "isu_cd": "KR7035720002",
+        #       "isu_abbrv": "\uce74\uce74\uc624",
+        #       "cvsrtsell_trdvol": "75,749",
+        #       "str_const_val1": "-",
+        #       "cvsrtsell_trdval": "7,475,106,600",
+        #       "str_const_val2": "-"
+        #     },
+        # }
+        if type(data) is dict and 'block1' in data:
+            for item in data['block1']:
+                amount = item['str_const_val1'].replace(',', '')
+                days.append(StockDayShort(
+                    stamp=item['trd_dd'],
+                    short=int(item['cvsrtsell_trdvol'].replace(',', '')),
+                    shortamount=None if amount == '-' else int(amount)))
+        for day in days:
+            cls.dprint(day)
+        return days
 
 
 class FUnknown:
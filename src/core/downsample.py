@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+
+import numpy
+import time
+
+from pysp.sbasic import SSingleton
+from pysp.serror import SCDebug
+
+from core.cache import LruCache
+from core.model import ColumnData
+
+
+class ChartDownsample(LruCache, SCDebug, metaclass=SSingleton):
+    '''
+    The rows of a long series reduced to the points a chart can show.
+    Each numeric column is a series, the points of each series are selected
+    by LTTB, Largest-Triangle-Three-Buckets, or by the min and the max of
+    each bucket and the rows of the selected points of all series are
+    returned, so the rows are a subset of the rows and all columns of a row
+    are of the same day. The rows of each code, range and max_points are
+    cached and dropped by the stored days of the code.
+
+        method:     'lttb' or 'minmax'.
+    '''
+    LTTB = 'lttb'
+    MINMAX = 'minmax'
+    METHODS = [LTTB, MINMAX]
+    # The first, the last and a point of a bucket at least.
+    MIN_POINTS = 3
+
+    class Error(Exception):
+        pass
+
+    @classmethod
+    def is_supported(cls, method):
+        return method in cls.METHODS
+
+    @classmethod
+    def to_valid(cls, array):
+        '''
+        :return:    Array of bool, True if the value is not null.
+        '''
+        if array.dtype.kind == 'f':
+            return ~numpy.isnan(array)
+        return array != ColumnData.NULL_INT
+
+    @classmethod
+    def lttb(cls, y, threshold):
+        '''
+        :param y:           Array of the values of a series, the x is the
+                            index of the value.
+        :param threshold:   Count of the points to select.
+        :return:            Array of the index of the selected points.
+        '''
+        count = len(y)
+        if threshold >= count or threshold < cls.MIN_POINTS:
+            return numpy.arange(count)
+        y = y.astype('f8')
+        x = numpy.arange(count, dtype='f8')
+        every = (count - 2) / (threshold - 2)
+        selected = numpy.empty(threshold, dtype='i8')
+        selected[0] = a = 0
+        for i in range(threshold - 2):
+            # The average point of the next bucket.
+            nstart = int((i + 1) * every) + 1
+            nend = min(int((i + 2) * every) + 1, count)
+            avg_x = x[nstart:nend].mean()
+            avg_y = y[nstart:nend].mean()
+            start = int(i * every) + 1
+            end = int((i + 1) * every) + 1
+            areas = numpy.abs((x[a] - avg_x) * (y[start:end] - y[a]) -
+                              (x[a] - x[start:end]) * (avg_y - y[a]))
+            a = start + int(numpy.argmax(areas))
+            selected[i+1] = a
+        selected[-1] = count - 1
+        return selected
+
+    @classmethod
+    def minmax(cls, y, threshold):
+        '''
+        :return:    Array of the index of the first, the last and the min
+                    and the max of each bucket.
+        '''
+        count = len(y)
+        if threshold >= count or threshold < cls.MIN_POINTS:
+            return numpy.arange(count)
+        buckets = max((threshold - 2) // 2, 1)
+        edges = numpy.linspace(1, count - 1, buckets + 1).astype('i8')
+        selected = [0, count - 1]
+        for start, end in zip(edges[:-1], edges[1:]):
+            if start >= end:
+                continue
+            selected.append(start + int(numpy.argmin(y[start:end])))
+            selected.append(start + int(numpy.argmax(y[start:end])))
+        return numpy.unique(selected)
+
+    @classmethod
+    def select(cls, cdata, max_points, method=LTTB):
+        '''
+        :return:    Array of the index of the rows of the selected points.
+                    The points of max_points are shared by the series.
+        '''
+        if not cls.is_supported(method):
+            raise cls.Error(f'Unknown Method: {method}')
+        count = cdata.get_count()
+        max_points = max(int(max_points), cls.MIN_POINTS)
+        if count <= max_points:
+            return numpy.arange(count)
+        series = [cdata.columns[x] for x in cdata.colnames
+                  if x != 'stamp' and cdata.columns[x].dtype.kind in 'iuf']
+        if not series:
+            return numpy.unique(numpy.linspace(0, count - 1, max_points)
+                                .astype('i8'))
+        threshold = max(max_points // len(series), cls.MIN_POINTS)
+        func = cls.lttb if method == cls.LTTB else cls.minmax
+        selected = [numpy.array([0, count - 1])]
+        for array in series:
+            index = numpy.flatnonzero(cls.to_valid(array))
+            if len(index):
+                selected.append(index[func(array[index], threshold)])
+        return numpy.unique(numpy.concatenate(selected))
+
+    @classmethod
+    def downsample(cls, cdata, max_points, method=LTTB):
+        '''
+        :param cdata:       ColumnData of the rows in order of the day.
+        :param max_points:  Count of the rows at most, about.
+        :return:            ColumnData of the selected rows.
+        '''
+        index = cls.select(cdata, max_points, method)
+        if len(index) == cdata.get_count():
+            return cdata
+        return cdata.take(index)
+
+    def invalidate(self, prefix):
+        '''
+        :param prefix:  The key of the code, the rows of all ranges.
+        '''
+        self.invalidate_keys(lambda x: x.startswith(prefix+':'))
+
+    def get(self, key, max_points, method, load):
+        '''
+        :param key:         The key of the code and the range, None is not
+                            cached.
+        :param load:        load() returns ColumnData of the rows.
+        :return:            ColumnData of the downsampled rows.
+        '''
+        if not self.is_supported(method):
+            raise self.Error(f'Unknown Method: {method}')
+        if key is None:
+            return self.downsample(load(), max_points, method)
+        key = f'{key}:{max_points}:{method}'
+        with self.loading(key) as gen:
+            entry = self.get_entry(key)
+            if entry is not None:
+                return entry['cdata']
+            cdata = self.downsample(load(), max_points, method)
+            self.dprint(f'Downsample {key} {cdata.get_count()}')
+            # The empty rows are not cached, the code is being collected.
+            if cdata.get_count():
+                self.put_entry(key, {'cdata': cdata,
+                                     'stamp': time.time() + self.DURATION},
+                               gen)
+        return cdata
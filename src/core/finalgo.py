@@ -1,16 +1,21 @@
 #!/usr/bin/env python3
 
 import codecs
+import collections
+import hashlib
 import itertools
 import json
 import multiprocessing
+import numpy
 import os
+import threading
 
 from collections import namedtuple
 
+from pysp.sbasic import SSingleton
 from pysp.serror import SDebug
 
-from core.model import Dict
+from core.model import ColumnData, Dict
 from core.finance import StockItemDB, StockQuery
 
 
@@ -30,9 +35,54 @@ class Algo:
 
 
 class AlgoOp(Algo):
+    '''
+    inputs and outputs are the index of the columns of the op, the values of
+    outputs are decided by params and the values of inputs.
+    '''
+    NULL = ColumnData.NULL_INT
+    inputs = []
+    outputs = []
+    params = ()
+
     def generate(self, idx, fields):
         raise NotImplementedError(f'{self.__class__.__name__}.generate')
 
+    def generate_columns(self, columns):
+        '''
+        The values of generate of all rows at once.
+        :param columns: List of the arrays of ColumnData by the index of
+                        colnames, the columns of this op are set to it.
+        '''
+        raise NotImplementedError(
+            f'{self.__class__.__name__}.generate_columns')
+
+    @classmethod
+    def to_int(cls, array):
+        '''
+        :return:    int() of each value, the truncation to zero.
+        '''
+        return numpy.trunc(array).astype('i8')
+
+    @classmethod
+    def rolling(cls, array, window, ufunc):
+        '''
+        The min or the max of the windows by van Herk/Gil-Werman, the
+        prefix and the suffix of the blocks of the window size.
+        :param ufunc:   numpy.minimum or numpy.maximum.
+        :return:        Array of ufunc of array[s:s+window] of each s.
+        '''
+        info = numpy.iinfo(array.dtype)
+        fill = info.max if ufunc is numpy.minimum else info.min
+        count = len(array)
+        blocks = -(-count // window)
+        padded = numpy.full(blocks * window, fill, dtype=array.dtype)
+        padded[:count] = array
+        padded = padded.reshape(blocks, window)
+        prefix = ufunc.accumulate(padded, axis=1).ravel()
+        suffix = ufunc.accumulate(padded[:, ::-1], axis=1)[:, ::-1].ravel()
+        starts = numpy.arange(count - window + 1)
+        return ufunc(suffix[starts], prefix[starts + window - 1])
+
 
 class AlgoProc(Algo):
     def process(self, idx, fields):
@@ -104,6 +154,9 @@ class OpPrice(AlgoOp):
         self.isprice = colnames.index(cfg.price.sell.colname)
         self.bpercent = cfg.price.buy.percent
         self.spercent = cfg.price.sell.percent
+        self.inputs = [self.ilow, self.ihigh]
+        self.outputs = [self.ibprice, self.isprice]
+        self.params = (self.bpercent, self.spercent)
 
     @classmethod
     def to_unit_price(cls, price, roundup):
@@ -119,6 +172,20 @@ class OpPrice(AlgoOp):
         # print('@', roundup, price, uprice)
         return uprice
 
+    @classmethod
+    def to_unit_prices(cls, prices, roundup):
+        '''
+        :return:    Array of to_unit_price of each price.
+        '''
+        keys = numpy.array(list(cls.TRADE_UNIT.keys()), dtype='i8')
+        units = numpy.array(list(cls.TRADE_UNIT.values()), dtype='i8')
+        pos = numpy.searchsorted(keys, prices, 'right')
+        mod = prices % units[numpy.minimum(pos, len(keys)-1)]
+        uprices = prices - mod
+        if roundup:
+            uprices += units[numpy.minimum(pos, len(keys)-1)]
+        return numpy.where((pos < len(keys)) & (mod != 0), uprices, prices)
+
     def generate(self, idx, fields):
         buyprice = None
         sellprice = None
@@ -134,6 +201,18 @@ class OpPrice(AlgoOp):
         values =[buyprice, sellprice]
         self._fill_data(indexes, values, field)
 
+    def generate_columns(self, columns):
+        low = columns[self.ilow]
+        high = columns[self.ihigh]
+        valid = (low != self.NULL) & (high != self.NULL)
+        low = numpy.where(valid, low, 0)
+        diff = numpy.where(valid, high, 0) - low
+        for iself, percent, roundup in [(self.ibprice, self.bpercent, True),
+                                        (self.isprice, self.spercent, False)]:
+            price = low + self.to_int(diff*percent/100)
+            price = self.to_unit_prices(price, roundup=roundup)
+            columns[iself] = numpy.where(valid, price, self.NULL)
+
 
 class OpSumAvg(AlgoOp):
     def __init__(self, accum, colnames):
@@ -144,6 +223,9 @@ class OpSumAvg(AlgoOp):
         self.iself = colnames.index(self.name)
         self.accum = accum
         self.items = []
+        self.inputs = [self.iend]
+        self.outputs = [self.iself]
+        self.params = (accum,)
     
     def generate(self, idx, fields):
         avg = None
@@ -154,6 +236,15 @@ class OpSumAvg(AlgoOp):
         self.items.append(data)
         self._fill_data([self.iself], [avg], fields[idx])
 
+    def generate_columns(self, columns):
+        end = columns[self.iend]
+        avg = numpy.full(len(end), self.NULL, dtype='i8')
+        if len(end) > self.accum:
+            sums = numpy.cumsum(numpy.r_[0, end])
+            window = sums[self.accum:-1] - sums[:-self.accum-1]
+            avg[self.accum:] = self.to_int(window/self.accum)
+        columns[self.iself] = avg
+
 
 class OpGradient(AlgoOp):
     def __init__(self, cfg, colname, colnames):
@@ -164,6 +255,9 @@ class OpGradient(AlgoOp):
         self.iself = colnames.index(self.name)
         self.accum = cfg.gradient.accum
         self.items = []
+        self.inputs = [self.icolname]
+        self.outputs = [self.iself]
+        self.params = (self.accum,)
     
     def generate(self, idx, fields):
         gradient = None
@@ -175,6 +269,17 @@ class OpGradient(AlgoOp):
             self.items.append(data)
         self._fill_data([self.iself], [gradient], fields[idx])
 
+    def generate_columns(self, columns):
+        data = columns[self.icolname]
+        gradient = numpy.full(len(data), self.NULL, dtype='i8')
+        # The items are of the values not None and not zero.
+        index = numpy.flatnonzero((data != self.NULL) & (data != 0))
+        values = data[index]
+        if len(index) > self.accum:
+            diff = values[self.accum-1:-1] - values[:-self.accum]
+            gradient[index[self.accum:]] = self.to_int(diff/(self.accum-1))
+        columns[self.iself] = gradient
+
 
 class Curve:
     HIGH = 3
@@ -202,6 +307,8 @@ class OpCurveStep(AlgoOp):
         self.igradients = [colnames.index(x) for x in std_colnames]
         self.istep = colnames.index(self.name)
         self.istepname = colnames.index(self.stepname)
+        self.inputs = list(self.igradients)
+        self.outputs = [self.istep, self.istepname]
     
     def generate(self, idx, fields):
         step = None
@@ -215,6 +322,17 @@ class OpCurveStep(AlgoOp):
         # print('@', idx, len(fields[idx]), self.istep, self.name, self.stepname)
         self._fill_data([self.istep, self.istepname], [step, stepname], fields[idx])
 
+    def generate_columns(self, columns):
+        gt1st = columns[self.igradients[0]]
+        gt2nd = columns[self.igradients[1]]
+        valid = (gt1st != self.NULL) & (gt2nd != self.NULL)
+        step = numpy.array(self.STEP, dtype='i8')[
+            (gt1st > 0)*2 + (gt2nd > 0)*1]
+        names = numpy.array([Curve.STEP.get(x) for x in range(len(self.STEP))],
+                            dtype=object)
+        columns[self.istep] = numpy.where(valid, step, self.NULL)
+        columns[self.istepname] = numpy.where(valid, names[step], None)
+
 
 class OpMinMax(AlgoOp):
     COLNAME_PERCENT = 'pct{}m'
@@ -233,6 +351,9 @@ class OpMinMax(AlgoOp):
         self.ipct = colnames.index(self.pctname)
         self.accum = accum*5*4
         self.items = []
+        self.inputs = [self.iend]
+        self.outputs = [self.imin, self.imax, self.ipct]
+        self.params = (self.accum,)
     
     def generate(self, idx, fields):
         minvalue = None
@@ -252,6 +373,26 @@ class OpMinMax(AlgoOp):
         self._fill_data([self.imin, self.imax, self.ipct], 
                         [minvalue, maxvalue, percent], fields[idx])
 
+    def generate_columns(self, columns):
+        end = columns[self.iend]
+        values = [numpy.full(len(end), self.NULL, dtype='i8')
+                  for _ in range(3)]
+        if len(end) > self.accum:
+            # The window of the previous accum days of each day.
+            minvalue = self.rolling(end[:-1], self.accum, numpy.minimum)
+            maxvalue = self.rolling(end[:-1], self.accum, numpy.maximum)
+            data = end[self.accum:]
+            span = maxvalue - minvalue
+            percent = self.to_int((data-minvalue)/numpy.where(
+                span == 0, 1, span)*100)
+            percent = numpy.where(span == 0,
+                                  numpy.where(data < minvalue, 0, 100),
+                                  percent)
+            for array, value in zip(values, [minvalue, maxvalue, percent]):
+                array[self.accum:] = value
+        for iself, array in zip([self.imin, self.imax, self.ipct], values):
+            columns[iself] = array
+
 
 class CondBuy(AlgoProc):
     COLNAME_BUYCNT =        'buycnt'
@@ -498,13 +639,70 @@ class CalSell(AlgoProc):
         self._fill_data(indexes, values, field)
 
 
+class OpCache(metaclass=SSingleton):
+    '''
+    The columns of AlgoOp of a process, keyed by the op, its params and the
+    keys of its inputs, the columns of the data are keyed by the
+    fingerprint of the data. So a column is generated once for the data and
+    shared by the configs of the same op, e.g. the configs of IterAlgo.
+    The children of the pool forked after it is warmed share it too.
+    '''
+    MAX_KEYS = 256
+
+    def __init__(self):
+        self._entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def fingerprint(cls, dumped):
+        '''
+        :param dumped:  JSON of QueryData.
+        '''
+        return hashlib.sha1(dumped.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''
+        :return:    (arrays, lists) of the outputs of the op, None if missed.
+        '''
+        with self.lock:
+            entry = self._entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, arrays):
+        entry = (arrays, [ColumnData.to_list(x) for x in arrays])
+        with self.lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.MAX_KEYS:
+                self._entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        with self.lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
 class AlgoTable:
 
     def __init__(self, qdata, cfg=None):
-        self.qdata = Dict(json.loads(json.dumps(qdata)))
+        if isinstance(qdata, ColumnData):
+            qdata = qdata.to_query()
+        dumped = json.dumps(qdata)
+        self.fingerprint = OpCache.fingerprint(dumped)
+        self.qdata = Dict(json.loads(dumped))
         self.operate = []
         qcolnames = self.qdata.colnames
         self.cfg = self.default_option() if cfg is None else cfg
+        self.ncolnames = len(qcolnames)
 
         self.operate.append(OpPrice(self.cfg, qcolnames))
         self.operate.append(OpGradient(self.cfg, 'end', qcolnames))
@@ -562,7 +760,58 @@ class AlgoTable:
             params.append(p)
         return params
 
+    def to_columns(self):
+        '''
+        :return:    List of the arrays of the columns of qdata by the index of
+                    colnames, None if the operations can not be vectorized,
+                    the prices are not integer, end has None or the
+                    accumulations raise the error of generate.
+        '''
+        cfg = self.cfg
+        accums = list(cfg.sum.accums) + list(cfg.minmax.accums)
+        if cfg.gradient.accum < 2 or (accums and min(accums) < 1):
+            return None
+        colnames = self.qdata.colnames[:self.ncolnames]
+        fields = self.qdata.fields
+        columns = [None] * len(self.qdata.colnames)
+        for colname in ['end', cfg.price.ref_colname.low,
+                        cfg.price.ref_colname.high]:
+            i = colnames.index(colname)
+            columns[i] = ColumnData.to_array([x[i] for x in fields])
+            if columns[i].dtype.kind != 'i':
+                return None
+        if (columns[colnames.index('end')] == ColumnData.NULL_INT).any():
+            return None
+        return columns
+
     def generate(self):
+        '''
+        The columns of the operations at once on the arrays, the values are
+        the same of generate_rows.
+        '''
+        columns = self.to_columns()
+        if columns is None:
+            return self.generate_rows()
+        cache = OpCache()
+        keys = [('data', self.fingerprint, x) for x in range(self.ncolnames)]
+        keys += [None] * (len(columns) - self.ncolnames)
+        values = [None] * len(columns)
+        for op in self.operate:
+            opkey = (op.__class__.__name__, op.params,
+                     tuple([keys[x] for x in op.inputs]))
+            entry = cache.get(opkey)
+            if entry is None:
+                op.generate_columns(columns)
+                entry = cache.put(opkey, [columns[x] for x in op.outputs])
+            for i, ix in enumerate(op.outputs):
+                columns[ix] = entry[0][i]
+                values[ix] = entry[1][i]
+                keys[ix] = (opkey, i)
+        values = values[self.ncolnames:]
+        for field, value in zip(self.qdata.fields, zip(*values)):
+            field.extend(value)
+
+    def generate_rows(self):
         for idx in range(len(self.qdata.fields)):
             for op in self.operate:
                 op.generate(idx, self.qdata.fields)
@@ -761,6 +1010,13 @@ class IterAlgo:
         sim.too_much = []
         sim.per_day = []
         sim.ecount = []
+        # The columns of the ops are generated once before the pool is
+        # forked, the configs differ in sum.accums only.
+        for accums in self.SUM_ACCUMS:
+            cfg = AlgoTable.default_option()
+            cfg.sum.accums = accums
+            cfg.curve.step = AlgoTable.get_curve_step_params(accums)
+            AlgoTable(qdata, cfg=cfg)
         cpu = multiprocessing.cpu_count()
         pool = multiprocessing.Pool(processes=cpu)
         mindays = len(qdata.fields)/5
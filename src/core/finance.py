@@ -1,58 +1,472 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import concurrent.futures
 import copy
-import datetime
+import functools
+import glob
+import itertools
+import numpy
 import os
 import sqlalchemy
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
 from dateutil.relativedelta import relativedelta
 from sqlalchemy import and_, Column
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import NullPool
 
-from pysp.sbasic import SFile
+from pysp.sbasic import SFile, SSingleton
 from pysp.sconf import SConfig
-# from pysp.serror import SDebug
-from pysp.ssql import SSimpleDB
+from pysp.serror import SCDebug
+from pysp.ssql import SSQL, SSimpleDB
 
 from core.helper import DateTool
-from core.cache import FCache
+from core.archive import ColdArchive
+from core.cache import FCache, RangeCache
+from core.codedir import CodeDirectory
+from core.colstore import ColumnStore
 from core.config import BillConfig
+from core.downsample import ChartDownsample
+from core.lock import CodeLock
+from core.metrics import CollectJob
+from core.pipeline import CollectPipeline
+from core.resample import StockResample
+from core.tradeday import TradeCalendar
 from core.connect import FDaum, FNaver, FKrx, FUnknown
 from core.model import (StockDayInvestor, StockDayShort,
-                        ServiceProvider, QueryData)
+                        ServiceProvider, QueryData, ColumnData)
 
 
 class StockItemDB(SSimpleDB):
     class Error(Exception):
         pass
     # SQL_ECHO = True
+    KEYS = ['stamp']
+    HIDDEN_COLNAMES = ['day']
+    MIGRATE_BATCH = 500
+    # PRAGMA user_version, the stores before it are migrated once.
+    SCHEMA_VERSION = 1
+    CANDLE_COLNAMES = ['finance', 'start', 'end', 'high', 'low', 'volume']
+    # The recent rows are patched if the late columns of them are missed.
+    PATCH_ROWS = 10
+    SQL_VARIABLES = 500
+    _schemas = {}
+    _schemas_lock = threading.Lock()
 
     def __init__(self, **kwargs):
         self.db_file = kwargs.get('db_file')
+        self.code = kwargs.get('code')
+        self.read_only = kwargs.get('read_only', False)
         db_config = kwargs.get('db_config')
-        super(StockItemDB, self).__init__(self.db_file, SConfig(db_config))
+        if self.read_only:
+            self._init_reader(self.load_schema(db_config))
+            return
+        super(StockItemDB, self).__init__(self.db_file,
+                                          self.load_schema(db_config))
+
+    def _init_reader(self, config):
+        '''
+        Open the file with the read-only connections, the tables are neither
+        created nor migrated and a missing file is an error.
+        '''
+        SSQL.__init__(self, config)
+        uri = f'file:{self.db_file}?mode=ro'
+        self.engine = sqlalchemy.create_engine(
+            'sqlite://', creator=lambda: sqlite3.connect(uri, uri=True),
+            poolclass=NullPool, echo=self.SQL_ECHO)
+        self.session = sessionmaker(bind=self.engine)()
+        self.get_table('stock_day')
+
+    def snapshot(self):
+        '''
+        :return:    A copy sharing the engine and the tables with its own
+                    session, the read transaction of the session sees the
+                    last committed snapshot of WAL.
+        '''
+        sidb = copy.copy(self)
+        sidb.session = sessionmaker(bind=self.engine)()
+        return sidb
+
+    @classmethod
+    def load_schema(cls, db_config):
+        '''
+        :return:    SConfig of the yml file, it is parsed once and each file
+                    has its own copy, the migrate of the tables is deleted
+                    from the copy when the file is migrated.
+        '''
+        with cls._schemas_lock:
+            if db_config not in cls._schemas:
+                cls._schemas[db_config] = SConfig(db_config)
+            return copy.deepcopy(cls._schemas[db_config])
+
+    @classmethod
+    def checkout(cls, code):
+        '''
+        with StockItemDB.checkout(code) as sidb:
+            ...
+        :return:    Context manager of an open handle in StockItemPool.
+        '''
+        return StockItemPool().checkout(code)
+
+    @classmethod
+    def reader(cls, code):
+        '''
+        with StockItemDB.reader(code) as sidb:
+            ...
+        :return:    Context manager of a read-only snapshot of the code,
+                    the readers do not wait for the writer of the code.
+        '''
+        return StockItemPool().checkout(code, read_only=True)
 
     @classmethod
-    def factory(cls, code):
+    def factory(cls, code, read_only=False):
         bcfg = BillConfig()
+        if bcfg.get_value('_config.db.stock_backend') == 'multi':
+            return StockMultiDB.factory(code, read_only=read_only)
         db_file = '{folder}/{code}.sqlite3'.format(
             folder=bcfg.get_value('_config.db.stock_folder'), code=code)
         SFile.mkdir(os.path.dirname(db_file))
         db_config = bcfg.get_value('_config.db.stock_yml')
-        return cls(db_file=db_file, db_config=db_config)
+        return cls(db_file=db_file, db_config=db_config, code=code,
+                   read_only=read_only)
+
+    @classmethod
+    def list_codes(cls):
+        bcfg = BillConfig()
+        if bcfg.get_value('_config.db.stock_backend') == 'multi':
+            return StockMultiDB.list_codes()
+        folder = bcfg.get_value('_config.db.stock_folder')
+        return sorted([os.path.basename(x).split('.')[0]
+                       for x in glob.glob(folder+'/*.sqlite3')])
+
+    @classmethod
+    def last_days(cls, codes=None):
+        '''
+        :param codes:   List of code, default is all of the stored codes.
+        :return:        Dict of the last stored day of each code,
+                        None if the code has no row.
+        '''
+        bcfg = BillConfig()
+        if bcfg.get_value('_config.db.stock_backend') == 'multi':
+            return StockMultiDB.last_days(codes)
+        days = {}
+        for code in (cls.list_codes() if codes is None else codes):
+            try:
+                sidb = cls.factory(code, read_only=True)
+            except Exception:
+                days[code] = None
+                continue
+            days[code] = sidb.last_day()
+            sidb.session.close()
+        return days
+
+    def last_day(self):
+        '''
+        :return:    The last stored day, None if no row.
+        '''
+        table = self.get_table('stock_day')
+        sql = sqlalchemy.sql.select([sqlalchemy.func.max(table.c.day)]).\
+            where(and_(*self.stock_day_filter(table)))
+        return self.session.execute(sql).scalar()
+
+    def days_since(self, sday):
+        '''
+        :return:    List of the stored days from sday.
+        '''
+        table = self.get_table('stock_day')
+        sql = sqlalchemy.sql.select([table.c.day]).where(and_(
+            table.c.day >= DateTool.to_day(sday),
+            *self.stock_day_filter(table))).order_by(table.c.day.asc())
+        return [x[0] for x in self.session.execute(sql).fetchall()]
+
+    def patch_day(self, day=None):
+        '''
+        :param day:     The last day, default is the last stored day.
+        :return:        The first day of the recent PATCH_ROWS rows to the
+                        day, the rows from it are patched by the late columns.
+                        None if no row.
+        '''
+        table = self.get_table('stock_day')
+        wheres = self.stock_day_filter(table)
+        if day is not None:
+            wheres.append(table.c.day <= DateTool.to_day(day))
+        sql = sqlalchemy.sql.select([table.c.day]).where(and_(*wheres)).\
+            order_by(table.c.day.desc()).limit(self.PATCH_ROWS)
+        days = [x[0] for x in self.session.execute(sql).fetchall()]
+        return min(days) if days else None
+
+    def get_version(self):
+        '''
+        :return:    The version of the rows of this code, '<base>.<revision>'.
+                    revision is changed by every write and base by the write
+                    of the days before the recent PATCH_ROWS rows.
+        '''
+        try:
+            table = self.get_table('stock_version')
+        except sqlalchemy.exc.NoSuchTableError:
+            # The file is not opened by the writer since the table is added.
+            return '0.0'
+        sql = sqlalchemy.sql.select([table.c.base, table.c.revision]).\
+            where(table.c.code == self.code)
+        row = self.session.execute(sql).first()
+        return '0.0' if row is None else f'{row[0]}.{row[1]}'
+
+    def update_version(self, old=False, day=None):
+        '''
+        Change the version in the transaction of the write.
+        :param old:     True if the days before the recent PATCH_ROWS rows
+                        are written, the delta of the clients is not enough.
+        :param day:     The first written day, the first of them is kept as
+                        dirty until the columnar copy is synced.
+        '''
+        if not self.code:
+            return
+        table = self.get_table('stock_version')
+        sql = sqlalchemy.sql.select([table.c.base, table.c.revision,
+                                     table.c.dirty]).\
+            where(table.c.code == self.code)
+        row = self.session.execute(sql).first()
+        revision = int(time.time() * 1000)
+        if row is None:
+            self.session.execute(sqlalchemy.insert(table).values(
+                code=self.code, base=revision, revision=revision, dirty=day))
+            return
+        revision = max(revision, row[1] + 1)
+        dirty = min([x for x in [row[2], day] if x is not None] or [None])
+        self.session.execute(sqlalchemy.update(table).where(
+            table.c.code == self.code).values(
+                base=revision if old else row[0], revision=revision,
+                dirty=dirty))
+
+    def get_dirty(self):
+        '''
+        :return:    (dirty, revision), dirty is the first day written after
+                    the columnar copy is synced, None if no day is written.
+        '''
+        table = self.get_table('stock_version')
+        sql = sqlalchemy.sql.select([table.c.dirty, table.c.revision]).\
+            where(table.c.code == self.code)
+        row = self.session.execute(sql).first()
+        return (None, None) if row is None else (row[0], row[1])
+
+    def clear_dirty(self, revision):
+        '''
+        :param revision:    The revision of get_dirty, the dirty day of
+                            the later writes is kept for the next sync.
+        '''
+        table = self.get_table('stock_version')
+        self.session.execute(sqlalchemy.update(table).where(and_(
+            table.c.code == self.code, table.c.revision == revision)).values(
+                dirty=None))
+        self.session.commit()
+
+    def _create_table(self, meta, dictable):
+        tablename = dictable['name']
+        args = [tablename, meta]
+        for colparams in dictable['columns']:
+            args.append(self.build_column(colparams))
+        kwargs = {}
+        if dictable.get('without_rowid', False):
+            kwargs['sqlite_with_rowid'] = False
+        sqlalchemy.Table(*args, **kwargs)
+
+    def init_tables(self):
+        super(StockItemDB, self).init_tables()
+        version = self.engine.execute('PRAGMA user_version').scalar()
+        if version < self.SCHEMA_VERSION:
+            # The days are unique before the unique index of day.
+            self.migrate_day()
+            self.dedup_day()
+        for dictable in self.config.get_value('tables'):
+            for index in dictable.get('indexes', []):
+                sql = 'CREATE {unique}INDEX IF NOT EXISTS {name} ' \
+                    'ON {tn} ({cns})'
+                self.engine.execute(sql.format(
+                    unique='UNIQUE ' if index.get('unique', False) else '',
+                    name=index['name'], tn=dictable['name'],
+                    cns=','.join([f'"{x}"' for x in index['columns']])))
+        if version < self.SCHEMA_VERSION:
+            self.engine.execute(f'PRAGMA user_version = {self.SCHEMA_VERSION}')
+
+    def migrate_day(self):
+        '''
+        Fill the integer day of the rows stored before the column was added.
+        It is done in the short transactions of MIGRATE_BATCH rows,
+        so the readers of WAL go on while a large store is migrated.
+        :return:    Count of the migrated rows.
+        '''
+        keys = ','.join(self.KEYS)
+        sql = 'UPDATE stock_day SET day = CAST(SUBSTR(stamp, 1, 4) || ' \
+            'SUBSTR(stamp, 6, 2) || SUBSTR(stamp, 9, 2) AS INTEGER) ' \
+            f'WHERE ({keys}) IN (SELECT {keys} FROM stock_day ' \
+            f'WHERE day IS NULL LIMIT {self.MIGRATE_BATCH})'
+        count = 0
+        while True:
+            rv = self.engine.execute(sql)
+            if rv.rowcount <= 0:
+                break
+            count += rv.rowcount
+        return count
+
+    def dedup_day(self):
+        '''
+        Remove the rows of the legacy stamps of the same day, e.g.
+        '2019.03.04' and '2019-03-04'. The row of the stamp of DateTool,
+        the one written lately, is kept or the last stamp of them.
+        :return:    Count of the removed rows.
+        '''
+        groups = ','.join([x for x in self.KEYS if x != 'stamp'] + ['day'])
+        sql = f'SELECT {",".join(self.KEYS)},day FROM stock_day ' \
+            f'WHERE ({groups}) IN (SELECT {groups} FROM stock_day ' \
+            f'WHERE day IS NOT NULL GROUP BY {groups} HAVING count(*) > 1)'
+        dups = collections.defaultdict(list)
+        for row in self.engine.execute(sql).fetchall():
+            row = dict(zip(self.KEYS + ['day'], row))
+            dups[tuple(row[x] for x in groups.split(','))].append(row)
+        table = self.get_table('stock_day')
+        count = 0
+        for rows in dups.values():
+            rows.sort(key=lambda x: (
+                x['stamp'] == DateTool.to_stamp(x['day']), x['stamp']))
+            for row in rows[:-1]:
+                self.engine.execute(table.delete().where(
+                    and_(*[table.c[x] == row[x] for x in self.KEYS])))
+                count += 1
+        return count
+
+    def compact(self):
+        '''
+        Give back the pages of the deleted rows, e.g. archived rows.
+        '''
+        self.engine.execute('VACUUM')
+
+    def get_colnames(self, tablename):
+        colnames = super(StockItemDB, self).get_colnames(tablename)
+        return [x for x in colnames if x not in self.HIDDEN_COLNAMES]
+
+    def stock_day_filter(self, table):
+        '''
+        :return:    List of the conditions to select rows of this code.
+        '''
+        return []
+
+    def stock_day_key(self):
+        '''
+        :return:    Dict of the key columns of this code in a row.
+        '''
+        return {}
+
+    def query_day(self, day, *colnames):
+        '''
+        :param day: Integer day, YYYYMMDD. A string or an object of date
+                    is also accepted.
+        '''
+        wheres = {'day': DateTool.to_day(day)}
+        return self.query('stock_day', *colnames, wheres=wheres)
+
+    @classmethod
+    def day_item(cls, stamp, **kwargs):
+        '''
+        :return:    Dict of a stock_day row, day is the first key to match.
+        '''
+        day = DateTool.to_day(stamp)
+        item = {'day': day, 'stamp': DateTool.to_stamp(day)}
+        item.update(kwargs)
+        return item
+
+    def stored_days(self, days, *colnames):
+        '''
+        :param days:    List of integer day.
+        :return:        Dict of the stored rows keyed by day,
+                        the rows are dict of colnames.
+        '''
+        table = self.get_table('stock_day')
+        columns = [table.c.day] + [table.c[x] for x in colnames]
+        stored = {}
+        for i in range(0, len(days), self.SQL_VARIABLES):
+            sql = sqlalchemy.sql.select(columns).where(and_(
+                table.c.day.in_(days[i:i+self.SQL_VARIABLES]),
+                *self.stock_day_filter(table)))
+            for row in self.session.query(sql).all():
+                stored[row[0]] = dict(zip(colnames, row[1:]))
+        return stored
+
+    def pending_days(self, *colnames):
+        '''
+        :return:    Days of the recent PATCH_ROWS rows, that miss any of
+                    colnames, the late columns to be patched.
+        '''
+        table = self.get_table('stock_day')
+        columns = [table.c.day] + [table.c[x] for x in colnames]
+        sql = sqlalchemy.sql.select(columns).\
+            where(and_(*self.stock_day_filter(table))).\
+            order_by(table.c.day.desc()).limit(self.PATCH_ROWS)
+        return [x[0] for x in self.session.query(sql).all()
+                if None in x[1:]]
+
+    def update_days(self, items):
+        '''
+        Write the merged rows once, a new day is inserted with all columns
+        and a stored day is patched with the late columns only.
+        The day without the candle is not stored.
+        :param items:   Dict of the merged rows keyed by day.
+        :return:        Count of the written rows.
+        '''
+        if not items:
+            return 0
+        table = self.get_table('stock_day')
+        colnames = [x.name for x in table.c]
+        lates = [x for x in colnames if x not in
+                 self.CANDLE_COLNAMES + self.KEYS + self.HIDDEN_COLNAMES]
+        stored = self.stored_days(sorted(items.keys()), *lates)
+        recent = self.patch_day()
+        inserts = []
+        patches = collections.defaultdict(list)
+        for day in sorted(items.keys()):
+            item = items[day]
+            if day not in stored:
+                if 'end' in item:
+                    row = dict({x: None for x in colnames}, **item)
+                    inserts.append(dict(row, **self.stock_day_key()))
+                continue
+            late = {k: v for k, v in item.items()
+                    if k in lates and stored[day][k] != v}
+            if late:
+                patch = {'b_'+k: v for k, v in late.items()}
+                patch['b_day'] = day
+                patches[tuple(sorted(late.keys()))].append(patch)
+        if inserts:
+            self.session.execute(sqlalchemy.insert(table), inserts)
+        for keys, rows in patches.items():
+            sql = sqlalchemy.update(table).where(and_(
+                table.c.day == sqlalchemy.bindparam('b_day'),
+                *self.stock_day_filter(table))).values(
+                    {x: sqlalchemy.bindparam('b_'+x) for x in keys})
+            self.session.execute(sql, rows)
+        days = [x['day'] for x in inserts] + \
+            [x['b_day'] for rows in patches.values() for x in rows]
+        if days:
+            self.update_version(recent is not None and min(days) < recent,
+                                day=min(days))
+        self.session.commit()
+        return len(days)
 
     def update_candle(self, days):
         if len(days) == 0:
             return False
         data = []
         for i, d in enumerate(days):
-            item = {
-                'stamp': datetime.date(*[int(x) for x in d.stamp.split('.')]),
-                'finance':  d.finance,
-                'start':    d.start,
-                'end':      d.end,
-                'high':     d.high,
-                'low':      d.low,
-                'volume':   d.volume,
-            }
+            item = self.day_item(
+                d.stamp,
+                finance=d.finance,
+                start=d.start,
+                end=d.end,
+                high=d.high,
+                low=d.low,
+                volume=d.volume)
             data.append(item)
         param = {
             'data': data,
@@ -65,19 +479,15 @@ class StockItemDB(SSimpleDB):
             return False
         data = []
         for i, d in enumerate(days):
-            item = {
-                'stamp': datetime.date(*[int(x) for x in d.stamp.split('.')]),
-                'foreigner':    d.foreigner,
-                'frate':        d.frate,
-                'institute':    d.institute,
-                'person':       d.person,
-            }
+            item = self.day_item(
+                d.stamp,
+                foreigner=d.foreigner,
+                frate=d.frate,
+                institute=d.institute,
+                person=d.person)
             if i == 0:
                 cols = ['stamp', 'foreigner', 'frate', 'institute', 'person']
-                options = {
-                    'wheres': {'stamp': item.get('stamp')}
-                }
-                rv = self.query('stock_day', *cols, **options)
+                rv = self.query_day(item.get('day'), *cols)
                 if not rv:
                     emsg = 'No Data, day field: {}'.format(item.get('stamp'))
                     raise StockItemDB.Error(emsg)
@@ -92,17 +502,13 @@ class StockItemDB(SSimpleDB):
             return False
         data = []
         for i, d in enumerate(days):
-            item = {
-                'stamp': datetime.date(*[int(x) for x in d.stamp.split('/')]),
-                'short':       d.short,
-                'shortamount': d.shortamount,
-            }
+            item = self.day_item(
+                d.stamp,
+                short=d.short,
+                shortamount=d.shortamount)
             if i == 0:
                 columns = ['stamp', 'short', 'shortamount']
-                options = {
-                    'wheres': {'stamp': item.get('stamp')}
-                }
-                rv = self.query('stock_day', *columns, **options)
+                rv = self.query_day(item.get('day'), *columns)
                 ds = StockDayShort.from_list(*rv[0])
                 if ds.short is not None:
                     return False
@@ -110,6 +516,250 @@ class StockItemDB(SSimpleDB):
         return self.upsert_array('stock_day', data=data)
 
 
+class StockMultiDB(StockItemDB):
+    '''
+    The consolidated store, stock_day of all codes are clustered by
+    (code, stamp) in one file, so a question across codes is a single scan
+    of the day indexes instead of opening each file of the codes.
+    '''
+    KEYS = ['code', 'stamp']
+    HIDDEN_COLNAMES = ['code', 'day']
+
+    @classmethod
+    def factory(cls, code, read_only=False):
+        bcfg = BillConfig()
+        db_file = bcfg.get_value('_config.db.stock_multi_file')
+        SFile.mkdir(os.path.dirname(db_file))
+        db_config = bcfg.get_value('_config.db.stock_multi_yml')
+        return cls(db_file=db_file, db_config=db_config, code=code,
+                   read_only=read_only)
+
+    @classmethod
+    def list_codes(cls):
+        mdb = cls.factory(None)
+        table = mdb.get_table('stock_day')
+        sql = sqlalchemy.sql.select([table.c.code]).distinct().\
+            order_by(table.c.code.asc())
+        return [x[0] for x in mdb.session.query(sql).all()]
+
+    @classmethod
+    def last_days(cls, codes=None):
+        mdb = cls.factory(None)
+        table = mdb.get_table('stock_day')
+        sql = sqlalchemy.sql.select([
+            table.c.code, sqlalchemy.func.max(table.c.day)]).\
+            group_by(table.c.code)
+        stored = dict(mdb.session.query(sql).all())
+        mdb.session.close()
+        if codes is None:
+            return stored
+        return {x: stored.get(x, None) for x in codes}
+
+    def stock_day_filter(self, table):
+        return [table.c.code == self.code]
+
+    def stock_day_key(self):
+        return {'code': self.code}
+
+    def compact(self):
+        # VACUUM of the consolidated store takes long with the lock of all
+        # codes, the free pages are reused by the next rows instead.
+        pass
+
+    def query_day(self, day, *colnames):
+        table = self.get_table('stock_day')
+        columns = [table.c[x] for x in colnames] if colnames else [table]
+        sql = sqlalchemy.sql.select(columns).where(
+            and_(table.c.code == self.code,
+                 table.c.day == DateTool.to_day(day)))
+        return self.session.query(sql).all()
+
+    def upsert_array(self, tablename, **kwargs):
+        tbl = self.get_table(tablename)
+        arr_data = kwargs.get('data')
+        only_insert = kwargs.get('only_insert', False)
+
+        executed_count = 0
+        self.session.begin_nested()
+        for data in arr_data:
+            data = dict(data, code=self.code)
+            where = and_(tbl.c.code == self.code, tbl.c.day == data['day'])
+            qc = sqlalchemy.sql.select([tbl.c.day]).where(where)
+            qi = sqlalchemy.insert(tbl).values(**data)
+            qu = sqlalchemy.update(tbl).values(**data).where(where)
+            try:
+                if self.session.query(qc).first() is None:
+                    self.session.execute(qi)
+                    executed_count += 1
+                elif only_insert is False:
+                    self.session.execute(qu)
+                    executed_count += 1
+            except Exception:
+                self.session.rollback()
+                return False
+        self.session.commit()
+        return True if executed_count > 0 else False
+
+    def import_rows(self, code, rows):
+        '''
+        :param code:    Code of the rows.
+        :param rows:    List of dict, the columns of stock_day.
+        :return:        Count of the imported rows.
+        '''
+        if not rows:
+            return 0
+        tbl = self.get_table('stock_day')
+        sql = sqlalchemy.insert(tbl).prefix_with('OR REPLACE')
+        self.session.execute(sql, [dict(x, code=code) for x in rows])
+        self.session.commit()
+        return len(rows)
+
+
+class StockItemPool(SCDebug, metaclass=SSingleton):
+    '''
+    Bounded LRU cache of the open StockItemDB handles keyed by code.
+    A handle is used by one thread at a time, its engine, the reflected
+    tables and the parsed schema are reused by the next checkout.
+    A read-only handle is shared by the readers, each of them has its own
+    session of the snapshot.
+    '''
+    SIZE = 32
+    IDLE_TIMEOUT = 300
+
+    class _Handle:
+        def __init__(self, sidb):
+            self.sidb = sidb
+            self.lock = threading.Lock()
+            self.stamp = time.time()
+            self.refs = 0
+
+        def close(self):
+            self.sidb.session.close()
+            self.sidb.engine.dispose()
+
+    def __init__(self):
+        bcfg = BillConfig()
+        self.size = int(bcfg.get_value('db.stock.pool_size', self.SIZE))
+        self.idle_timeout = int(bcfg.get_value('db.stock.idle_timeout',
+                                               self.IDLE_TIMEOUT))
+        self._handles = collections.OrderedDict()
+        # code: [Lock, count of the openers], the openers of a code.
+        self._openers = {}
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._handles)
+
+    @contextmanager
+    def checkout(self, code, read_only=False):
+        handle = self._acquire(code, read_only)
+        try:
+            if read_only:
+                sidb = handle.sidb.snapshot()
+                try:
+                    yield sidb
+                finally:
+                    sidb.session.close()
+            else:
+                yield handle.sidb
+        finally:
+            self._release(handle)
+
+    def _acquire(self, code, read_only=False):
+        self.remove_expired()
+        key = (code, read_only)
+        handle = self._get(key)
+        if handle is None:
+            # The file is opened and migrated out of the lock of the pool,
+            # only the checkouts of the code wait for it.
+            with self._opening(code):
+                handle = self._get(key)
+                if handle is None:
+                    handle = self._Handle(StockItemDB.factory(code, read_only))
+                    with self.lock:
+                        handle.refs += 1
+                        self._handles[key] = handle
+                        self._evict()
+        if not read_only:
+            handle.lock.acquire()
+        return handle
+
+    def _get(self, key):
+        '''
+        :return:    The handle referenced by the checkout, None if not open.
+        '''
+        with self.lock:
+            handle = self._handles.get(key, None)
+            if handle is not None:
+                handle.refs += 1
+                self._handles.move_to_end(key)
+            return handle
+
+    @contextmanager
+    def _opening(self, code):
+        with self.lock:
+            opener = self._openers.setdefault(code, [threading.Lock(), 0])
+            opener[1] += 1
+        try:
+            with opener[0]:
+                yield
+        finally:
+            with self.lock:
+                opener[1] -= 1
+                if opener[1] == 0:
+                    del self._openers[code]
+
+    def _release(self, handle):
+        # The connection is bound to the thread, so it is returned here
+        # and the next checkout opens a new one on its own thread.
+        if not handle.sidb.read_only:
+            handle.sidb.session.close()
+            handle.lock.release()
+        with self.lock:
+            handle.refs -= 1
+            handle.stamp = time.time()
+
+    def _evict(self):
+        for key in list(self._handles.keys()):
+            if len(self._handles) <= self.size:
+                break
+            if self._handles[key].refs == 0:
+                self._handles.pop(key).close()
+                self.dprint(f'Evict {key}')
+
+    def remove_expired(self):
+        cstamp = time.time() - self.idle_timeout
+        with self.lock:
+            for key, handle in list(self._handles.items()):
+                if handle.refs == 0 and handle.stamp < cstamp:
+                    self._handles.pop(key).close()
+                    self.dprint(f'Close idle {key}')
+
+    def clear(self):
+        with self.lock:
+            for key, handle in list(self._handles.items()):
+                if handle.refs == 0:
+                    self._handles.pop(key).close()
+
+
+class StockDayMerge:
+    '''
+    The rows of the streams, the candle, the investor and the short stock,
+    joined by day in memory.
+    '''
+    def __init__(self):
+        self.items = {}
+
+    def add(self, rows):
+        for row in rows:
+            day = DateTool.to_day(row['stamp'])
+            item = self.items.get(day, None)
+            if item is None:
+                item = StockItemDB.day_item(day)
+                self.items[day] = item
+            item.update({k: v for k, v in row.items() if k != 'stamp'})
+
+
 class DataCollection:
     class Error(Exception):
         pass
@@ -119,6 +769,8 @@ class DataCollection:
         'naver':    FNaver,
         'krx':      FKrx,
     }
+    # The columns of the streams after the candle, they arrive late.
+    LATE_COLNAMES = StockDayInvestor.COLUMNS[1:] + StockDayShort.COLUMNS[1:]
 
     def __init__(self):
         super(DataCollection, self).__init__()
@@ -128,87 +780,192 @@ class DataCollection:
         return cls.PROVIDER.get(sp.name, FUnknown)
 
     @classmethod
-    def collect_candle(cls, sp, **kwargs):
-        page = 0
-        loop = True
-        wstate = kwargs.get('wstate', None)
+    def _merge_candle(cls, code, merge, pages):
+        '''
+        The writer stage of CollectPipeline, the new candles are merged.
+        :return:    Count of the pages to go on.
+        '''
+        with StockItemDB.checkout(code) as sidb:
+            for i, rows in enumerate(pages):
+                days = [DateTool.to_day(x['stamp']) for x in rows]
+                stored = sidb.stored_days(days)
+                rows = [x for x, d in zip(rows, days) if d not in stored]
+                if not rows:
+                    return i
+                merge.add(rows)
+        return len(pages)
+
+    @classmethod
+    def _merge_late(cls, code, merge, pages, colnames):
+        '''
+        The writer stage of CollectPipeline, the late columns are merged.
+        It stops at the page having a stored row of the same columns,
+        unless the page is newer than the rows to be patched.
+        :return:    Count of the pages to go on.
+        '''
+        with StockItemDB.checkout(code) as sidb:
+            pending = sidb.pending_days(*colnames)
+            for i, rows in enumerate(pages):
+                if not rows:
+                    return i
+                merge.add(rows)
+                days = [DateTool.to_day(x['stamp']) for x in rows]
+                stored = sidb.stored_days(days, *colnames)
+                same = [d for x, d in zip(rows, days) if d in stored and
+                        all([stored[d][c] == x[c] for c in colnames])]
+                if same and (not pending or min(days) <= min(pending)):
+                    return i
+        return len(pages)
+
+    @classmethod
+    def _run_stream(cls, sp, merge_func, fetch, parse, **kwargs):
+        merge = kwargs.get('merge', None)
+        job = kwargs.get('job', None)
+        flush = merge is None
+        if flush:
+            merge = StockDayMerge()
+        pipeline = CollectPipeline(**kwargs)
+        pipeline.run(fetch=fetch, parse=parse,
+                     store=functools.partial(merge_func, sp.code, merge))
+        if job is not None:
+            job.pages += pipeline.fetched
+        if flush:
+            rows = cls.store_merge(sp.code, merge)
+            if job is not None:
+                job.rows += rows
+
+    @classmethod
+    def store_merge(cls, code, merge):
+        with StockItemDB.checkout(code) as sidb:
+            count = sidb.update_days(merge.items)
+            if merge.items:
+                StockQuery.invalidate(sidb, since=min(merge.items))
+            return count
+
+    @classmethod
+    def get_chunk_funcs(cls, sp, chunk):
+        '''
+        :param chunk:   'day', 'dayinvestor' or 'shortstock'.
+        :return:        fetch(page=page) and parse(raw) of the chunk of
+                        the provider, the stages of CollectPipeline.
+        '''
         provider = cls.get_provider(sp)
-        sidb = StockItemDB.factory(sp.code)
-        while loop:
-            if wstate and wstate.is_run() is False:
-                break
-            page += 1
-            chunk = provider.get_chunk('day', code=sp.code, page=page)
-            loop = sidb.update_candle(chunk)
+        if chunk == 'shortstock':
+            kwargs = {'fcode': CodeDirectory().get_fullcode(sp.code),
+                      'scode': 'A'+sp.code}
+        else:
+            kwargs = {'code': sp.code}
+        return (functools.partial(provider.fetch_chunk, chunk, **kwargs),
+                functools.partial(provider.parse_chunk, chunk))
+
+    @classmethod
+    def collect_candle(cls, sp, **kwargs):
+        '''
+        :param merge:   StockDayMerge to join the streams, the rows are stored
+                        at the end of the stream if it is not given.
+        '''
+        fetch, parse = cls.get_chunk_funcs(sp, 'day')
+        cls._run_stream(sp, cls._merge_candle, fetch, parse, **kwargs)
 
     @classmethod
     def collect_investor(cls, sp, **kwargs):
-        page = 0
-        loop = True
-        wstate = kwargs.get('wstate', None)
-        provider = cls.get_provider(sp)
-        sidb = StockItemDB.factory(sp.code)
-        while loop:
-            if wstate and wstate.is_run() is False:
-                break
-            page += 1
-            chunk = provider.get_chunk('dayinvestor', code=sp.code, page=page)
-            loop = sidb.update_investor(chunk)
+        fetch, parse = cls.get_chunk_funcs(sp, 'dayinvestor')
+        cls._run_stream(
+            sp, functools.partial(cls._merge_late,
+                                  colnames=StockDayInvestor.COLUMNS[1:]),
+            fetch, parse, **kwargs)
 
     @classmethod
     def collect_shortstock(cls, sp, **kwargs):
-        page = 0
-        loop = True
-        wstate = kwargs.get('wstate', None)
-        provider = cls.get_provider(sp)
-        sidb = StockItemDB.factory(sp.code)
-        codepool = provider.get_chunk('list')
-        shortcode = 'A'+sp.code
-        fullcode = provider.get_fullcode(codepool, shortcode)
-        while loop:
-            if wstate and wstate.is_run() is False:
-                break
-            page += 1
-            params = {
-                'fcode': fullcode,
-                'scode': shortcode,
-                'page':  page,
-            }
-            chunk = provider.get_chunk('shortstock', **params)
-            loop = sidb.update_shortstock(chunk)
+        fetch, parse = cls.get_chunk_funcs(sp, 'shortstock')
+        cls._run_stream(
+            sp, functools.partial(cls._merge_late,
+                                  colnames=StockDayShort.COLUMNS[1:]),
+            fetch, parse, **kwargs)
 
     @classmethod
     def factory_provider(cls, code, pname):
-        items = FKrx.get_chunk('list')
-        acode = 'A'+str(code)
         if pname not in cls.PROVIDER:
             cls.Error(f'Not Exist Provider Name: {pname}')
-        for item in items:
-            if acode == item['short_code']:
-                return ServiceProvider(name=pname,
-                                       codename=item['codeName'], code=code)
-        raise cls.Error(f'Not Exist Code: {code}')
+        item = CodeDirectory().get(code)
+        if item is None:
+            raise cls.Error(f'Not Exist Code: {code}')
+        return ServiceProvider(name=pname, codename=item['codeName'],
+                               code=code)
 
     @classmethod
     def get_name_of_code(cls, code):
-        sp = cls.factory_provider(code, 'krx')
-        provider = cls.get_provider(sp)
-        shortcode = 'A'+code
-        for item in provider.get_chunk('list'):
-            if item['short_code'] == shortcode:
-                return item['codeName']
-        return None
+        return CodeDirectory().get_name(code)
 
     @classmethod
     def collect(cls, code, **kwargs):
+        '''
+        :param job:     CollectJob of the metrics, the phases are timed.
+        '''
+        job = kwargs.pop('job', None) or CollectJob(code)
+        if not kwargs.pop('force', False) and cls.is_current(code):
+            # The rows of the last session are stored, no request is sent.
+            job.skipped = True
+            return job
+        # The streams are joined by day, and each row is written once.
+        merge = StockDayMerge()
         sp = cls.factory_provider(code, 'naver')
-        cls.collect_candle(sp, **kwargs)
-        cls.collect_investor(sp, **kwargs)
+        with job.phase('candle'):
+            cls.collect_candle(sp, merge=merge, job=job, **kwargs)
+        with job.phase('investor'):
+            cls.collect_investor(sp, merge=merge, job=job, **kwargs)
         sp = cls.factory_provider(code, 'krx')
-        cls.collect_shortstock(sp, **kwargs)
+        with job.phase('short'):
+            cls.collect_shortstock(sp, merge=merge, job=job, **kwargs)
+        with job.phase('store'):
+            job.rows += cls.store_merge(code, merge)
+        calendar = TradeCalendar()
+        calendar.learn([k for k, v in merge.items.items() if 'end' in v],
+                       sequence=(code == calendar.reference))
+        with job.phase('sync'):
+            cls.sync_code(code)
+        return job
+
+    @classmethod
+    def is_current(cls, code, now=None):
+        '''
+        :return:    True if the code has the row of the last session of
+                    TradeCalendar with all of the late columns.
+        '''
+        calendar = TradeCalendar()
+        try:
+            with StockItemDB.reader(code) as sidb:
+                if not calendar.is_current(sidb.last_day(), now):
+                    return False
+                session = calendar.last_session(now)
+                return not [x for x in sidb.pending_days(*cls.LATE_COLNAMES)
+                            if x >= session]
+        except Exception:
+            # Not stored yet.
+            return False
+
+    @classmethod
+    def sync_code(cls, code):
+        '''
+        Move the old rows to the archive and update the columnar copy,
+        after the rows of the code are stored.
+        '''
+        with StockItemDB.checkout(code) as sidb, CodeLock().write(code):
+            if ColdArchive.is_enabled():
+                ColdArchive.factory(code).archive(sidb)
+            if ColumnStore.is_enabled():
+                ColumnStore.factory(code).sync(sidb)
+            RangeCache().invalidate(StockQuery.range_cachekey(sidb))
 
 
 class StockQuery:
+    STREAM_CHUNK = 500
+    BATCH_WORKERS = 4
+    BATCH_CODES = 50
+    MAX_POINTS = 2000
+    _batch_pool = None
+    _batch_lock = threading.Lock()
+
     class Error(Exception):
         pass
 
@@ -277,17 +1034,78 @@ class StockQuery:
             # print('  ', self.rows)
             return copy.deepcopy(self.rows)
 
+        def accumulate(self, fields):
+            '''
+            The columns of all fields at once, the prefix sums of the
+            accumulated columns and a pass on the amount column.
+            The rows are the same as update() of each field, the fields of
+            ExceptionEndOfData are skipped.
+            :return:    List of the rows.
+            '''
+            if not fields:
+                return []
+            columns = self.accumulate_columns(list(zip(*fields)))
+            return [list(x) for x in zip(*columns)]
+
+        def accumulate_columns(self, columns):
+            '''
+            accumulate() of the columns of the fields.
+            :param columns: List of the values of each column of colnames.
+            :return:        List of the accumulated columns.
+            '''
+            if not columns or not len(columns[0]):
+                return [[] for _ in self.val_ilist]
+            if self.rows:
+                raise StockQuery.Error('Accumulator Is Already Updated')
+            ilist = set(self.val_ilist)
+            selected = [c for i, c in enumerate(columns) if i in ilist]
+            # The first field is taken without the check of the end of data.
+            nones = [sum(x) for x in zip(*[[v is None for v in c]
+                                           for c in selected])]
+            valid = [0] + [k for k in range(1, len(nones)) if nones[k] < 2]
+            if len(valid) < len(nones):
+                selected = [[c[k] for k in valid] for c in selected]
+            aidx = self.amount_idx
+            outputs = []
+            for i, column in enumerate(selected):
+                if i == aidx:
+                    values = columns[self.val_ilist[aidx]]
+                    outputs.append(self._accumulate_amount(
+                        column, [values[k] for k in valid]))
+                elif i == 0 or i > aidx:
+                    outputs.append(list(column))
+                else:
+                    outputs.append(list(itertools.accumulate(column)))
+            return outputs
+
+        @classmethod
+        def _accumulate_amount(cls, column, values):
+            '''
+            :param column:  The amount column of the rows.
+            :param values:  The amount value of the fields of the rows.
+            '''
+            amount_value = column[0]
+            amount = None
+            outputs = [None]
+            for cur, value in zip(column[1:], values[1:]):
+                if cur:
+                    if amount:
+                        amount += cur - amount_value
+                    elif amount_value:
+                        amount = cur - amount_value
+                    else:
+                        amount = cur
+                    amount_value = value
+                else:
+                    amount = None
+                outputs.append(amount)
+            return outputs
+
     @classmethod
-    def raw_data(cls, sidb, **kwargs):
+    def to_query_range(cls, sidb, **kwargs):
         '''
-        :param colnames:    list of Column name
-        :param sdate:       Start date, default is current local time.
-                            Format is YYYY-MM-DD, YYYY.MM.DD or YYYYMMDD.
-        :param edate:       End date, default is current local time.
-                            Format is YYYY-MM-DD, YYYY.MM.DD or YYYYMMDD.
-        :param months:      The past duration time, unit is month.
-                            Default is 3 months.
-        :return:            List of list.
+        :return:    The colnames, the start day and the end day of
+                    the arguments of raw_data.
         '''
         start_date = kwargs.get('sdate', DateTool.to_strfdate())
         end_date = kwargs.get('edate', None)
@@ -305,26 +1123,264 @@ class StockQuery:
         colnames = kwargs.get('colnames', sidb.get_colnames(tablename))
         if not colnames:
             colnames = sidb.get_colnames(tablename)
-        columns = [Column(x) for x in colnames]
-        table = sidb.get_table(tablename)
-        sql = sqlalchemy.sql.select(columns).where(
-            and_(DateTool.to_strfdate(date_start) <= table.c.stamp,
-                 table.c.stamp <= DateTool.to_strfdate(date_end))).\
-            order_by(table.c.stamp.asc())
-        sqlquery = sidb.to_sql(sql)
+        return colnames, DateTool.to_day(date_start), \
+            DateTool.to_day(date_end)
+
+    @classmethod
+    def raw_data(cls, sidb, **kwargs):
+        '''
+        :param colnames:    list of Column name
+        :param sdate:       Start date, default is current local time.
+                            Format is YYYY-MM-DD, YYYY.MM.DD or YYYYMMDD.
+        :param edate:       End date, default is current local time.
+                            Format is YYYY-MM-DD, YYYY.MM.DD or YYYYMMDD.
+        :param months:      The past duration time, unit is month.
+                            Default is 3 months.
+        :param columnar:    Return ColumnData instead of QueryData.
+        :param timeframe:   The bars of 'week', 'month' or '<N>d' by
+                            StockResample, default is 'day'.
+        :return:            List of list.
+        '''
+        colnames, sday, eday = cls.to_query_range(sidb, **kwargs)
+        sqlquery = sidb.to_sql(cls._select_days(sidb, colnames, sday, eday))
+        columnar = kwargs.get('columnar', False)
+        timeframe = kwargs.get('timeframe', None) or 'day'
+        if timeframe != 'day':
+            cdata = cls.resample_data(sidb, colnames, sday, eday, timeframe)
+            cdata.sql = sqlquery
+            return cdata if columnar else cdata.to_query()
+
+        def load(loadnames, lsday, leday):
+            if sidb.code is None:
+                return cls._load_fields(sidb, loadnames, lsday, leday)
+            with CodeLock().read(sidb.code):
+                return cls._load_fields(sidb, loadnames, lsday, leday)
+
+        if sidb.code:
+            # The range and the columns of the code are sliced from the
+            # widest one loaded.
+            columns = RangeCache().get_columns(cls.range_cachekey(sidb),
+                                               colnames, sday, eday, load)
+            if columnar:
+                return ColumnData.from_columns(colnames, columns, sqlquery)
+            return QueryData(colnames=colnames, sql=sqlquery,
+                             fields=[list(x) for x in zip(*columns)])
 
         def gathering():
-            try:
-                fields = sidb.session.query(sql).all()
-            except Exception as e:
-                raise StockQuery.Error(f'{e}')
-            return QueryData(colnames=colnames,
-                             fields=[list(x) for x in fields], sql=sqlquery)
+            qdata = QueryData(colnames=colnames, sql=sqlquery,
+                              fields=load(colnames, sday, eday))
+            return ColumnData.from_query(qdata) if columnar else qdata
 
-        cachekey = sidb.db_file+':'+sqlquery
+        cachekey = f'{sidb.db_file}:{sday}:{sqlquery}'
+        if columnar:
+            return FCache().caching(cachekey+':columns', gathering,
+                                    duration=900, cast=ColumnData.cast)
         return FCache().caching(cachekey, gathering,
                                 duration=900, cast=QueryData.cast)
 
+    @classmethod
+    def resample_data(cls, sidb, colnames, sday, eday, timeframe):
+        '''
+        :return:    ColumnData of the bars of the timeframe, the bars of
+                    the code are cached by StockResample.
+        '''
+        def load(loadnames, lsday, leday):
+            return cls.raw_data(sidb, colnames=loadnames, sdate=str(lsday),
+                                edate=str(leday), columnar=True)
+
+        key = cls.range_cachekey(sidb) if sidb.code else None
+        try:
+            return StockResample().get(key, colnames, sday, eday, timeframe,
+                                       load)
+        except StockResample.Error as e:
+            raise cls.Error(f'{e}')
+
+    @classmethod
+    def downsample_data(cls, sidb, colnames, max_points, **kwargs):
+        '''
+        :param max_points:  Count of the rows at most, up to query.max_points.
+        :param downsample:  'lttb' or 'minmax' of ChartDownsample.
+        :return:            ColumnData of raw_data_of_each_colnames
+                            downsampled, the rows of the code are cached by
+                            ChartDownsample.
+        '''
+        limit = int(BillConfig().get_value('query.max_points',
+                                           cls.MAX_POINTS))
+        max_points = min(int(max_points), limit)
+        method = kwargs.pop('downsample', None) or ChartDownsample.LTTB
+        kwargs = {k: v for k, v in kwargs.items()
+                  if k not in ['colnames', 'max_points']}
+        colnames, sday, eday = cls.to_query_range(sidb, colnames=colnames,
+                                                  **kwargs)
+
+        def load():
+            return cls.raw_data_of_each_colnames(
+                sidb, colnames, **dict(kwargs, columnar=True))
+
+        key = None
+        if sidb.code:
+            timeframe = kwargs.get('timeframe', None) or 'day'
+            accmulator = bool(kwargs.get('accmulator', False))
+            key = f'{cls.range_cachekey(sidb)}:{sday}:{eday}:{timeframe}:' \
+                f'{accmulator}:{",".join(colnames)}'
+        try:
+            return ChartDownsample().get(key, max_points, method, load)
+        except ChartDownsample.Error as e:
+            raise cls.Error(f'{e}')
+
+    @classmethod
+    def range_cachekey(cls, sidb):
+        return f'{sidb.db_file}:{sidb.code}'
+
+    @classmethod
+    def invalidate(cls, sidb, since=None):
+        '''
+        The stored days of the code drop the cached rows, the downsampled
+        rows and the bars of it.
+        :param since:   The first stored day, the bars before it are kept.
+        '''
+        key = cls.range_cachekey(sidb)
+        RangeCache().invalidate(key)
+        ChartDownsample().invalidate(key)
+        StockResample().invalidate(key, since=since)
+
+    @classmethod
+    def _select_days(cls, sidb, colnames, sday, eday):
+        table = sidb.get_table('stock_day')
+        return sqlalchemy.sql.select([Column(x) for x in colnames]).where(
+            and_(table.c.day >= sday, table.c.day <= eday,
+                 *sidb.stock_day_filter(table))).\
+            order_by(table.c.day.asc())
+
+    @classmethod
+    def _load_fields(cls, sidb, colnames, sday, eday):
+        '''
+        :return:    List of list, the rows of the days from sday to eday.
+        '''
+        fields = []
+        # The years before 'until' are read from the cold archive.
+        archive = ColdArchive.factory(sidb.code) if sidb.code else None
+        until = archive.until() if archive else 0
+        hot_sday = max(sday, until)
+        if sday < until:
+            fields += archive.load(colnames, sday, min(eday, until-1))
+        if hot_sday > eday:
+            return fields
+        if sidb.code and ColumnStore.is_enabled() and \
+                ColumnStore.is_supported(colnames):
+            cstore = ColumnStore.factory(sidb.code)
+            if cstore.exists():
+                arrays = cstore.load(colnames, hot_sday, eday)
+                return fields + cstore.to_fields(colnames, arrays)
+        sql = cls._select_days(sidb, colnames, hot_sday, eday)
+        try:
+            fields += [list(x) for x in sidb.session.query(sql).all()]
+        except Exception as e:
+            raise StockQuery.Error(f'{e}')
+        return fields
+
+    @classmethod
+    def iter_raw_data(cls, sidb, **kwargs):
+        '''
+        The rows of raw_data_of_each_colnames in chunks, the archive is read
+        by the block of a year and the rows of SQLite by the cursor, so the
+        memory is of a chunk regardless of the range.
+        :param chunk:       Count of the rows of a chunk.
+        :param accmulator:  Accumulate the trading columns as
+                            raw_data_of_each_colnames.
+        :return:            Generator of list of list.
+        '''
+        colnames, sday, eday = cls.to_query_range(sidb, **kwargs)
+        size = int(kwargs.get('chunk', None) or cls.STREAM_CHUNK)
+        if (kwargs.get('timeframe', None) or 'day') != 'day' or \
+                kwargs.get('max_points', None):
+            # The bars and the downsampled rows are few, they are at once.
+            qdata = cls.raw_data_of_each_colnames(
+                sidb, colnames,
+                **{k: v for k, v in kwargs.items() if k != 'colnames'})
+            for i in range(0, len(qdata.fields), size):
+                yield qdata.fields[i:i+size]
+            return
+        tacc = cls.TradingAccumulator(colnames, colnames,
+                                      amount_colname='shortamount') \
+            if kwargs.get('accmulator', False) else None
+
+        def accumulate(fields):
+            if tacc is None:
+                return fields
+            rows = []
+            for field in fields:
+                try:
+                    rows.append(tacc.update(field))
+                except cls.ExceptionEndOfData:
+                    pass
+            return rows
+
+        archive = ColdArchive.factory(sidb.code) if sidb.code else None
+        until = archive.until() if archive else 0
+        for year in range(sday // 10000, min(eday, until-1) // 10000 + 1):
+            with CodeLock().read(sidb.code):
+                fields = archive.load(colnames, max(sday, year*10000+101),
+                                      min(eday, year*10000+1231, until-1))
+            for i in range(0, len(fields), size):
+                yield accumulate(fields[i:i+size])
+        if max(sday, until) > eday:
+            return
+        sql = cls._select_days(sidb, colnames, max(sday, until), eday)
+        result = sidb.session.execute(sql)
+        try:
+            while True:
+                fields = result.fetchmany(size)
+                if not fields:
+                    break
+                yield accumulate([list(x) for x in fields])
+        finally:
+            result.close()
+
+    @classmethod
+    def get_batch_pool(cls):
+        with cls._batch_lock:
+            if cls._batch_pool is None:
+                workers = int(BillConfig().get_value('query.batch_workers',
+                                                     cls.BATCH_WORKERS))
+                cls._batch_pool = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=workers)
+            return cls._batch_pool
+
+    @classmethod
+    def batch_raw_data(cls, codes, colnames, **kwargs):
+        '''
+        raw_data_of_each_colnames of the codes, the reads of the codes go in
+        parallel on the pool of query.batch_workers shared by the batches.
+        :param codes:   List of code, up to query.batch_codes.
+        :return:        OrderedDict of each code, 'success', 'message' and
+                        'value' of QueryData or ColumnData and 'stored',
+                        True if the code has the stored rows. The failure
+                        of a code does not fail the others.
+        '''
+        codes = list(collections.OrderedDict.fromkeys(codes))
+        limit = int(BillConfig().get_value('query.batch_codes',
+                                           cls.BATCH_CODES))
+        if len(codes) > limit:
+            raise cls.Error(f'Too Many Codes: {len(codes)} > {limit}')
+
+        def query(code):
+            stored = False
+            try:
+                with StockItemDB.reader(code) as sidb:
+                    stored = sidb.last_day() is not None
+                    data = cls.raw_data_of_each_colnames(
+                        sidb, colnames, **kwargs)
+            except Exception as e:
+                return {'success': False, 'message': f'{e}', 'value': None,
+                        'stored': stored}
+            return {'success': True, 'message': None, 'value': data,
+                    'stored': stored}
+
+        pool = cls.get_batch_pool()
+        futures = [(x, pool.submit(query, x)) for x in codes]
+        return collections.OrderedDict([(x, f.result()) for x, f in futures])
+
     @classmethod
     def raw_data_of_each_colnames(cls, sidb, colnames, **kwargs):
         '''
@@ -336,18 +1392,108 @@ class StockQuery:
         :param months (int):    The past duration time, unit is month.
                                 Default is 3 months.
         :param accmulator (bool): Return the data with operating to accmulate.
+        :param columnar (bool): Return ColumnData instead of QueryData.
+        :param timeframe (str): The bars of 'week', 'month' or '<N>d'.
+        :param max_points (int): Downsample the rows for the chart.
+        :param downsample (str): 'lttb' or 'minmax', default is 'lttb'.
         :return (list):         List of list.
         '''
+        if kwargs.get('max_points', None):
+            cdata = cls.downsample_data(sidb, colnames, **kwargs)
+            return cdata if kwargs.get('columnar', False) else \
+                cdata.to_query()
         qdata = cls.raw_data(sidb, colnames=colnames, **kwargs)
+        if kwargs.get('accmulator', False) and \
+                kwargs.get('columnar', False):
+            tacc = cls.TradingAccumulator(colnames, qdata.colnames,
+                                          amount_colname='shortamount')
+            columns = tacc.accumulate_columns(
+                [qdata.get_column(x) for x in qdata.colnames])
+            return ColumnData.from_columns(colnames, columns, qdata.sql)
         if kwargs.get('accmulator', False):
             tradedata = QueryData(colnames=colnames, sql=qdata.sql)
             tacc = cls.TradingAccumulator(
                             tradedata.colnames, qdata.colnames,
                             amount_colname='shortamount')
-            for field in qdata.fields:
-                try:
-                    tradedata.fields.append(tacc.update(field))
-                except StockQuery.ExceptionEndOfData:
-                    pass
+            tradedata.fields = tacc.accumulate(qdata.fields)
             return tradedata
         return qdata
+
+    @classmethod
+    def delta_data(cls, sidb, colnames, since, version=None, **kwargs):
+        '''
+        The rows changed after the version of the client, the rows from the
+        first day of the recent PATCH_ROWS rows to since are replied, the new
+        days and the patched late columns are in them.
+        :param since:   The stamp of the last row of the client.
+        :param version: The version of get_version replied to the client.
+        :return:        (data, version, reset, start), data is the rows of
+                        raw_data_of_each_colnames to patch in place,
+                        all rows of the range if reset is True. start is
+                        the stamp of the first day of the range, the rows
+                        of the client before it are out of the range.
+        '''
+        current = sidb.get_version()
+        names, sday, _ = cls.to_query_range(sidb, colnames=colnames,
+                                            **kwargs)
+        start = DateTool.to_stamp(sday)
+        if version == current:
+            cdata = ColumnData.from_columns(names, [[] for _ in names])
+            return (cdata if kwargs.get('columnar', False) else
+                    cdata.to_query()), current, False, start
+        data = cls.raw_data_of_each_colnames(sidb, colnames, **kwargs)
+        pday = sidb.patch_day(since)
+        # The downsampled rows are selected by the whole rows and the
+        # accumulated rows are summed from the first row of the range.
+        if str(version).split('.')[0] != current.split('.')[0] or \
+                pday is None or kwargs.get('max_points', None) or \
+                kwargs.get('accmulator', False) or \
+                'stamp' not in data.colnames:
+            return data, current, True, start
+        if isinstance(data, ColumnData):
+            index = [i for i, x in enumerate(data.columns['stamp'].tolist())
+                     if DateTool.to_day(x) >= pday]
+            return data.take(numpy.array(index, dtype='i8')), current, \
+                False, start
+        pos = data.colnames.index('stamp')
+        fields = [x for x in data.fields if DateTool.to_day(x[pos]) >= pday]
+        return QueryData(colnames=data.colnames, fields=fields,
+                         sql=data.sql), current, False, start
+
+    @classmethod
+    def cross_section(cls, mdb, stamp, **kwargs):
+        '''
+        :param mdb:         StockMultiDB, the consolidated store.
+        :param stamp:       Date of a trading day.
+                            Format is YYYY-MM-DD, YYYY.MM.DD or YYYYMMDD.
+        :param colnames:    list of Column name, 'code' is the first column.
+        :param filters:     list of (colname, operator, value),
+                            operator is one of <, <=, ==, >=, >.
+        :return:            QueryData, a row per code.
+        '''
+        _op = {
+            '<': lambda c, v: c < v,
+            '<=': lambda c, v: c <= v,
+            '==': lambda c, v: c == v,
+            '>=': lambda c, v: c >= v,
+            '>': lambda c, v: c > v,
+        }
+        if not isinstance(mdb, StockMultiDB):
+            raise cls.Error('Need The Consolidated Store(StockMultiDB)')
+        tablename = 'stock_day'
+        table = mdb.get_table(tablename)
+        colnames = kwargs.get('colnames', None) or mdb.get_colnames(tablename)
+        colnames = ['code'] + [x for x in colnames if x != 'code']
+        wheres = [table.c.day == DateTool.to_day(stamp)]
+        for colname, op, value in kwargs.get('filters', []):
+            if op not in _op:
+                raise cls.Error(f'Unknown Operator: {op}')
+            wheres.append(_op[op](table.c[colname], value))
+        sql = sqlalchemy.sql.select([table.c[x] for x in colnames]).\
+            where(and_(*wheres)).order_by(table.c.code.asc())
+        try:
+            fields = mdb.session.query(sql).all()
+        except Exception as e:
+            raise StockQuery.Error(f'{e}')
+        return QueryData(colnames=colnames,
+                         fields=[list(x) for x in fields], sql=mdb.to_sql(sql))
@@ -98,6 +98,30 @@ class DateTool:
             return date.strftime(format)
         raise cls.Error('Unknown object: {}'.format(date.__class__.__name__))
 
+    @classmethod
+    def to_day(cls, date):
+        '''
+        :param date:        Object of date, an integer day or a string of date.
+                            Forms are YYYY.MM.DD, YYYY/MM/DD, YYYY-MM-DD,
+                            YYYYMMDD ...
+        :return:            Integer day, YYYYMMDD.
+        '''
+        if isinstance(date, int):
+            return date
+        if isinstance(date, datetime.date):
+            return date.year*10000 + date.month*100 + date.day
+        if len(date) == 10 and date[4] == date[7] and date[4] in '.-/':
+            return int(date[:4])*10000 + int(date[5:7])*100 + int(date[8:])
+        return cls.to_day(cls.to_datetime(date))
+
+    @classmethod
+    def to_stamp(cls, day):
+        '''
+        :param day:         Integer day, YYYYMMDD.
+        :return:            String of date stored in stamp, YYYY-MM-DD.
+        '''
+        return f'{day//10000:04d}-{day//100%100:02d}-{day%100:02d}'
+
 
 class Helper:
     class LineParser:
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+import threading
+from contextlib import contextmanager
+
+from pysp.sbasic import SSingleton
+from pysp.serror import SCDebug
+
+
+class RWLock:
+    '''
+    The readers share it and a writer holds it alone.
+    A waiting writer blocks the new readers, so it is not starved.
+    '''
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class CodeLock(SCDebug, metaclass=SSingleton):
+    '''
+    RWLock of each code, the readers of a code go on while the other codes
+    are written. The rows of SQLite need not it, a read transaction of WAL
+    sees the last committed snapshot. It guards the files rewritten in
+    place, the archive and the columnar copy of a code.
+    '''
+    def __init__(self):
+        self._locks = {}
+        self.lock = threading.Lock()
+
+    def get(self, code):
+        with self.lock:
+            if code not in self._locks:
+                self._locks[code] = RWLock()
+            return self._locks[code]
+
+    def read(self, code):
+        return self.get(code).read()
+
+    def write(self, code):
+        return self.get(code).write()
@@ -2,7 +2,8 @@
 
 import atexit
 import datetime
-import glob
+import heapq
+import itertools
 import os
 import time
 import queue
@@ -14,7 +15,11 @@ from pysp.sbasic import SSingleton
 from pysp.serror import SCDebug
 
 from core.config import BillConfig
-from core.finance import DataCollection
+from core.finance import DataCollection, StockItemDB
+from core.helper import DateTool
+from core.metrics import CollectMetrics
+from core.pipeline import CollectPipeline
+from core.tradeday import TradeCalendar
 
 
 @atexit.register
@@ -27,7 +32,6 @@ class Manager(SCDebug):
 
     def __init__(self, *args, **kwargs):
         super(Manager, self).__init__()
-        self.lock = threading.Lock()
 
 
 class _State(SCDebug):
@@ -36,8 +40,8 @@ class _State(SCDebug):
     def __init__(self):
         super(_State, self).__init__()
         self.loop = True
-        self.wcode = []
-        self.dprint(f'------------------- {id(self)} {id(self.wcode)}')
+        self.wcodes = set()
+        self.lock = threading.Lock()
 
     def quit(self):
         self.loop = False
@@ -45,13 +49,121 @@ class _State(SCDebug):
     def is_run(self):
         return self.loop
 
-    def set_work_code(self, code=None):
-        self.dprint(f'###########B {id(self.wcode)} {self.wcode}=[{code}]')
-        if self.wcode:
-            self.wcode.pop()
-        if code:
-            self.wcode.append(code)
-        self.dprint(f'###########A {id(self.wcode)} {self.wcode}=[{code}]')
+    def begin_work(self, code):
+        '''
+        :return:    False if the code is already in-flight on other worker.
+        '''
+        with self.lock:
+            if code in self.wcodes:
+                return False
+            self.wcodes.add(code)
+            self.dprint(f'BEGIN {code} {self.wcodes}')
+            return True
+
+    def end_work(self, code):
+        with self.lock:
+            self.wcodes.discard(code)
+            self.dprint(f'END {code} {self.wcodes}')
+
+    def is_working(self, code):
+        with self.lock:
+            return code in self.wcodes
+
+    def get_working(self):
+        with self.lock:
+            return sorted(self.wcodes)
+
+
+class _PriorityQueue(SCDebug):
+    '''
+    The codes in order of (priority, order, pushed), a lower value is
+    served first. A code is queued once, kept in the dict of the entries,
+    and a push of a higher priority promotes it. The entry of the promoted
+    code is left in the heap without the code and skipped by get().
+    '''
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition(threading.Lock())
+        self._closed = False
+
+    def __contains__(self, code):
+        with self._cond:
+            return code in self._entries
+
+    def __len__(self):
+        with self._cond:
+            return len(self._entries)
+
+    def put(self, code, priority, order=0):
+        '''
+        :param order:   The order in the same priority.
+        :return:        True if it is queued or promoted.
+        '''
+        with self._cond:
+            if self._closed:
+                return False
+            entry = self._entries.get(code, None)
+            if entry is not None:
+                if entry[0] <= priority:
+                    return False
+                entry[-1] = None
+            entry = [priority, order, next(self._seq), code]
+            self._entries[code] = entry
+            heapq.heappush(self._heap, entry)
+            self._cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        '''
+        :return:    The code of the highest priority, queue.Empty is raised
+                    at the timeout or if it is closed.
+        '''
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][-1] is None:
+                    heapq.heappop(self._heap)
+                if self._closed:
+                    raise queue.Empty
+                if self._heap:
+                    break
+                wait = None if deadline is None else deadline - time.time()
+                if (wait is not None and wait <= 0) or \
+                        not self._cond.wait(wait):
+                    raise queue.Empty
+            code = heapq.heappop(self._heap)[-1]
+            del self._entries[code]
+            return code
+
+    def clear(self):
+        with self._cond:
+            self._heap = []
+            self._entries = {}
+
+    def close(self):
+        '''
+        The queued codes are dropped and the waiters of get() are woken.
+        '''
+        with self._cond:
+            self._closed = True
+            self._heap = []
+            self._entries = {}
+            self._cond.notify_all()
+
+    def is_closed(self):
+        return self._closed
+
+    def depth(self):
+        '''
+        :return:    Dict of the count of the queued codes by priority.
+        '''
+        with self._cond:
+            depth = {}
+            for entry in self._entries.values():
+                depth[entry[0]] = depth.get(entry[0], 0) + 1
+            return depth
 
 
 class _Scheduler(SCDebug):
@@ -77,14 +189,19 @@ class _Scheduler(SCDebug):
 
     @classmethod
     def next_collect(cls, now=None):
+        '''
+        :return:    Event of the next trading day of TradeCalendar.
+        '''
         if now is None:
             now = datetime.datetime.now()
         next = datetime.datetime(now.year, now.month, now.day,
                                  cls.collect_hour, cls.collect_min)
-        if (next.timestamp() - now.timestamp()) > 0:
-            return cls.Event(cls.EVENT_COLLECT, next.timestamp())
-
-        next = next + relativedelta(days=1)
+        calendar = TradeCalendar()
+        if (next.timestamp() - now.timestamp()) <= 0 or \
+                not calendar.is_trading_day(next.date()):
+            day = calendar.next_trading_day(next.date())
+            next = datetime.datetime.combine(calendar.to_date(day),
+                                             next.time())
         return cls.Event(cls.EVENT_COLLECT, next.timestamp())
 
     @classmethod
@@ -97,67 +214,144 @@ class _Scheduler(SCDebug):
 
 
 class Collector(Manager, metaclass=SSingleton):
+    '''
+    The codes are collected by the pool of collect.workers threads.
+    The work is waiting for the network mostly, so the threads share the
+    singletons of the process, the cache, the handles of StockItemDB and
+    the semaphores per host of Http, which limit the concurrent requests.
+    A code is collected by one worker at a time.
+    The queue is served by priority, a code requested by a user is ahead
+    of the codes of the nightly refresh, which go from the stalest one.
+    '''
     DEBUG = True
     INIT_NO_COLLECT = "NO_COLLECT"
     CMD_QUIT = 'quit'
     QUEUE_SIZE = 1000
     QUEUE_TIMEOUT_SEC = 5
+    WORKERS = 4
+    PRIORITY_HIGH = 0
+    PRIORITY_STALE = 1
+    PRIORITY_LOW = 2
+    PRIORITY_NAMES = {
+        PRIORITY_HIGH:  'high',
+        PRIORITY_STALE: 'stale',
+        PRIORITY_LOW:   'low',
+    }
+    # The refreshed code of the last day older than it is stale.
+    STALE_DAYS = 7
+    # The stored days of tradeday.reference learned by TradeCalendar.
+    CALENDAR_DAYS = 365
     # class
     # State = _State
     Scheduler = _Scheduler
 
     def __init__(self, *args, **kwargs):
         super(Collector, self).__init__(*args, **kwargs)
-        self.stock_folder = BillConfig().get_value('_config.db.stock_folder')
-        self._q = queue.Queue()
+        self._q = _PriorityQueue()
+        self._queued = {}
         self.state = _State()
-        self._thread = threading.Thread(target=self.worker)
-        self._thread.start()
+        self.event = self.Scheduler.next()
+        self._event_lock = threading.Lock()
+        workers = int(BillConfig().get_value('collect.workers', self.WORKERS))
+        self._threads = [threading.Thread(target=self.worker,
+                                          name=f'Collector-{i}')
+                         for i in range(max(1, workers))]
+        for thread in self._threads:
+            thread.start()
+        self.learn_calendar()
         if self.INIT_NO_COLLECT not in args:
             if 'DEBUG_PYTHON' not in os.environ:
                 self.collect(None)
 
-    def push(self, code):
-        if self.is_exist(code) is False:
-            if code == self.CMD_QUIT:
-                with self._q.mutex:
-                    self._q.queue.clear()
-            self.dprint(f'PUT: {code}')
-            self._q.put(code)
+    def push(self, code, priority=PRIORITY_HIGH, order=0):
+        if code == self.CMD_QUIT:
+            self._q.close()
+            return
+        # An in-flight code is not queued again, it is being collected.
+        if self.state.is_working(code) is False and \
+                self._q.put(code, priority, order):
+            # The wait is from the first push, a promotion keeps it.
+            self._queued.setdefault(code, time.time())
+            self.dprint(f'PUT: {code} {self.PRIORITY_NAMES[priority]}')
 
     def pop(self):
         return self._q.get(timeout=self.QUEUE_TIMEOUT_SEC)
 
     def is_exist(self, code):
-        return True if code in self._q.queue else False
-
-    def collect(self, code):
+        return code in self._q
+
+    def get_depth(self):
+        '''
+        :return:    Dict of the count of the queued codes by priority name.
+        '''
+        depth = self._q.depth()
+        return {v: depth.get(k, 0) for k, v in self.PRIORITY_NAMES.items()}
+
+    def learn_calendar(self):
+        calendar = TradeCalendar()
+        sday = datetime.date.today() - \
+            datetime.timedelta(days=self.CALENDAR_DAYS)
+        try:
+            with StockItemDB.reader(calendar.reference) as sidb:
+                calendar.learn(sidb.days_since(sday), sequence=True)
+        except Exception as e:
+            self.dprint(f'Not Learned Days of {calendar.reference}: {e}')
+
+    def refresh(self):
+        '''
+        Queue the stored codes which miss the last session of TradeCalendar
+        or the late columns of it, the stale codes ahead of the others and
+        each of them in order of the last stored day.
+        '''
+        calendar = TradeCalendar()
+        stale = DateTool.to_day(datetime.date.today() -
+                                datetime.timedelta(days=self.STALE_DAYS))
+        for code, day in StockItemDB.last_days().items():
+            # The late columns of the last session are collected again.
+            if calendar.is_current(day) and DataCollection.is_current(code):
+                continue
+            day = day or 0
+            priority = self.PRIORITY_STALE if day < stale else \
+                self.PRIORITY_LOW
+            self.push(code, priority, day)
+
+    def collect(self, code, priority=PRIORITY_HIGH):
+        '''
+        :param code:    The code to collect, all stored codes if it is None.
+        '''
         if code is None:
-            for file in glob.glob(self.stock_folder+'/*.sqlite3'):
-                code = os.path.basename(file).split('.')[0]
-                self.push(code)
+            self.refresh()
             return
-        self.push(code)
+        self.push(code, priority)
 
-    def quit(self):
+    def quit(self, timeout=None):
+        '''
+        The queued codes are dropped, the in-flight codes stop at the next
+        page and the workers are joined.
+        '''
         self.state.quit()
         self.collect(self.CMD_QUIT)
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout)
 
     def is_working(self, code):
-        # return self.state.is_working(code)
-        self.dprint(f'### {id(self.state.wcode)} {self.state.wcode} {code}')
-        if self.state.wcode and self.state.wcode[0] == code:
-            return True
-        return False
+        return self.state.is_working(code)
 
     def _do_event_collect(self):
+        if not TradeCalendar().is_trading_day(datetime.date.today()):
+            self.iprint('Skip Collect, Not Trading Day')
+            return
         self.collect(None)
 
     def _do_event_hour(self):
         self.iprint(f'EVENT HOUR {datetime.datetime.now()} {id(self)}')
 
     def _worker_event(self):
-        if self.event.stamp < time.time():
+        # Every worker passes here, the first one takes the event.
+        with self._event_lock:
+            if self.event.stamp >= time.time():
+                return
             event = self.Scheduler.next()
             self.iprint(f'EVENT@{self.event.event}')
             if self.event.event == self.Scheduler.EVENT_COLLECT:
@@ -166,24 +360,43 @@ class Collector(Manager, metaclass=SSingleton):
                 self._do_event_hour()
             self.event = event
 
+    def get_metrics(self, limit=10):
+        '''
+        :return:    Dict of the metrics of CollectMetrics, the queue depth,
+                    the working codes and the stats of CollectPipeline.
+        '''
+        metrics = CollectMetrics().get_summary(limit=limit)
+        metrics['depth'] = self.get_depth()
+        metrics['working'] = self.state.get_working()
+        metrics['pipeline'] = CollectPipeline.get_stats()
+        return metrics
+
     def _worker_item(self, item):
-        if item:
-            self.state.set_work_code(item)
-            DataCollection.collect(item, wstate=self.state)
-            self.state.set_work_code()
+        if item and self.state.begin_work(item):
+            metrics = CollectMetrics()
+            job = metrics.begin(item, queued=self._queued.pop(item, None))
+            error = None
+            try:
+                DataCollection.collect(item, wstate=self.state, job=job)
+            except Exception as e:
+                # The worker goes on to the next code.
+                self.eprint(f'Failed To Collect {item}: {e}')
+                error = e
+            finally:
+                metrics.end(job, error=error)
+                self.state.end_work(item)
+        elif item:
+            self._queued.pop(item, None)
 
     def worker(self, *args):
         self.dprint("<Collector::worker(begin)>")
-        self.event = self.Scheduler.next()
         while self.state.is_run():
             try:
                 item = self.pop()
                 self.dprint(f'GET: "{item}"')
             except queue.Empty:
                 item = ''
-            if self.is_exist(self.CMD_QUIT) or \
-                    self.state.is_run() is False or \
-                    item == self.CMD_QUIT:
+            if self._q.is_closed() or self.state.is_run() is False:
                 break
 
             self._worker_item(item)
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import threading
+import time
+from contextlib import contextmanager
+
+from pysp.sbasic import SSingleton
+from pysp.serror import SCDebug
+
+
+class CollectJob:
+    '''
+    The metrics of a collect of a code, it is passed to DataCollection.collect
+    as job and the phases of it are timed.
+    '''
+    def __init__(self, code, queued=None):
+        '''
+        :param queued:  The time pushed into the queue of Collector.
+        '''
+        self.code = code
+        self.start = time.time()
+        self.wait = self.start - queued if queued else 0.0
+        self.phases = collections.OrderedDict()
+        self.pages = 0
+        self.rows = 0
+        self.error = None
+        self.skipped = False
+        self.end = None
+
+    @contextmanager
+    def phase(self, name):
+        stamp = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + \
+                time.time() - stamp
+
+    def get_seconds(self):
+        return (self.end or time.time()) - self.start
+
+    def to_dict(self):
+        return {
+            'code':     self.code,
+            'start':    round(self.start, 3),
+            'wait':     round(self.wait, 3),
+            'seconds':  round(self.get_seconds(), 3),
+            'phases':   {k: round(v, 3) for k, v in self.phases.items()},
+            'pages':    self.pages,
+            'rows':     self.rows,
+            'error':    self.error,
+            'skipped':  self.skipped,
+        }
+
+
+class CollectMetrics(SCDebug, metaclass=SSingleton):
+    '''
+    The metrics of the finished jobs of Collector, the recent jobs, the
+    last result of each code and the rolling throughput of WINDOW_SECONDS.
+    '''
+    RECENT_JOBS = 100
+    WINDOW_SECONDS = 600
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = collections.deque(maxlen=self.RECENT_JOBS)
+        self.window = collections.deque()
+        self.codes = {}
+        self.totals = {'jobs': 0, 'failed': 0, 'skipped': 0, 'pages': 0,
+                       'rows': 0}
+
+    def begin(self, code, queued=None):
+        return CollectJob(code, queued)
+
+    def end(self, job, error=None):
+        '''
+        :param error:   The exception of the failed job.
+        '''
+        job.end = time.time()
+        if error is not None:
+            job.error = str(error) or error.__class__.__name__
+        with self.lock:
+            self.jobs.append(job)
+            self.window.append(job)
+            self._expire(job.end)
+            self.totals['jobs'] += 1
+            self.totals['failed'] += 1 if job.error else 0
+            self.totals['skipped'] += 1 if job.skipped else 0
+            self.totals['pages'] += job.pages
+            self.totals['rows'] += job.rows
+            item = self.codes.setdefault(job.code, {
+                'code': job.code, 'last_success': None, 'last_error': None,
+                'error': None, 'seconds': 0.0, 'runs': 0, 'failures': 0})
+            item['runs'] += 1
+            if not job.skipped:
+                item['seconds'] = round(job.get_seconds(), 3)
+            if job.error:
+                item['failures'] += 1
+                item['last_error'] = job.end
+                item['error'] = job.error
+            else:
+                item['last_success'] = job.end
+                item['error'] = None
+
+    def _expire(self, now):
+        while self.window and self.window[0].end < now - self.WINDOW_SECONDS:
+            self.window.popleft()
+
+    def get_gauge(self):
+        '''
+        :return:    Dict of the throughput of the jobs ended in the window.
+        '''
+        with self.lock:
+            now = time.time()
+            self._expire(now)
+            jobs = list(self.window)
+        seconds = float(self.WINDOW_SECONDS)
+        return {
+            'seconds':      self.WINDOW_SECONDS,
+            'jobs':         len(jobs),
+            'failed':       len([x for x in jobs if x.error]),
+            'jobs_min':     round(len(jobs)*60/seconds, 2),
+            'pages_sec':    round(sum([x.pages for x in jobs])/seconds, 2),
+            'rows_sec':     round(sum([x.rows for x in jobs])/seconds, 2),
+            'wait_avg':     round(sum([x.wait for x in jobs])/len(jobs), 3)
+            if jobs else 0.0,
+        }
+
+    def get_code(self, code):
+        with self.lock:
+            item = self.codes.get(code, None)
+            return None if item is None else dict(item)
+
+    def get_summary(self, limit=10):
+        '''
+        :return:    Dict of the totals, the gauge, the slowest codes,
+                    the failing codes and the recent jobs.
+        '''
+        gauge = self.get_gauge()
+        with self.lock:
+            codes = [dict(x) for x in self.codes.values()]
+            recent = [x.to_dict() for x in reversed(self.jobs)][:limit]
+            totals = dict(self.totals)
+        slowest = sorted(codes, key=lambda x: -x['seconds'])[:limit]
+        failing = sorted([x for x in codes if x['error']],
+                         key=lambda x: -x['last_error'])[:limit]
+        return {'totals': totals, 'gauge': gauge, 'slowest': slowest,
+                'failing': failing, 'recent': recent}
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import glob
+import os
+import sqlalchemy
+
+from pysp.serror import SCDebug
+
+from core.config import BillConfig
+from core.finance import StockItemDB, StockMultiDB
+
+
+class StockMigrate(SCDebug):
+    '''
+    Migrate stock_day of the per-code files, <folder.stock>/<code>.sqlite3,
+    to the integer day keys or into the consolidated store.
+    '''
+    DEBUG = True
+    CHUNK_SIZE = 5000
+
+    class Error(Exception):
+        pass
+
+    @classmethod
+    def get_code_files(cls, codes=None):
+        folder = BillConfig().get_value('_config.db.stock_folder')
+        files = {}
+        for file in glob.glob(folder+'/*.sqlite3'):
+            code = os.path.basename(file).split('.')[0]
+            if codes is None or code in codes:
+                files[code] = file
+        return files
+
+    @classmethod
+    def read_rows(cls, db_file):
+        db_config = BillConfig().get_value('_config.db.stock_yml')
+        sidb = StockItemDB(db_file=db_file, db_config=db_config)
+        table = sidb.get_table('stock_day')
+        colnames = [x.name for x in table.c]
+        sql = sqlalchemy.sql.select([table]).order_by(table.c.stamp.asc())
+        result = sidb.session.execute(sql)
+        while True:
+            rows = result.fetchmany(cls.CHUNK_SIZE)
+            if not rows:
+                break
+            yield [dict(zip(colnames, x)) for x in rows]
+        sidb.session.close()
+
+    @classmethod
+    def to_day_keys(cls, codes=None):
+        '''
+        Fill the integer day of the files ahead of their first use,
+        StockItemDB migrates a file when it is opened.
+        :return:        Dict, the count of the rows keyed by day of each code.
+        '''
+        db_config = BillConfig().get_value('_config.db.stock_yml')
+        files = cls.get_code_files(codes)
+        report = {}
+        for i, code in enumerate(sorted(files.keys())):
+            sidb = StockItemDB(db_file=files[code], db_config=db_config)
+            sql = 'SELECT count(day) FROM stock_day'
+            report[code] = sidb.session.execute(sql).scalar()
+            sidb.session.close()
+            cls.iprint(f'[{i+1}/{len(files)}] {code}: {report[code]} rows')
+        if BillConfig().get_value('_config.db.stock_backend') == 'multi':
+            StockMultiDB.factory(None)
+        return report
+
+    @classmethod
+    def to_multi(cls, codes=None):
+        '''
+        :param codes:   List of code to migrate, default is all of the files.
+        :return:        Dict, the count of migrated rows of each code.
+        '''
+        files = cls.get_code_files(codes)
+        if codes is not None:
+            missed = [x for x in codes if x not in files]
+            if missed:
+                raise cls.Error(f'Not Exist Code Files: {missed}')
+        report = {}
+        for i, code in enumerate(sorted(files.keys())):
+            mdb = StockMultiDB.factory(code)
+            count = 0
+            for rows in cls.read_rows(files[code]):
+                count += mdb.import_rows(code, rows)
+            report[code] = count
+            cls.iprint(f'[{i+1}/{len(files)}] {code}: {count} rows')
+        return report
+
+
+if __name__ == '__main__':
+    import sys
+
+    def usage():
+        '''
+    Usage: migrate <multi|day> [<code> ...]
+        multi   Copy the per-code files to the consolidated store.
+        day     Fill the integer day keys of the stores.
+        All codes in the stock folder if no code is given.
+        '''
+        print(usage.__doc__)
+        exit(-1)
+
+    commands = {
+        'multi':    StockMigrate.to_multi,
+        'day':      StockMigrate.to_day_keys,
+    }
+    if len(sys.argv) < 2 or sys.argv[1] not in commands:
+        usage()
+
+    codes = sys.argv[2:] if len(sys.argv) > 2 else None
+    commands[sys.argv[1]](codes)
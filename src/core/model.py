@@ -1,5 +1,8 @@
 # -*- coding: utf-8 -*-
 
+import numpy
+
+
 class Dict(dict):
 
     def __getattr__(self, name):
@@ -100,3 +103,102 @@ class QueryData(DictHelper):
         self['colnames'] = kwargs.get('colnames', [])
         self['fields'] = kwargs.get('fields', [])
         self['sql'] = kwargs.get('sql', None)
+
+
+class ColumnData(DictHelper):
+    '''
+    The columnar QueryData, a typed array of each column in columns.
+    The integer column is 'i8' of NULL_INT for None, the float column is
+    'f8' of NaN for None and the others are the arrays of numpy as they are.
+    fields is the row view of QueryData.
+    '''
+    LAYOUT = 'columns'
+    NULL_INT = numpy.iinfo('i8').min
+
+    def __init__(self, **kwargs):
+        super(ColumnData, self).__init__()
+        self['colnames'] = kwargs.get('colnames', [])
+        self['columns'] = kwargs.get('columns', {})
+        self['sql'] = kwargs.get('sql', None)
+
+    @classmethod
+    def to_array(cls, values):
+        kinds = set([type(x) for x in values if x is not None])
+        if kinds <= {int}:
+            return numpy.array([cls.NULL_INT if x is None else x
+                                for x in values], dtype='i8')
+        if kinds <= {int, float}:
+            return numpy.array([numpy.nan if x is None else x
+                                for x in values], dtype='f8')
+        return numpy.array(values)
+
+    @classmethod
+    def to_list(cls, array):
+        if array.dtype.kind == 'i':
+            null = cls.NULL_INT
+            return [None if x == null else x for x in array.tolist()]
+        if array.dtype.kind == 'f':
+            return [None if x != x else x for x in array.tolist()]
+        return array.tolist()
+
+    @classmethod
+    def from_columns(cls, colnames, columns, sql=None):
+        '''
+        :param columns: List of the values of each column of colnames.
+        '''
+        return cls(colnames=list(colnames), sql=sql,
+                   columns={k: cls.to_array(v)
+                            for k, v in zip(colnames, columns)})
+
+    @classmethod
+    def from_query(cls, qdata):
+        columns = list(zip(*qdata.fields)) if qdata.fields else \
+            [[] for _ in qdata.colnames]
+        return cls.from_columns(qdata.colnames, columns, qdata.sql)
+
+    @classmethod
+    def cast(cls, data):
+        if type(data) is cls:
+            return data
+        if isinstance(data, dict) and data.get('layout') == cls.LAYOUT:
+            return cls.from_columns(data['colnames'], data['columns'],
+                                    data.get('sql', None))
+        raise cls.Error('Not Supported CAST')
+
+    def get_count(self):
+        if not self.colnames:
+            return 0
+        return len(self.columns[self.colnames[0]])
+
+    def get_column(self, colname):
+        '''
+        :return:    List of the values of the column, None for the null.
+        '''
+        return self.to_list(self.columns[colname])
+
+    def take(self, index):
+        '''
+        :param index:   Array of the index of the rows.
+        :return:        ColumnData of the rows.
+        '''
+        return ColumnData(colnames=list(self.colnames), sql=self.sql,
+                          columns={k: v[index]
+                                   for k, v in self.columns.items()})
+
+    @property
+    def fields(self):
+        return [list(x) for x in
+                zip(*[self.get_column(x) for x in self.colnames])]
+
+    def to_query(self):
+        return QueryData(colnames=list(self.colnames), fields=self.fields,
+                         sql=self.sql)
+
+    def to_dict(self):
+        '''
+        :return:    The columnar layout of JSON, a list of each column in
+                    order of colnames.
+        '''
+        return {'layout': self.LAYOUT, 'colnames': list(self.colnames),
+                'count': self.get_count(), 'sql': self.sql,
+                'columns': [self.get_column(x) for x in self.colnames]}
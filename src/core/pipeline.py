@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import concurrent.futures
+import multiprocessing
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+from pysp.serror import SCDebug
+
+from core.config import BillConfig
+
+
+def _parse_page(parse, raw):
+    '''
+    It runs on the process of the parse stage,
+    the rows go back as dict to be picklable.
+    '''
+    return [dict(x) for x in parse(raw)]
+
+
+class CollectPipeline(SCDebug):
+    '''
+    The pages of a stream are collected by the stages,
+
+        fetch (threads) -> parse (processes) -> store (one writer)
+
+    The pool of the fetch threads and the pool of the parse processes are
+    shared by all pipelines, the pages are parsed on the fetch threads if
+    collect.parse_workers is 0 or the pool is broken, e.g. under uWSGI.
+    The pages in flight ahead of the writer are bounded by the window, it
+    is doubled while the pages have new rows up to collect.window. When
+    store() stops at a page of the rows already stored, the pending pages
+    are cancelled and no more page is fetched.
+    '''
+    FETCH_WORKERS = 8
+    PARSE_WORKERS = 0
+    WINDOW = 8
+
+    _pools = {}
+    _pools_lock = threading.Lock()
+    _stats = collections.OrderedDict([
+        ('fetch', {'pages': 0, 'seconds': 0.0}),
+        ('parse', {'pages': 0, 'seconds': 0.0}),
+        ('store', {'pages': 0, 'seconds': 0.0}),
+        ('cancel', {'pages': 0, 'seconds': 0.0}),
+    ])
+    _stats_lock = threading.Lock()
+
+    class Error(Exception):
+        pass
+
+    def __init__(self, **kwargs):
+        '''
+        :param wstate:  The state of Collector, the pipeline stops if it is
+                        not running.
+        '''
+        self.wstate = kwargs.get('wstate', None)
+        self.fetched = 0
+        self.window = int(BillConfig().get_value('collect.window',
+                                                 self.WINDOW))
+
+    @classmethod
+    def get_pool(cls, stage):
+        with cls._pools_lock:
+            if stage not in cls._pools:
+                bcfg = BillConfig()
+                if stage == 'fetch':
+                    workers = int(bcfg.get_value('collect.fetch_workers',
+                                                 cls.FETCH_WORKERS))
+                    cls._pools[stage] = concurrent.futures.ThreadPoolExecutor(
+                        max_workers=workers)
+                else:
+                    workers = int(bcfg.get_value('collect.parse_workers',
+                                                 cls.PARSE_WORKERS))
+                    # The process is spawned, not forked from the threads.
+                    cls._pools[stage] = None if workers <= 0 else \
+                        concurrent.futures.ProcessPoolExecutor(
+                            max_workers=workers,
+                            mp_context=multiprocessing.get_context('spawn'))
+            return cls._pools[stage]
+
+    @classmethod
+    def shutdown(cls):
+        with cls._pools_lock:
+            for pool in cls._pools.values():
+                if pool:
+                    pool.shutdown(wait=False)
+            cls._pools = {}
+
+    @classmethod
+    def _drop_pool(cls, stage, pool):
+        '''
+        The broken pool is not used again, the stage runs inline.
+        '''
+        with cls._pools_lock:
+            if cls._pools.get(stage) is pool:
+                cls._pools[stage] = None
+        pool.shutdown(wait=False)
+
+    @classmethod
+    def _count(cls, stage, stamp, pages=1):
+        with cls._stats_lock:
+            cls._stats[stage]['pages'] += pages
+            cls._stats[stage]['seconds'] += time.time() - stamp
+
+    @classmethod
+    def get_stats(cls):
+        '''
+        :return:    Dict of the stages, the pages, the busy seconds and
+                    the pages per busy second.
+        '''
+        with cls._stats_lock:
+            stats = collections.OrderedDict()
+            for stage, stat in cls._stats.items():
+                seconds = stat['seconds']
+                stats[stage] = dict(stat, rate=round(
+                    stat['pages']/seconds, 2) if seconds else 0.0)
+            return stats
+
+    def is_run(self):
+        return self.wstate is None or self.wstate.is_run()
+
+    def _fetch_and_parse(self, stop, fetch, parse, page):
+        if stop.is_set():
+            return None
+        stamp = time.time()
+        raw = fetch(page=page)
+        self._count('fetch', stamp)
+        with self._stats_lock:
+            self.fetched += 1
+        stamp = time.time()
+        pool = self.get_pool('parse')
+        rows = None
+        if pool is not None:
+            try:
+                rows = pool.submit(_parse_page, parse, raw).result()
+            except BrokenProcessPool as e:
+                self._drop_pool('parse', pool)
+                self.eprint(f'Parse Inline: {e}')
+        if rows is None:
+            rows = _parse_page(parse, raw)
+        self._count('parse', stamp)
+        return rows
+
+    def run(self, fetch, parse, store, start=1):
+        '''
+        :param fetch:   fetch(page=page) returns the raw page.
+        :param parse:   parse(raw) returns the rows, it must be picklable.
+        :param store:   store(rows_of_pages) stores the pages in order and
+                        returns the count of them to go on, it stops when
+                        the count is less than the pages.
+        :param start:   The first page to fetch.
+        :return:        Count of the stored pages.
+        '''
+        stop = threading.Event()
+        fpool = self.get_pool('fetch')
+        pending = collections.deque()
+        window = 1
+        page = start - 1
+        stored = 0
+        try:
+            while self.is_run():
+                while len(pending) < window:
+                    page += 1
+                    pending.append(fpool.submit(self._fetch_and_parse, stop,
+                                                fetch, parse, page))
+                # The writer takes the pages which are ready in order,
+                # the pages before a failed page are stored first.
+                pages = [pending.popleft().result()]
+                while pending and pending[0].done() and \
+                        pending[0].exception() is None:
+                    pages.append(pending.popleft().result())
+                stamp = time.time()
+                count = store(pages)
+                self._count('store', stamp, len(pages))
+                stored += count
+                if count < len(pages):
+                    break
+                window = min(window * 2, self.window)
+        finally:
+            stop.set()
+            stamp = time.time()
+            for future in pending:
+                future.cancel()
+            self._count('cancel', stamp, len(pending))
+        return stored
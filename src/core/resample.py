@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+
+import collections
+import numpy
+import re
+import time
+
+from pysp.sbasic import SSingleton
+from pysp.serror import SCDebug
+
+from core.cache import LruCache
+from core.colstore import ColumnStore
+from core.helper import DateTool
+from core.model import ColumnData
+
+
+class StockResample(LruCache, SCDebug, metaclass=SSingleton):
+    '''
+    The bars of the days of stock_day, a bar of a week, a month or N weekdays.
+    The columns are aggregated by AGGREGATE at once on the arrays and the
+    stamp of a bar is the last day of it. The bars of each code and
+    timeframe are cached with the days loaded for them, a wider range
+    resamples the days out of the cached range only and the stored days
+    drop the bars from the day, so the bars are maintained incrementally.
+
+        timeframe:  'week', 'month' or '<N>d', e.g. '5d'.
+    '''
+    AGGREGATE = collections.OrderedDict([
+        ('start',       'first'),
+        ('end',         'last'),
+        ('high',        'max'),
+        ('low',         'min'),
+        ('volume',      'sum'),
+        ('foreigner',   'sum'),
+        ('frate',       'last'),
+        ('institute',   'sum'),
+        ('person',      'sum'),
+        ('short',       'sum'),
+        # The balance of the short stock, not a flow.
+        ('shortamount', 'last'),
+    ])
+    # The dtype of each column, a load of no value of a column is 'i8' of
+    # NULL_INT even if it is a float column.
+    DTYPES = {x: ColumnStore.COLUMNS[x] for x in AGGREGATE.keys()}
+    PATTERN_NDAYS = re.compile(r'^([1-9]\d*)d$')
+    EPOCH = numpy.datetime64('1970-01-01', 'D')
+
+    class Error(Exception):
+        pass
+
+    @classmethod
+    def is_supported(cls, timeframe):
+        return timeframe in ['week', 'month'] or \
+            cls.PATTERN_NDAYS.match(str(timeframe)) is not None
+
+    @classmethod
+    def to_dates(cls, days):
+        '''
+        :param days:    Array of the integer days, YYYYMMDD.
+        :return:        Array of datetime64[D].
+        '''
+        days = numpy.asarray(days, dtype='i8')
+        years = (days // 10000 - 1970).astype('M8[Y]')
+        months = years.astype('M8[M]') + (days // 100 % 100 - 1)
+        return months.astype('M8[D]') + (days % 100 - 1)
+
+    @classmethod
+    def to_keys(cls, days, timeframe):
+        '''
+        :return:    Array of the key of the bar of each day.
+        '''
+        if timeframe == 'month':
+            return numpy.asarray(days, dtype='i8') // 100
+        dates = cls.to_dates(days)
+        if timeframe == 'week':
+            # 1970-01-01 is Thursday, the weeks begin on Monday.
+            return (dates.astype('i8') + 3) // 7
+        m = cls.PATTERN_NDAYS.match(str(timeframe))
+        if m is None:
+            raise cls.Error(f'Unknown Timeframe: {timeframe}')
+        return numpy.busday_count(cls.EPOCH, dates) // int(m.group(1))
+
+    @classmethod
+    def bar_start(cls, day, timeframe):
+        '''
+        :return:    The first day of the bar of the day.
+        '''
+        if timeframe == 'month':
+            return day // 100 * 100 + 1
+        date = cls.to_dates([day])[0]
+        if timeframe == 'week':
+            date -= (date.astype('i8') + 3) % 7
+        else:
+            count = int(cls.PATTERN_NDAYS.match(timeframe).group(1))
+            bars = numpy.busday_count(cls.EPOCH, date) // count
+            date = numpy.busday_offset(cls.EPOCH, bars * count,
+                                       roll='forward')
+        return DateTool.to_day(date.item())
+
+    @classmethod
+    def to_dtype(cls, array, dtype):
+        '''
+        :return:    Array of dtype, None is NULL_INT or NaN of it.
+        '''
+        if array.dtype == dtype:
+            return array
+        if array.dtype.kind == 'f':
+            null = numpy.isnan(array)
+        else:
+            null = array == ColumnData.NULL_INT
+        array = numpy.where(null, 0, array).astype(dtype)
+        array[null] = numpy.nan if array.dtype.kind == 'f' else \
+            ColumnData.NULL_INT
+        return array
+
+    @classmethod
+    def _reduce(cls, array, how, starts):
+        null = numpy.nan if array.dtype.kind == 'f' else ColumnData.NULL_INT
+        valid = ~numpy.isnan(array) if array.dtype.kind == 'f' else \
+            array != ColumnData.NULL_INT
+        if how == 'sum':
+            sums = numpy.add.reduceat(numpy.where(valid, array, 0), starts)
+            counts = numpy.add.reduceat(valid.astype('i8'), starts)
+            return numpy.where(counts > 0, sums, null)
+        if how in ['max', 'min']:
+            if array.dtype.kind == 'f':
+                fill = -numpy.inf if how == 'max' else numpy.inf
+            else:
+                info = numpy.iinfo(array.dtype)
+                fill = info.min if how == 'max' else info.max
+            ufunc = numpy.maximum if how == 'max' else numpy.minimum
+            values = ufunc.reduceat(numpy.where(valid, array, fill), starts)
+            return numpy.where(values == fill, null, values)
+        # The first or the last valid value of the bar.
+        count = len(array)
+        index = numpy.arange(count)
+        if how == 'first':
+            index = numpy.minimum.reduceat(
+                numpy.where(valid, index, count), starts)
+            found = index < count
+        else:
+            index = numpy.maximum.reduceat(
+                numpy.where(valid, index, -1), starts)
+            found = index >= 0
+        return numpy.where(found, array[numpy.clip(index, 0, count-1)], null)
+
+    @classmethod
+    def resample(cls, cdata, timeframe):
+        '''
+        :param cdata:   ColumnData of the days, stamp and the columns of
+                        AGGREGATE in order of the day.
+        :return:        Dict of the arrays of the bars, 'first' and 'last'
+                        are the first and the last day of each bar.
+        '''
+        count = cdata.get_count()
+        days = numpy.array([DateTool.to_day(x) for x in
+                            cdata.columns['stamp'].tolist()], dtype='i8')
+        columns = {k: cls.to_dtype(cdata.columns[k], cls.DTYPES[k])
+                   for k in cdata.colnames if k != 'stamp'}
+        bars = {'first': days[:0], 'last': days[:0]}
+        if count == 0:
+            bars.update({k: v[:0] for k, v in columns.items()})
+            return bars
+        keys = cls.to_keys(days, timeframe)
+        starts = numpy.flatnonzero(numpy.r_[True, keys[1:] != keys[:-1]])
+        ends = numpy.r_[starts[1:], count] - 1
+        bars = {'first': days[starts], 'last': days[ends]}
+        for colname, array in columns.items():
+            bars[colname] = cls._reduce(array, cls.AGGREGATE[colname],
+                                        starts)
+        return bars
+
+    def invalidate(self, prefix, since=None):
+        '''
+        :param prefix:  The key of the code, the bars of all timeframes.
+        :param since:   The first stored day, the bars from it are dropped.
+                        All bars are dropped if it is None.
+        '''
+        def update(entry):
+            if since is None or since <= entry['sday']:
+                return None
+            keep = int(numpy.searchsorted(entry['bars']['last'], since,
+                                          'left'))
+            if keep == 0:
+                return None
+            bars = {k: v[:keep] for k, v in entry['bars'].items()}
+            # The days of the dropped bars are resampled again.
+            return dict(entry, bars=bars, eday=int(bars['last'][-1]))
+
+        self.invalidate_keys(lambda x: x.startswith(prefix+':'), update)
+
+    def _load(self, load, timeframe, sday, eday):
+        colnames = ['stamp'] + list(self.AGGREGATE.keys())
+        return self.resample(load(colnames, sday, eday), timeframe)
+
+    @classmethod
+    def _join(cls, head, tail):
+        return {k: numpy.concatenate([head[k], tail[k]]) for k in head.keys()}
+
+    def get(self, key, colnames, sday, eday, timeframe, load):
+        '''
+        :param key:         The key of the code, None is not cached.
+        :param colnames:    List of column name, stamp and the columns of
+                            AGGREGATE.
+        :param load:        load(colnames, sday, eday) returns ColumnData
+                            of the days of the range.
+        :return:            ColumnData of the bars overlapped with the range,
+                            the first and the last bar are of the whole
+                            week, month or N weekdays.
+        '''
+        if not self.is_supported(timeframe):
+            raise self.Error(f'Unknown Timeframe: {timeframe}')
+        unknown = [x for x in colnames
+                   if x != 'stamp' and x not in self.AGGREGATE]
+        if unknown:
+            raise self.Error(f'Not Supported Column: {unknown}')
+        if key is None:
+            # Not cached.
+            entry = self._update(None, load, timeframe, sday, eday)
+            return self._slice(entry, colnames, sday, eday)
+        key = f'{key}:{timeframe}'
+        with self.loading(key) as gen:
+            entry = self._update(self.get_entry(key), load, timeframe, sday,
+                                 eday)
+            self.put_entry(key, entry, gen)
+        return self._slice(entry, colnames, sday, eday)
+
+    def _slice(self, entry, colnames, sday, eday):
+        bars = entry['bars']
+        lo = int(numpy.searchsorted(bars['last'], sday, 'left'))
+        hi = int(numpy.searchsorted(bars['first'], eday, 'right'))
+        columns = {}
+        for colname in colnames:
+            if colname == 'stamp':
+                columns[colname] = numpy.array(
+                    [DateTool.to_stamp(x) for x in bars['last'][lo:hi]
+                     .tolist()])
+            else:
+                columns[colname] = bars[colname][lo:hi]
+        return ColumnData(colnames=list(colnames), columns=columns)
+
+    def _update(self, entry, load, timeframe, sday, eday):
+        '''
+        :return:    The entry of the bars of the range, the cached bars and
+                    the bars of the days out of them.
+        '''
+        bsday = self.bar_start(sday, timeframe)
+        if entry is None or len(entry['bars']['last']) == 0:
+            self.dprint(f'Resample {timeframe} {bsday}~{eday}')
+            bars = self._load(load, timeframe, bsday, eday)
+            return {'sday': bsday, 'eday': eday, 'bars': bars,
+                    'stamp': time.time() + self.DURATION}
+        bars = entry['bars']
+        if bsday < entry['sday']:
+            head = self._load(load, timeframe, bsday, entry['sday']-1)
+            bars = self._join(head, bars)
+            entry = dict(entry, sday=bsday)
+        if eday > entry['eday']:
+            # The last bar is resampled again with the new days.
+            keep = len(bars['last']) - 1
+            tail = self._load(load, timeframe, int(bars['first'][-1]), eday)
+            bars = self._join({k: v[:keep] for k, v in bars.items()}, tail)
+            entry = dict(entry, eday=eday)
+        return dict(entry, bars=bars)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import threading
+
+from pysp.sbasic import SSingleton
+from pysp.serror import SCDebug
+
+from core.config import BillConfig
+from core.helper import DateTool
+
+
+class TradeCalendar(SCDebug, metaclass=SSingleton):
+    '''
+    The trading days of KRX, the weekdays except tradeday.holidays.
+    The stored days of stock_day are learned, a weekday in the range of
+    the days of tradeday.reference and not in the learned days is a holiday
+    too, so a holiday missed in the list is found by the stored rows.
+    '''
+    OPEN = '09:00'
+    CLOSE = '15:30'
+    SETTLE = '18:00'
+    REFERENCE = '005930'
+    # The days to look back for the previous trading day.
+    MAX_GAP_DAYS = 30
+
+    class Error(Exception):
+        pass
+
+    def __init__(self):
+        bcfg = BillConfig()
+        self.open = self.to_time(bcfg.get_value('tradeday.open', self.OPEN))
+        self.close = self.to_time(bcfg.get_value('tradeday.close',
+                                                 self.CLOSE))
+        self.settle = self.to_time(bcfg.get_value('tradeday.settle',
+                                                  self.SETTLE))
+        self.reference = str(bcfg.get_value('tradeday.reference',
+                                            self.REFERENCE))
+        holidays = bcfg.get_value('tradeday.holidays', None) or []
+        self.holidays = set([DateTool.to_day(str(x)) for x in holidays])
+        self.lock = threading.Lock()
+        self.learned = set()
+        self.ranges = []
+
+    @classmethod
+    def to_time(cls, hhmm):
+        hour, minute = str(hhmm).split(':')
+        return datetime.time(int(hour), int(minute))
+
+    @classmethod
+    def to_date(cls, day):
+        day = DateTool.to_day(day)
+        return datetime.date(day//10000, day//100 % 100, day % 100)
+
+    def learn(self, days, sequence=False):
+        '''
+        :param days:        List of the stored days of a code.
+        :param sequence:    True if the days are all trading days of the
+                            range of them, the days of tradeday.reference.
+                            The days of a code can miss the days of the
+                            suspended trading.
+        '''
+        days = [DateTool.to_day(x) for x in days]
+        if not days:
+            return
+        with self.lock:
+            self.learned.update(days)
+            if not sequence:
+                return
+            self.ranges.append((min(days), max(days)))
+            # The overlapped ranges are merged.
+            ranges = []
+            for sday, eday in sorted(self.ranges):
+                if ranges and sday <= ranges[-1][1]:
+                    ranges[-1] = (ranges[-1][0], max(ranges[-1][1], eday))
+                else:
+                    ranges.append((sday, eday))
+            self.ranges = ranges
+
+    def is_trading_day(self, day):
+        day = DateTool.to_day(day)
+        if self.to_date(day).weekday() >= 5:
+            return False
+        with self.lock:
+            if day in self.learned:
+                return True
+            if day in self.holidays:
+                return False
+            for sday, eday in self.ranges:
+                if sday <= day <= eday:
+                    return False
+        return True
+
+    def prev_trading_day(self, day):
+        '''
+        :return:    The trading day before the day.
+        '''
+        date = self.to_date(day)
+        for _ in range(self.MAX_GAP_DAYS):
+            date -= datetime.timedelta(days=1)
+            if self.is_trading_day(date):
+                return DateTool.to_day(date)
+        raise self.Error(f'No Trading Day Before {day}')
+
+    def next_trading_day(self, day):
+        date = self.to_date(day)
+        for _ in range(self.MAX_GAP_DAYS):
+            date += datetime.timedelta(days=1)
+            if self.is_trading_day(date):
+                return DateTool.to_day(date)
+        raise self.Error(f'No Trading Day After {day}')
+
+    def last_session(self, now=None):
+        '''
+        :return:    The last trading day of the settled session,
+                    the rows of it are final after tradeday.settle.
+        '''
+        now = now or datetime.datetime.now()
+        day = DateTool.to_day(now.date())
+        if self.is_trading_day(day) and now.time() >= self.settle:
+            return day
+        return self.prev_trading_day(day)
+
+    def is_current(self, day, now=None):
+        '''
+        :param day:     The last stored day of a code.
+        :return:        True if it has the last settled session.
+        '''
+        return day is not None and \
+            DateTool.to_day(day) >= self.last_session(now)
+
+    def is_market_open(self, now=None):
+        now = now or datetime.datetime.now()
+        return self.is_trading_day(now.date()) and \
+            self.open <= now.time() < self.close
+
+    def seconds_to_open(self, now=None):
+        '''
+        :return:    Seconds to the next open of the market, 0 if it is open.
+        '''
+        now = now or datetime.datetime.now()
+        if self.is_market_open(now):
+            return 0
+        day = DateTool.to_day(now.date())
+        if not self.is_trading_day(day) or now.time() >= self.open:
+            day = self.next_trading_day(day)
+        opening = datetime.datetime.combine(self.to_date(day), self.open)
+        return int((opening - now).total_seconds())
@@ -1,7 +1,8 @@
 import datetime
+import json
 
 from dateutil.relativedelta import relativedelta
-from flask import jsonify, request
+from flask import jsonify, request, Response, stream_with_context
 from flask_login import UserMixin
 
 from . import db
@@ -139,6 +140,28 @@ class Reply:
         data['value'] = kwargs.get('value', None)
         return jsonify(data)
 
+    @classmethod
+    def Stream(cls, chunks, **kwargs):
+        '''
+        NDJSON of the rows, the first line is the header of kwargs, a line
+        of each row and the last line is the count of the rows or the
+        message of the error while streaming.
+        :param chunks:  Iterable of list of the rows.
+        '''
+        def generate():
+            yield json.dumps(dict(kwargs, success=True)) + '\n'
+            count = 0
+            try:
+                for chunk in chunks:
+                    count += len(chunk)
+                    yield ''.join([json.dumps(x) + '\n' for x in chunk])
+            except Exception as e:
+                yield json.dumps({'success': False, 'message': f'{e}'}) + '\n'
+                return
+            yield json.dumps({'success': True, 'count': count}) + '\n'
+        return Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
+
     @classmethod
     def Data(cls, data):
         if isinstance(data, dict):
@@ -68,7 +68,7 @@
   stock = {
     kakao_brief_stock: function(code, cb) {
       var url = 'https://stock.kakao.com/api/securities/KOREA-A'+code+'.json';
-      var params = {method: 'GET', url: url, datatype: 'json', duration: 90};
+      var params = {method: 'GET', url: url, datatype: 'json', duration: 90, intraday: true};
       ajax.post('/ajax/proxy', params, function(resp){cb(resp.recentSecurity);});
     },
     kakao_brief_company: function(code, cb) {
@@ -79,7 +79,7 @@
     kakao_assets: function(codes, cb) {
       var url = 'https://stock.kakao.com/api/assets.json';
       var data = codes.map(function(el){return 'KOREA-A'+el});
-      var params = {method: 'GET', url: url, datatype: 'json', params: {ids: data.join()}, duration: 30};
+      var params = {method: 'GET', url: url, datatype: 'json', params: {ids: data.join()}, duration: 30, intraday: true};
       ajax.post('/ajax/proxy', params, function(resp){cb(resp.assets);});
     },
     kakao_overseas: function(cb) {
@@ -94,15 +94,39 @@
     query_columns: function(code, months, params, cb) {
       ajax.post('/ajax/stock/item/'+code+'/columns/'+months, params, cb);
     },
+    query_columns_stream: function(code, months, params, onrows, cb) {
+      // The rows come by the chunks, onrows(header, rows) for each chunk.
+      ajax.stream('/ajax/stock/item/'+code+'/columns/'+months+'?stream=ndjson', params, onrows, cb);
+    },
+    query_columns_layout: function(code, months, params, cb) {
+      // The columnar layout, resp.columns[i] is the values of resp.colnames[i].
+      ajax.post('/ajax/stock/item/'+code+'/columns/'+months+'?layout=columns', params, cb);
+    },
+    query_columns_since: function(code, months, params, since, version, cb) {
+      // The rows from a few rows before since to patch in place by stamp,
+      // all rows of the range if resp.reset. Drop the rows before resp.start,
+      // the first day of the range. Keep resp.version for the next.
+      params = Object.assign({since: since, version: version}, params);
+      ajax.post('/ajax/stock/item/'+code+'/columns/'+months, params, cb);
+    },
+    query_columns_batch: function(codes, months, params, cb) {
+      // resp.codes[code] is {success, message, value} of each code.
+      params = Object.assign({codes: codes}, params);
+      ajax.post('/ajax/stock/items/columns/'+months, params, cb);
+    },
     query_simulation: function(code, months, params, cb) {
       ajax.post('/ajax/stock/item/'+code+'/simulation/'+months, params, cb);
     },
     query_investors_graph: function(code, months, cb) {
       var params = {
           colnames: ['stamp', 'foreigner', 'institute', 'person', 'shortamount', 'end'],
-          accmulator: true
+          accmulator: true,
+          // The bars of a week over a year.
+          timeframe: months > 12 ? 'week' : 'day',
+          // A point of a pixel of the chart at most.
+          max_points: Math.max(window.innerWidth || 0, 300)
         };
-      this.query_columns(code, months, params, cb);
+      this.query_columns_layout(code, months, params, cb);
     },
     query_investors_table: function(code, months, cb) {
       this.query_columns(code, months, {colnames: ['stamp', 'foreigner', 'frate', 'institute', 'person']}, cb);
@@ -137,6 +161,17 @@
       };
       this.do_ajax(opts, callback);
     },
+    query : function(url, params, callback) {
+      // GET with the parameters in the query string, it can be cached.
+      var opts = {
+        dataType : 'json',
+        type : 'GET',
+        async : true,
+        url : url,
+        data : params,
+      };
+      this.do_ajax(opts, callback);
+    },
     post :function(url, params, callback) {
       var opts = {
         dataType : 'json',
@@ -181,6 +216,55 @@
       };
       this.do_ajax(opts, callback);
     },
+    stream : function(url, params, onrows, callback) {
+      // POST and read the NDJSON reply, the first line is the header,
+      // a line of each row and the last line is the count of the rows.
+      var fail = function(message) {
+        util.gui.flash('URL@POST: '+url+'<br/>Error: '+message, 'danger');
+      };
+      fetch(url, {
+        method: 'POST',
+        credentials: 'same-origin',
+        headers: {'Content-Type': 'application/json'},
+        body: JSON.stringify(params),
+      }).then(function(resp) {
+        if (resp.headers.get('Content-Type').indexOf('ndjson') < 0) {
+          // Reply.Fail before the first row.
+          return resp.json().then(function(data) { fail(data.message); });
+        }
+        var reader = resp.body.getReader();
+        var decoder = new TextDecoder();
+        var header = null;
+        var rest = '';
+        var read = function(result) {
+          if (result.done) {
+            return;
+          }
+          var lines = (rest + decoder.decode(result.value, {stream: true})).split('\n');
+          var rows = [];
+          rest = lines.pop();
+          for (var i in lines) {
+            var line = JSON.parse(lines[i]);
+            if (Array.isArray(line)) {
+              rows.push(line);
+            } else if (header == null) {
+              header = line;
+            } else if (line.success == false) {
+              fail(line.message);
+            } else if (callback) {
+              callback(header, line.count);
+            }
+          }
+          if (rows.length) {
+            onrows(header, rows);
+          }
+          return reader.read().then(read);
+        };
+        return reader.read().then(read);
+      }).catch(function(e) {
+        fail(e.message);
+      });
+    },
     do_ajax : function(opts, callback) {
       opts.success = function(resp) {
         // console.log(JSON.stringify(resp));
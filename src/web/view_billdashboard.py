@@ -1,18 +1,23 @@
 # import codecs
 # import os
 import datetime
+import itertools
 
-from flask import render_template, flash, abort, session, request
+from flask import (render_template, flash, abort, session, request,
+                   Response)
 from flask_login import login_required
 
 from . import app, db
 from .account import role_required
 from .model import MStock, Reply
 # from core.finance import BillConfig
-from core.connect import FKrx, Http
+from core.codedir import CodeDirectory
+from core.connect import Http
+from core.downsample import ChartDownsample
 from core.finance import DataCollection, StockItemDB, StockQuery
 from core.finalgo import AlgoTable
 from core.manager import Collector
+from core.resample import StockResample
 
 
 @app.route('/bill/dashboard')
@@ -52,7 +57,31 @@ def bill_stock(code):
 @login_required
 @role_required('STOCK')
 def ajax_stock_list():
-    return Reply.Success(value=FKrx.get_chunk('list'))
+    cdir = CodeDirectory()
+    cdir.refresh()
+    market = request.args.get('market', None)
+    # The list is changed only with the version of the directory.
+    etag = f'codedir-{cdir.version}-{market}'
+    if request.method == 'GET' and request.if_none_match.contains(etag):
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+    response = Reply.Success(value=cdir.list(market=market))
+    response.set_etag(etag)
+    return response
+
+
+@app.route('/ajax/stock/search', methods=['GET'])
+@login_required
+@role_required('STOCK')
+def ajax_stock_search():
+    query = request.args.get('q', '')
+    market = request.args.get('market', None)
+    limit = request.args.get('limit', CodeDirectory.SEARCH_LIMIT)
+    try:
+        limit = min(int(limit), 100)
+    except ValueError:
+        return Reply.Fail(message=f'Invalid Limit: {limit}')
+    return Reply.Success(value=CodeDirectory().search(query, market=market,
+                                                      limit=limit))
 
 
 @app.route('/ajax/stock/item/<code>', methods=['DELETE'])
@@ -68,25 +97,129 @@ def ajax_stock_item(code):
     return Reply.Fail(message=f'Not Support Method[{request.method}]')
 
 
+def check_query_columns(kwargs):
+    '''
+    :return:    The message of the invalid arguments, None if valid.
+    '''
+    timeframe = kwargs.get('timeframe', None) or 'day'
+    if timeframe != 'day' and not StockResample.is_supported(timeframe):
+        return f'Unknown Timeframe: {timeframe}'
+    # max_points downsamples the rows for the chart by the method.
+    method = kwargs.get('downsample', None)
+    if method and not ChartDownsample.is_supported(method):
+        return f'Unknown Downsample: {method}'
+    return None
+
+
 @app.route('/ajax/stock/item/<code>/columns/<month>', methods=['GET', 'POST'])
 @login_required
 @role_required('STOCK')
 def ajax_stock_query_columns(code, month):
     collector = Collector()
     # colnames = request.get_json().get('colnames', [])
-    with collector.lock:
+    # The last committed rows are served while the code is being collected.
+    emsg = check_query_columns(request.get_json() or {})
+    if emsg:
+        return Reply.Fail(message=emsg)
+    if request.args.get('stream', None) == 'ndjson':
+        return stream_stock_query_columns(code, month)
+    # The columnar layout, a list of each column.
+    columnar = request.args.get('layout', None) == 'columns'
+    kwargs = dict(request.get_json() or {})
+    # The delta of the rows after the last stamp and the version of client.
+    since = kwargs.pop('since', None) or request.args.get('since', None)
+    version = kwargs.pop('version', None) or \
+        request.args.get('version', None)
+    reset = True
+    try:
+        with StockItemDB.reader(code) as sidb:
+            if since:
+                tdata, version, reset, start = StockQuery.delta_data(
+                    sidb, kwargs.pop('colnames', None), since, version,
+                    months=int(month), columnar=columnar, **kwargs)
+            else:
+                version = sidb.get_version()
+                tdata = StockQuery.raw_data_of_each_colnames(
+                    sidb, months=int(month), columnar=columnar, **kwargs)
+        count = tdata.get_count() if columnar else len(tdata.fields)
+        if count == 0 and reset:
+            raise Exception
+    except Exception:
         if collector.is_working(code):
             return Reply.Fail(message="Not Ready, Still be Collecting Data.")
-        try:
-            sidb = StockItemDB.factory(code)
-            tdata = StockQuery.raw_data_of_each_colnames(
-                                sidb, months=int(month), **request.get_json())
-            if len(tdata.fields) == 0:
-                raise Exception
-        except Exception:
-            collector.collect(code)
-            return Reply.Fail(message="Collector is Gathering Data.")
-        return Reply.Success(value=Reply.Data(tdata))
+        collector.collect(code)
+        return Reply.Fail(message="Collector is Gathering Data.")
+    value = dict(tdata.to_dict() if columnar else tdata, version=version)
+    if since:
+        value.update({'since': since, 'reset': reset, 'start': start})
+    return Reply.Success(value=Reply.Data(value))
+
+
+@app.route('/ajax/stock/items/columns/<month>', methods=['POST'])
+@login_required
+@role_required('STOCK')
+def ajax_stock_batch_query_columns(month):
+    '''
+    The columns of the codes at once, {'codes': [...], 'colnames': [...]}
+    and the arguments of ajax_stock_query_columns. The value has the dict
+    of each code in codes, the failure of a code is in its success and
+    message. The code without the stored rows is collected.
+    '''
+    collector = Collector()
+    columnar = request.args.get('layout', None) == 'columns'
+    kwargs = request.get_json() or {}
+    emsg = check_query_columns(kwargs)
+    if emsg:
+        return Reply.Fail(message=emsg)
+    codes = kwargs.pop('codes', [])
+    colnames = kwargs.pop('colnames', None)
+    try:
+        results = StockQuery.batch_raw_data(
+            codes, colnames, months=int(month), columnar=columnar, **kwargs)
+    except (StockQuery.Error, ValueError) as e:
+        return Reply.Fail(message=f'{e}')
+    value = {}
+    for code, result in results.items():
+        data = result['value']
+        if not result.pop('stored'):
+            if collector.is_working(code):
+                message = "Not Ready, Still be Collecting Data."
+            else:
+                collector.collect(code)
+                message = "Collector is Gathering Data."
+            result = {'success': False, 'message': message, 'value': None}
+        elif columnar and data is not None:
+            result = dict(result, value=data.to_dict())
+        value[code] = result
+    return Reply.Success(value=Reply.Data({'codes': value}))
+
+
+def stream_stock_query_columns(code, month):
+    '''
+    The rows go out by the chunks of the cursor, the first chunk is read
+    here to reply the failure as ajax_stock_query_columns.
+    '''
+    collector = Collector()
+    kwargs = request.get_json() or {}
+
+    def iter_chunks():
+        with StockItemDB.reader(code) as sidb:
+            yield StockQuery.to_query_range(sidb, **kwargs)[0]
+            yield from StockQuery.iter_raw_data(sidb, months=int(month),
+                                                **kwargs)
+    chunks = iter_chunks()
+    try:
+        colnames = next(chunks)
+        first = next(chunks, [])
+        if len(first) == 0:
+            raise Exception
+    except Exception:
+        chunks.close()
+        if collector.is_working(code):
+            return Reply.Fail(message="Not Ready, Still be Collecting Data.")
+        collector.collect(code)
+        return Reply.Fail(message="Collector is Gathering Data.")
+    return Reply.Stream(itertools.chain([first], chunks), colnames=colnames)
 
 
 @app.route('/ajax/stock/item/<code>/simulation/<month>', methods=['GET', 'POST'])
@@ -94,22 +227,29 @@ def ajax_stock_query_columns(code, month):
 @role_required('STOCK')
 def ajax_stock_simulation_table(code, month):
     collector = Collector()
-    with collector.lock:
+    try:
+        # colnames = ['stamp', 'start', 'low', 'high', 'end', 'volume']
+        with StockItemDB.reader(code) as sidb:
+            tdata = StockQuery.raw_data_of_each_colnames(
+                            sidb, months=int(month), **request.get_json())
+        if len(tdata.fields) == 0:
+            raise Exception
+        algo = AlgoTable(tdata)
+        pdata = algo.process()
+    except Exception:
         if collector.is_working(code):
             return Reply.Fail(message="Not Ready, Still be Collecting Data.")
-        try:
-            # colnames = ['stamp', 'start', 'low', 'high', 'end', 'volume']
-            sidb = StockItemDB.factory(code)
-            tdata = StockQuery.raw_data_of_each_colnames(
-                                sidb, months=int(month), **request.get_json())
-            if len(tdata.fields) == 0:
-                raise Exception
-            algo = AlgoTable(tdata)
-            pdata = algo.process()
-        except Exception:
-            collector.collect(code)
-            return Reply.Fail(message="Collector is Gathering Data.")
-        return Reply.Success(value=Reply.Data(pdata))        
+        collector.collect(code)
+        return Reply.Fail(message="Collector is Gathering Data.")
+    return Reply.Success(value=Reply.Data(pdata))
+
+
+@app.route('/ajax/collector/metrics', methods=['GET'])
+@login_required
+@role_required('ADMIN')
+def ajax_collector_metrics():
+    limit = min(int(request.args.get('limit', 10)), 100)
+    return Reply.Success(value=Collector().get_metrics(limit=limit))
 
 
 @app.route('/ajax/proxy', methods=['POST'])
@@ -131,6 +271,7 @@ def ajax_proxy():
     kwargs.update(_data_type.get(datatype, {}))
     if 'duration' in reqjson:
         kwargs['duration'] = reqjson.get('duration')
+    kwargs['intraday'] = reqjson.get('intraday', False)
     # Request
     try:
         rv = Http.proxy(method, url, **kwargs)
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+import contextlib
+import tempfile
+
+from core.config import BillConfig
+from core.finance import StockItemPool
+
+
+@contextlib.contextmanager
+def stock_folder(*keys):
+    '''
+    The stock databases of a test in a temporary folder.
+
+    :param keys:    The other config keys the test sets, restored too.
+    :return:        The temporary folder.
+    '''
+    bconfig = BillConfig()
+    keys = ('_config.db.stock_folder',) + keys
+    backup = {k: bconfig.get_value(k) for k in keys}
+    with tempfile.TemporaryDirectory() as folder:
+        bconfig.set_value(keys[0], folder)
+        try:
+            yield folder
+        finally:
+            StockItemPool().clear()
+            for k, v in backup.items():
+                bconfig.set_value(k, v)
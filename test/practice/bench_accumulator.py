@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+StockQuery.TradingAccumulator, update() of each field vs accumulate().
+    $ cd src; PYTHONPATH=. python3 ../test/practice/bench_accumulator.py
+'''
+
+import random
+import sys
+import timeit
+
+from core.finance import StockQuery
+
+
+COLNAMES = ['stamp', 'foreigner', 'institute', 'person', 'shortamount', 'end']
+
+
+def make_fields(count, seed=0):
+    rand = random.Random(seed)
+    fields = []
+    for i in range(count):
+        field = [f'day-{i:05d}'] + [rand.randint(-10**6, 10**6)
+                                    for _ in range(3)]
+        field += [rand.choice([None, 0, rand.randint(1, 10**7)]),
+                  rand.randint(1000, 100000)]
+        # The end of data, the investor columns are not stored yet.
+        if i and rand.random() < 0.02:
+            field[2] = field[3] = None
+        fields.append(field)
+    return fields
+
+
+def by_update(fields):
+    tacc = StockQuery.TradingAccumulator(COLNAMES, COLNAMES,
+                                         amount_colname='shortamount')
+    rows = []
+    for field in fields:
+        try:
+            rows.append(tacc.update(field))
+        except StockQuery.ExceptionEndOfData:
+            pass
+    return rows
+
+
+def by_accumulate(fields):
+    tacc = StockQuery.TradingAccumulator(COLNAMES, COLNAMES,
+                                         amount_colname='shortamount')
+    return tacc.accumulate(fields)
+
+
+if __name__ == '__main__':
+    # 60 months are about 1,250 trading days.
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1250
+    for seed in range(20):
+        fields = make_fields(count, seed)
+        assert by_update(fields) == by_accumulate(fields), f'seed {seed}'
+    fields = make_fields(count)
+    loops = 50
+    tu = timeit.timeit(lambda: by_update(fields), number=loops) / loops
+    ta = timeit.timeit(lambda: by_accumulate(fields), number=loops) / loops
+    print(f'{count} fields, same rows of 20 seeds')
+    print(f'update():     {tu*1000:8.3f} ms')
+    print(f'accumulate(): {ta*1000:8.3f} ms  x{tu/ta:.1f}')
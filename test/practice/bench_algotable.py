@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+'''
+AlgoTable.generate, generate_rows() of each row vs the columns at once,
+and the configs of IterAlgo with OpCache vs without it.
+    $ cd src; PYTHONPATH=. python3 ../test/practice/bench_algotable.py
+'''
+
+import itertools
+import json
+import random
+import sys
+import timeit
+
+from core.finalgo import AlgoTable, IterAlgo, OpCache
+from core.model import QueryData
+
+
+COLNAMES = ['stamp', 'start', 'low', 'high', 'end', 'volume']
+
+
+class RowTable(AlgoTable):
+    def generate(self):
+        self.generate_rows()
+
+
+def make_qdata(count, seed=0):
+    rand = random.Random(seed)
+    price = rand.randint(500, 200000)
+    fields = []
+    for i in range(count):
+        price = max(price + rand.randint(-price//20, price//20), 100)
+        low = price - rand.randint(0, price//30)
+        high = price + rand.randint(0, price//30)
+        fields.append([f'day-{i:05d}', price, low, high, price,
+                       rand.randint(0, 10**6)])
+    return QueryData(colnames=list(COLNAMES), fields=fields)
+
+
+if __name__ == '__main__':
+    # 60 months are about 1,250 trading days.
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1250
+    for seed in range(20):
+        qdata = make_qdata(count, seed)
+        assert json.dumps(AlgoTable(qdata).qdata) == \
+            json.dumps(RowTable(qdata).qdata), f'seed {seed}'
+    qdata = make_qdata(count)
+    loops = 20
+    # The columns are generated every time without OpCache.
+    maxkeys = OpCache.MAX_KEYS
+    OpCache.MAX_KEYS = 0
+    tr = timeit.timeit(lambda: RowTable(qdata), number=loops) / loops
+    tc = timeit.timeit(lambda: AlgoTable(qdata), number=loops) / loops
+    print(f'{count} fields, same qdata of 20 seeds')
+    print(f'generate_rows(): {tr*1000:8.3f} ms')
+    print(f'generate():      {tc*1000:8.3f} ms  x{tr/tc:.1f}')
+
+    # The configs of a sweep, all SUM_ACCUMS are in them.
+    it = IterAlgo()
+    params = list(itertools.islice(it.gen_params(qdata), 0, 45000, 90))
+    cache = OpCache()
+    tn = timeit.timeit(lambda: [it.calculate(x) for x in params], number=1)
+    OpCache.MAX_KEYS = maxkeys
+    cache.clear()
+    tw = timeit.timeit(lambda: [it.calculate(x) for x in params], number=1)
+    tp = timeit.timeit(lambda: [AlgoTable(x.data, cfg=x.cfg)
+                                for x in params[:50]], number=1) / 50
+    print(f'{len(params)} configs of IterAlgo, calculate()')
+    print(f'without OpCache: {tn*1000:8.1f} ms')
+    print(f'with OpCache:    {tw*1000:8.1f} ms  x{tn/tw:.1f}'
+          f'  hits {cache.hits} misses {cache.misses}')
+    print(f'AlgoTable of a config with OpCache: {tp*1000:.3f} ms, '
+          f'the rest is process()')
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+
+from core.archive import ColdArchive
+from core.finance import StockItemDB, StockQuery
+from core.model import StockDay, StockDayInvestor
+from test.fixture import stock_folder
+
+
+class TestColdArchive(unittest.TestCase):
+
+    def test_block(self):
+        rows = [{'day': 20120102+i, 'stamp': None, 'finance': 'Naver',
+                 'end': 1000-i*10, 'frate': 1.5, 'short': None if i else 3}
+                for i in range(3)]
+        columns = ColdArchive.decode(ColdArchive.encode(rows))
+        self.assertEqual(columns['stamp'],
+                         ['2012-01-02', '2012-01-03', '2012-01-04'])
+        self.assertEqual(columns['end'], [1000, 990, 980])
+        self.assertEqual(columns['frate'], [1.5, 1.5, 1.5])
+        self.assertEqual(columns['short'], [3, None, None])
+
+    def test_archive(self):
+        with stock_folder():
+            sidb = StockItemDB.factory('000010')
+            stamps = ['2011.12.29', '2011.12.30', '2012.01.02',
+                      '2012.12.28', '2013.01.02', '2013.01.03']
+            sidb.update_candle([StockDay(
+                finance='Naver', stamp=x, start=i, end=i, high=i, low=i,
+                volume=i) for i, x in enumerate(stamps)])
+            sidb.update_investor([StockDayInvestor(
+                stamp='2012.12.28', foreigner=7, frate=1.0, institute=0,
+                person=-7)])
+            archive = ColdArchive.factory('000010')
+            self.assertEqual(archive.archive(sidb, until=20130101), 4)
+            self.assertEqual(archive.get_meta(),
+                             {'until': 20130101, 'years': [2011, 2012]})
+            self.assertEqual(len(sidb.query('stock_day')), 2)
+
+            colnames = ['stamp', 'end']
+            qdata = StockQuery.raw_data(sidb, colnames=colnames,
+                                        sdate='2011.12.30',
+                                        edate='2013.01.02')
+            self.assertEqual(qdata.fields, [
+                ['2011-12-30', 1], ['2012-01-02', 2],
+                ['2012-12-28', 3], ['2013-01-02', 4]])
+            # A row stored again is merged into the block
+            sidb.update_candle([StockDay(
+                finance='Naver', stamp='2012.06.01', start=9, end=9,
+                high=9, low=9, volume=9)])
+            self.assertEqual(archive.archive(sidb, until=20130101), 1)
+            fields = archive.load(colnames, 20120101, 20121231)
+            self.assertEqual(fields, [
+                ['2012-01-02', 2], ['2012-06-01', 9], ['2012-12-28', 3]])
+            # The candle backfilled again keeps the archived investor.
+            sidb.update_candle([StockDay(
+                finance='Naver', stamp='2012.12.28', start=8, end=8,
+                high=8, low=8, volume=8)])
+            self.assertEqual(archive.archive(sidb, until=20130101), 1)
+            fields = archive.load(['end', 'foreigner', 'short'], 20121228,
+                                  20121228)
+            self.assertEqual(fields, [[8, 7, None]])
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import functools
+import unittest
+
+from core.backfill import BackfillDB, StockBackfill
+from core.finance import StockItemDB
+from test.fixture import stock_folder
+
+
+DAYS = [(datetime.date(2024, 3, 29) - datetime.timedelta(days=x)).
+        strftime('%Y.%m.%d') for x in range(45)]
+# The days after the checkpoint, they move the pages back.
+NEW_DAYS = [(datetime.date(2024, 4, 8) - datetime.timedelta(days=x)).
+            strftime('%Y.%m.%d') for x in range(10)]
+
+
+def parse_days(days, raw):
+    # The page after the last one is the last page again, as Naver does.
+    page = min(raw['page'], (len(days) + 9) // 10)
+    return [{'stamp': x, 'finance': 'Naver', 'start': i, 'end': i,
+             'high': i, 'low': i, 'volume': i}
+            for i, x in enumerate(days[(page-1)*10:page*10])]
+
+
+parse_candle = functools.partial(parse_days, DAYS)
+
+
+class TestStockBackfill(unittest.TestCase):
+
+    def test_backfill(self):
+        with stock_folder() as folder:
+            pdb = BackfillDB(f'{folder}/backfill.sqlite3')
+            fetched = []
+
+            def fetch(page):
+                fetched.append(page)
+                return {'page': page}
+
+            def broken(page):
+                if page >= 3:
+                    raise IOError('Interrupted')
+                return fetch(page)
+
+            bf = StockBackfill('2024.03.01', pdb=pdb)
+            with self.assertRaises(IOError):
+                bf.backfill_stream('000010', 'candle', fetch=broken,
+                                   parse=parse_candle)
+            progress = pdb.get('000010', 'candle')
+            self.assertEqual(progress['page'], 2)
+            self.assertEqual(progress['oldest'], 20240310)
+            self.assertFalse(progress['done'])
+
+            # It goes on by the oldest day from the page of the checkpoint,
+            # the pages 2 and 3 are of the stored days by the new days.
+            fetched.clear()
+            bf = StockBackfill('2024.03.01', pdb=pdb)
+            progress = bf.backfill_stream(
+                '000010', 'candle', fetch=fetch,
+                parse=functools.partial(parse_days, NEW_DAYS + DAYS))
+            self.assertEqual(min(fetched), 2)
+            self.assertEqual(progress['page'], 4)
+            self.assertEqual(progress['rows'], 30)
+            self.assertEqual(progress['oldest'], 20240229)
+            self.assertTrue(progress['done'])
+            self.assertEqual(bf.get_total_fraction(), 1.0)
+
+            # The older horizon goes on to the end of the history.
+            bf = StockBackfill('2020.01.01', pdb=pdb)
+            progress = bf.backfill_stream(
+                '000010', 'candle', fetch=fetch,
+                parse=functools.partial(parse_days, NEW_DAYS + DAYS))
+            self.assertTrue(progress['done'])
+            self.assertEqual(progress['page'], 6)
+            self.assertEqual(progress['rows'], 45)
+            with StockItemDB.checkout('000010') as sidb:
+                self.assertEqual(len(sidb.stored_days(
+                    [int(x.replace('.', '')) for x in DAYS])), 45)
+            self.assertEqual(pdb.remove(['000010']), 1)
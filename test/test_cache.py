@@ -2,7 +2,7 @@
 import time
 import unittest
 
-from core.cache import FCache
+from core.cache import FCache, LruCache, RangeCache
 from pysp.sbasic import SSingleton
 
 
@@ -36,3 +36,59 @@ class TestCache(unittest.TestCase):
         time.sleep(5)
         FCache().cleanup()
         del SSingleton._instances[FCache]
+
+    def test_range_cache(self):
+        days = [20190301+i for i in range(20)]
+        table = {'stamp': [str(x) for x in days], 'end': days,
+                 'volume': [x % 100 for x in days]}
+        loads = []
+
+        def load(colnames, sday, eday):
+            loads.append((colnames, sday, eday))
+            return [[table[c][i] for c in colnames]
+                    for i, x in enumerate(days) if sday <= x <= eday]
+
+        cache = RangeCache()
+        key = 'test:000010'
+        fields = cache.get(key, ['stamp', 'end'], 20190305, 20190310, load)
+        self.assertEqual(fields, load(['stamp', 'end'], 20190305, 20190310))
+        loads.clear()
+        # The narrow range and the subset of columns are sliced.
+        self.assertEqual(cache.get(key, ['end'], 20190306, 20190307, load),
+                         [[20190306], [20190307]])
+        self.assertEqual(loads, [])
+        # The wider range loads the edges only.
+        fields = cache.get(key, ['end', 'stamp'], 20190303, 20190312, load)
+        self.assertEqual([x[0] for x in fields], days[2:12])
+        self.assertEqual(loads, [(['stamp', 'end'], 20190303, 20190304),
+                                 (['stamp', 'end'], 20190311, 20190312)])
+        loads.clear()
+        # A new column loads the columns of the whole range again.
+        fields = cache.get(key, ['volume'], 20190303, 20190304, load)
+        self.assertEqual(fields, [[3], [4]])
+        self.assertEqual(loads, [(['stamp', 'end', 'volume'],
+                                  20190303, 20190312)])
+        loads.clear()
+        cache.invalidate(key)
+        cache.get(key, ['end'], 20190303, 20190304, load)
+        self.assertEqual(loads, [(['stamp', 'end'], 20190303, 20190304)])
+        # The locks and the generations are of the loads in progress only.
+        self.assertEqual((cache._locks, cache._gens), ({}, {}))
+        del SSingleton._instances[RangeCache]
+
+    def test_lru_cache(self):
+        cache = LruCache()
+        with cache.loading('a') as gen:
+            # The key invalidated while it is loaded is not stored.
+            cache.invalidate_keys(lambda x: x == 'a')
+            self.assertFalse(cache.put_entry('a', {'stamp': 0}, gen))
+        with cache.loading('a') as gen:
+            entry = {'stamp': time.time() + 10}
+            self.assertTrue(cache.put_entry('a', entry, gen))
+        self.assertIs(cache.get_entry('a'), entry)
+        for key in range(LruCache.MAX_KEYS):
+            with cache.loading(key) as gen:
+                cache.put_entry(key, {'stamp': 0}, gen)
+        self.assertIsNone(cache.get_entry('a'))
+        self.assertEqual(len(cache._entries), LruCache.MAX_KEYS)
+        self.assertEqual((cache._locks, cache._gens), ({}, {}))
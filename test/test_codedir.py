@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+import tempfile
+import threading
+import unittest
+
+from pysp.sbasic import SSingleton
+
+from core.codedir import CodeDirectory
+from core.config import BillConfig
+from core.connect import FKrx
+
+
+class TestCodeDirectory(unittest.TestCase):
+    items = [
+        {'full_code': 'KR7035720002', 'short_code': 'A035720',
+         'codeName': '카카오', 'marketName': 'KOSPI'},
+        {'full_code': 'KR7060310000', 'short_code': 'A060310',
+         'codeName': '3S', 'marketName': 'KOSDAQ'},
+    ]
+
+    def setUp(self):
+        self.folder = tempfile.TemporaryDirectory()
+        self.bconfig = BillConfig()
+        self.backup = self.bconfig.get_value('krx.codedir_file')
+        self.bconfig.set_value('krx.codedir_file',
+                               self.folder.name+'/codedir.json')
+        SSingleton._instances.pop(CodeDirectory, None)
+
+    def tearDown(self):
+        SSingleton._instances.pop(CodeDirectory, None)
+        self.bconfig.set_value('krx.codedir_file', self.backup)
+        self.folder.cleanup()
+
+    def test_code_directory(self):
+        cdir = CodeDirectory()
+        diff = cdir.apply(self.items)
+        self.assertEqual(diff['added'], ['035720', '060310'])
+        self.assertEqual(cdir.by_fullcode['KR7060310000'], '060310')
+        self.assertEqual(cdir.by_name['카카오'], '035720')
+        self.assertEqual(sorted(cdir.by_market['KOSDAQ']), ['060310'])
+
+        items = [dict(self.items[0], codeName='카카오2'),
+                 {'full_code': 'KR7005930003', 'short_code': 'A005930',
+                  'codeName': '삼성전자', 'marketName': 'KOSPI'}]
+        diff = cdir.apply(items)
+        self.assertEqual(diff, {'added': ['005930'], 'removed': ['060310'],
+                                'changed': ['035720']})
+        self.assertTrue('카카오' not in cdir.by_name)
+        self.assertEqual(cdir.version, 2)
+        cdir.store()
+
+        # The stored directory is loaded by the next process.
+        SSingleton._instances.pop(CodeDirectory, None)
+        loaded = CodeDirectory()
+        self.assertTrue(loaded is not cdir)
+        self.assertEqual(loaded.rows, cdir.rows)
+        self.assertEqual(loaded.get('A005930')['full_code'], 'KR7005930003')
+        self.assertEqual([x['short_code'] for x in loaded.list('KOSPI')],
+                         ['A005930', 'A035720'])
+
+    def test_search(self):
+        cdir = CodeDirectory()
+        cdir.apply(self.items + [
+            {'full_code': 'KR7035250000', 'short_code': 'A035250',
+             'codeName': '강원랜드', 'marketName': 'KOSPI'},
+            {'full_code': 'KR7035420009', 'short_code': 'A035420',
+             'codeName': 'NAVER', 'marketName': 'KOSPI'}])
+        self.assertEqual(CodeDirectory.to_choseong('카카오 A'), 'ㅋㅋㅇ A')
+        codes = [x['short_code'] for x in cdir.search('035')]
+        self.assertEqual(codes, ['A035250', 'A035420', 'A035720'])
+        self.assertEqual(cdir.search('A0357')[0]['short_code'], 'A035720')
+        self.assertEqual(cdir.search('카카')[0]['short_code'], 'A035720')
+        self.assertEqual(cdir.search('ㅋㅋ')[0]['short_code'], 'A035720')
+        self.assertEqual(cdir.search('nav')[0]['short_code'], 'A035420')
+        self.assertEqual(cdir.search('3', market='KOSDAQ')[0]['short_code'],
+                         'A060310')
+        self.assertEqual(len(cdir.search('0', limit=2)), 2)
+        self.assertEqual(cdir.search(' '), [])
+        # The list is in order of the name.
+        self.assertEqual([x['codeName'] for x in cdir.list()],
+                         ['3S', 'NAVER', '강원랜드', '카카오'])
+
+    def test_refresh(self):
+        cdir = CodeDirectory()
+        cdir.apply(self.items)
+        cdir.stamp = 0
+        fetching = threading.Event()
+        release = threading.Event()
+
+        def get_chunk(name):
+            fetching.set()
+            release.wait(5)
+            return self.items[:1]
+
+        get_chunk_backup = FKrx.get_chunk
+        FKrx.get_chunk = get_chunk
+        try:
+            worker = threading.Thread(target=cdir.refresh)
+            worker.start()
+            self.assertTrue(fetching.wait(5))
+            # The readers go on with the rows while the list is fetched.
+            self.assertEqual(cdir.get('060310')['codeName'], '3S')
+            self.assertIsNone(cdir.refresh())
+            release.set()
+            worker.join(5)
+            self.assertIsNone(cdir.get('060310'))
+        finally:
+            release.set()
+            FKrx.get_chunk = get_chunk_backup
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import tempfile
+import unittest
+
+from core.colstore import ColumnStore
+from core.finance import (DataCollection, StockDayMerge, StockItemDB,
+                          StockQuery)
+from test.fixture import stock_folder
+
+
+class TestColumnStore(unittest.TestCase):
+
+    def make_rows(self, days):
+        rows = []
+        for i, day in enumerate(days):
+            row = {x: i for x in ColumnStore.COLUMNS.keys()}
+            row['day'] = day
+            row['frate'] = 1.5
+            row['short'] = None
+            rows.append(row)
+        return rows
+
+    def test_column_store(self):
+        colnames = ['stamp', 'end', 'frate', 'short']
+        with tempfile.TemporaryDirectory() as folder:
+            cstore = ColumnStore(folder+'/000010.col')
+            self.assertFalse(cstore.exists())
+            cstore.rebuild(self.make_rows([20190301, 20190304, 20190305]))
+            arrays = cstore.load(colnames, 20190302, 20190331)
+            self.assertEqual(cstore.to_fields(colnames, arrays), [
+                ['2019-03-04', 1, 1.5, None],
+                ['2019-03-05', 2, 1.5, None]])
+            # Rewrite the last row and append a row
+            rows = self.make_rows([20190305, 20190306])
+            rows[0]['short'] = 7
+            cstore.append(rows, 2)
+            self.assertEqual(cstore.get_meta(), {'rows': 4, 'gen': 2})
+            arrays = cstore.load(colnames, 20190305, 20190306)
+            self.assertEqual(cstore.to_fields(colnames, arrays), [
+                ['2019-03-05', 0, 1.5, 7],
+                ['2019-03-06', 1, 1.5, None]])
+            arrays = cstore.load(colnames, 20190307, 20190331)
+            self.assertEqual(cstore.to_fields(colnames, arrays), [])
+
+    def test_generation(self):
+        colnames = ['stamp', 'end']
+        with tempfile.TemporaryDirectory() as folder:
+            cstore = ColumnStore(folder+'/000010.col')
+            cstore.rebuild(self.make_rows([20190301, 20190304]))
+            stale = cstore.get_meta()
+            cstore.append(self.make_rows([20190305]), 2)
+            # The previous generation is kept for the reader of it.
+            self.assertTrue(os.path.exists(cstore._column_file('end', 1)))
+            arrays = cstore._load(colnames, 20190301, 20190331, stale)
+            self.assertEqual(len(arrays['stamp']), 2)
+            cstore.rebuild(self.make_rows([20190304, 20190305, 20190306]))
+            self.assertFalse(os.path.exists(cstore._column_file('end', 1)))
+            self.assertTrue(os.path.exists(cstore._column_file('end', 2)))
+            # The removed generation is read again by the fresh meta.
+            metas = [stale]
+            get_meta = cstore.get_meta
+            cstore.get_meta = lambda: metas.pop() if metas else get_meta()
+            arrays = cstore.load(colnames, 20190301, 20190331)
+            self.assertEqual(cstore.to_fields(colnames, arrays), [
+                ['2019-03-04', 0], ['2019-03-05', 1], ['2019-03-06', 2]])
+
+    def test_sync_dirty(self):
+        stamps = [datetime.date(2024, 1, 1) + datetime.timedelta(days=x)
+                  for x in range(60)]
+        stamps = [x.strftime('%Y.%m.%d') for x in stamps]
+        with stock_folder():
+            merge = StockDayMerge()
+            merge.add([{'finance': 'Naver', 'stamp': x, 'start': i,
+                        'end': i, 'high': i, 'low': i, 'volume': i}
+                       for i, x in enumerate(stamps)])
+            DataCollection.store_merge('000010', merge)
+            DataCollection.sync_code('000010')
+            # The late columns of the old rows, the count is not changed.
+            merge = StockDayMerge()
+            merge.add([{'stamp': x, 'foreigner': 5} for x in stamps[:10]])
+            DataCollection.store_merge('000010', merge)
+            with StockItemDB.reader('000010') as sidb:
+                self.assertEqual(sidb.get_dirty()[0], 20240101)
+            DataCollection.sync_code('000010')
+            with StockItemDB.reader('000010') as sidb:
+                self.assertIsNone(sidb.get_dirty()[0])
+                qdata = StockQuery.raw_data(
+                    sidb, colnames=['stamp', 'foreigner'],
+                    sdate='2024.01.01', edate='2024.01.05')
+            self.assertEqual(qdata.fields, [
+                [x.replace('.', '-'), 5] for x in stamps[:5]])
+            cstore = ColumnStore.factory('000010')
+            self.assertEqual(cstore.get_meta()['rows'], 60)
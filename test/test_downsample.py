@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import math
+import numpy
+import unittest
+
+from pysp.sbasic import SSingleton
+
+from core.downsample import ChartDownsample
+from core.finance import (DataCollection, StockDayMerge, StockItemDB,
+                          StockQuery)
+from core.model import ColumnData
+from test.fixture import stock_folder
+
+
+def make_cdata(count):
+    date = datetime.date(2015, 1, 1)
+    stamps = []
+    while len(stamps) < count:
+        if date.weekday() < 5:
+            stamps.append(date.strftime('%Y-%m-%d'))
+        date += datetime.timedelta(days=1)
+    end = [int(1000 + 100 * math.sin(i / 20)) for i in range(count)]
+    foreigner = [i * 3 - count for i in range(count)]
+    # The spikes and the late days of the investor columns.
+    end[count // 3] = 5000
+    foreigner[count // 2] = -10**6
+    foreigner[-3:] = [None] * 3
+    colnames = ['stamp', 'end', 'foreigner']
+    return ColumnData.from_columns(colnames, [stamps, end, foreigner])
+
+
+class TestChartDownsample(unittest.TestCase):
+
+    def test_downsample(self):
+        cdata = make_cdata(1500)
+        for method in ChartDownsample.METHODS:
+            rows = ChartDownsample.downsample(cdata, 300, method)
+            self.assertLessEqual(rows.get_count(), 300 + 2)
+            stamps = rows.columns['stamp'].tolist()
+            self.assertEqual(stamps, sorted(stamps))
+            self.assertEqual(stamps[0], cdata.columns['stamp'][0])
+            self.assertEqual(stamps[-1], cdata.columns['stamp'][-1])
+            # The extremes of each series are kept.
+            self.assertIn(5000, rows.columns['end'].tolist())
+            self.assertIn(-10**6, rows.columns['foreigner'].tolist())
+            # The rows are the rows of the days.
+            fields = dict([(x[0], x) for x in cdata.fields])
+            for field in rows.fields:
+                self.assertEqual(field, fields[field[0]])
+        self.assertIs(ChartDownsample.downsample(cdata, 2000), cdata)
+        y = numpy.arange(100, dtype='f8')
+        index = ChartDownsample.lttb(y, 10)
+        self.assertEqual(len(index), 10)
+        self.assertEqual((index[0], index[-1]), (0, 99))
+        with self.assertRaises(ChartDownsample.Error):
+            ChartDownsample.downsample(cdata, 300, 'average')
+
+    def test_cache(self):
+        cdata = make_cdata(500)
+        loads = []
+
+        def load():
+            loads.append(1)
+            return cdata
+
+        downsample = ChartDownsample()
+        try:
+            key = 'test:000010:20150101:20161231'
+            first = downsample.get(key, 100, 'lttb', load)
+            self.assertIs(downsample.get(key, 100, 'lttb', load), first)
+            self.assertEqual(len(loads), 1)
+            # The width is a key of the rows too.
+            downsample.get(key, 200, 'lttb', load)
+            self.assertEqual(len(loads), 2)
+            downsample.invalidate('test:000010')
+            downsample.get(key, 100, 'lttb', load)
+            self.assertEqual(len(loads), 3)
+            self.assertEqual((downsample._locks, downsample._gens), ({}, {}))
+        finally:
+            del SSingleton._instances[ChartDownsample]
+
+    def test_stockquery(self):
+        with stock_folder():
+            cdata = make_cdata(400)
+            rows = [{'finance': 'Naver', 'stamp': x[0], 'start': x[1],
+                     'end': x[1], 'high': x[1], 'low': x[1],
+                     'volume': 1} for x in cdata.fields]
+            merge = StockDayMerge()
+            merge.add(rows[:-1])
+            DataCollection.store_merge('000010', merge)
+            kwargs = {'sdate': '2015.01.01', 'edate': '2016.12.31',
+                      'max_points': 100}
+            with StockItemDB.reader('000010') as sidb:
+                qdata = StockQuery.raw_data_of_each_colnames(
+                    sidb, ['stamp', 'end'], **kwargs)
+            self.assertLessEqual(len(qdata.fields), 101)
+            self.assertIn([rows[400//3]['stamp'], 5000], qdata.fields)
+            # The stored days drop the downsampled rows.
+            merge = StockDayMerge()
+            merge.add(rows[-1:])
+            DataCollection.store_merge('000010', merge)
+            with StockItemDB.reader('000010') as sidb:
+                cdata = StockQuery.raw_data_of_each_colnames(
+                    sidb, ['stamp', 'end'], columnar=True, **kwargs)
+                self.assertEqual(cdata.fields[-1][0], rows[-1]['stamp'])
+                with self.assertRaises(StockQuery.Error):
+                    StockQuery.raw_data_of_each_colnames(
+                        sidb, ['stamp', 'end'], downsample='average',
+                        **kwargs)
@@ -4,10 +4,38 @@ import codecs
 import json
 import os
 import pickle
+import random
 import unittest
 
 from core.finance import StockItemDB, StockQuery
-from core.finalgo import AlgoTable, IterAlgo
+from core.finalgo import AlgoTable, IterAlgo, OpCache
+from core.model import QueryData
+
+
+COLNAMES = ['stamp', 'start', 'low', 'high', 'end', 'volume']
+
+
+class RowTable(AlgoTable):
+    def generate(self):
+        self.generate_rows()
+
+
+def make_qdata(count, seed=0, missed=True):
+    rand = random.Random(seed)
+    price = rand.randint(500, 200000)
+    fields = []
+    for i in range(count):
+        price = max(price + rand.randint(-price//20, price//20), 100)
+        low = price - rand.randint(0, price//30)
+        high = price + rand.randint(0, price//30)
+        field = [f'day-{i:05d}', price, low, high, price, rand.randint(0, 9)]
+        # The stopped trading and the missed candle.
+        if rand.random() < 0.02:
+            field[4] = 0
+        if missed and rand.random() < 0.02:
+            field[2] = field[3] = None
+        fields.append(field)
+    return QueryData(colnames=list(COLNAMES), fields=fields)
 
 
 class TestAlgorithm(unittest.TestCase):
@@ -18,6 +46,62 @@ class TestAlgorithm(unittest.TestCase):
             fd.write(json.dumps(data))
 
 
+    def test_generate_columns(self):
+        for seed in range(6):
+            # process() needs the prices of all days.
+            qdata = make_qdata(1250, seed, missed=seed % 2 == 0)
+            for accums in [None] + IterAlgo.SUM_ACCUMS[::6]:
+                cfg = AlgoTable.default_option()
+                if accums:
+                    cfg.sum.accums = accums
+                    cfg.curve.step = AlgoTable.get_curve_step_params(accums)
+                algo = AlgoTable(qdata, cfg=cfg)
+                rows = RowTable(qdata, cfg=cfg)
+                self.assertIsNotNone(algo.to_columns())
+                self.assertEqual(algo.qdata.colnames, rows.qdata.colnames)
+                self.assertEqual(json.dumps(algo.qdata),
+                                 json.dumps(rows.qdata))
+                if seed % 2:
+                    self.assertEqual(json.dumps(algo.process()),
+                                     json.dumps(rows.process()))
+        # The float prices are generated by the rows.
+        qdata.fields[0][4] = 1000.5
+        algo = AlgoTable(qdata)
+        self.assertIsNone(algo.to_columns())
+        self.assertEqual(json.dumps(algo.qdata),
+                         json.dumps(RowTable(qdata).qdata))
+        short = make_qdata(3)
+        self.assertEqual(json.dumps(AlgoTable(short).qdata),
+                         json.dumps(RowTable(short).qdata))
+
+    def test_op_cache(self):
+        cache = OpCache()
+        cache.clear()
+        qdata = make_qdata(500, seed=1, missed=False)
+        first = AlgoTable(qdata)
+        misses = cache.misses
+        self.assertEqual(cache.hits, 0)
+        # The ops of the same params are not generated again.
+        cfg = AlgoTable.default_option()
+        cfg.buy.after.hhupup.begin = 10
+        again = AlgoTable(qdata, cfg=cfg)
+        self.assertEqual(cache.misses, misses)
+        self.assertEqual(json.dumps(again.qdata), json.dumps(first.qdata))
+        # The params of an op change the keys of the ops of its outputs.
+        cfg.gradient.accum = 3
+        algo = AlgoTable(qdata, cfg=cfg)
+        self.assertEqual(json.dumps(algo.qdata),
+                         json.dumps(RowTable(qdata, cfg=cfg).qdata))
+        self.assertEqual(json.dumps(algo.process()),
+                         json.dumps(RowTable(qdata, cfg=cfg).process()))
+        # The other data is of the other fingerprint.
+        misses = cache.misses
+        other = make_qdata(500, seed=2, missed=False)
+        algo = AlgoTable(other)
+        self.assertEqual(cache.misses - misses, len(algo.operate))
+        self.assertEqual(json.dumps(algo.qdata),
+                         json.dumps(RowTable(other).qdata))
+
     def test_fetch_finance_data(self):
         stockcode = '030200'
         # stockcode = '001800'
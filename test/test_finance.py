@@ -1,13 +1,23 @@
 # -*- coding: utf-8 -*-
 
+import datetime
+import sqlite3
+import threading
 import unittest
 
 from pysp.sbasic import SSingleton
 from pysp.serror import SDebug
 
+from core.archive import ColdArchive
 from core.cache import FCache
-from core.finance import StockItemDB, DataCollection, BillConfig, StockQuery
-from core.model import ServiceProvider, QueryData
+from core.finance import (StockItemDB, StockMultiDB, StockItemPool,
+                          DataCollection, BillConfig, StockQuery,
+                          StockDayMerge)
+from core.migrate import StockMigrate
+from core.model import (ServiceProvider, QueryData, StockDay, StockDayInvestor,
+                        ColumnData)
+from core.tradeday import TradeCalendar
+from test.fixture import stock_folder
 
 
 class TestFinance(unittest.TestCase):
@@ -37,6 +47,362 @@ class TestFinance(unittest.TestCase):
         f.collect('009150')
         del SSingleton._instances[FCache]
 
+    def test_multi_store(self):
+        bconfig = BillConfig()
+        keys = ['_config.db.stock_multi_file', '_config.db.stock_backend']
+        with stock_folder(*keys) as folder:
+            bconfig.set_value('_config.db.stock_folder', folder+'/stock')
+            bconfig.set_value(keys[0], folder+'/stock.sqlite3')
+            for code, base in [('000010', 100), ('000020', 200)]:
+                sidb = StockItemDB.factory(code)
+                stamps = [f'2019.03.{x:02d}' for x in range(10, 1, -1)]
+                sidb.update_candle([StockDay(
+                    finance='Naver', stamp=x, start=base, end=base,
+                    high=base, low=base, volume=1) for x in stamps])
+                sidb.update_investor([StockDayInvestor(
+                    stamp=x, foreigner=base, frate=1.0, institute=0,
+                    person=-base) for x in stamps])
+            report = StockMigrate.to_multi()
+            self.assertEqual(report, {'000010': 9, '000020': 9})
+
+            bconfig.set_value(keys[1], 'multi')
+            self.assertEqual(StockItemDB.list_codes(),
+                             ['000010', '000020'])
+            mdb = StockItemDB.factory('000020')
+            self.assertTrue(type(mdb) is StockMultiDB)
+            qdata = StockQuery.raw_data(mdb, sdate='2019.03.10', months=1)
+            self.assertEqual(len(qdata.fields), 9)
+            self.assertEqual(qdata.colnames, StockItemDB.factory(
+                             '000010').get_colnames('stock_day'))
+            qdata = StockQuery.cross_section(
+                        mdb, '2019.03.05', colnames=['foreigner'],
+                        filters=[('foreigner', '>', 150)])
+            self.assertEqual(qdata.fields, [['000020', 200]])
+
+    def test_migrate_day(self):
+        with stock_folder() as folder:
+            with StockItemDB.checkout('000010'):
+                pass
+            StockItemPool().clear()
+            # The legacy store without day, a day in two stamps.
+            conn = sqlite3.connect(f'{folder}/000010.sqlite3')
+            conn.execute('DROP INDEX ix_stock_day_day')
+            conn.execute('PRAGMA user_version = 0')
+            conn.executemany(
+                'INSERT INTO stock_day (finance, stamp, end) VALUES (?, ?, ?)',
+                [('Naver', '2019.03.04', 1), ('Naver', '2019-03-04', 2),
+                 ('Naver', '2019.03.05', 3)])
+            conn.commit()
+            with StockItemDB.checkout('000010') as sidb:
+                self.assertEqual(sidb.query_day(20190304, 'stamp', 'end'),
+                                 [('2019-03-04', 2)])
+                self.assertEqual(len(sidb.query('stock_day')), 2)
+            StockItemPool().clear()
+            # It is migrated once.
+            conn.execute('UPDATE stock_day SET day = NULL')
+            conn.commit()
+            conn.close()
+            with StockItemDB.checkout('000010') as sidb:
+                self.assertEqual(sidb.query_day(20190305), [])
+
+    def test_stockitem_pool(self):
+        pool = StockItemPool()
+        size, pool.size = pool.size, 2
+        try:
+            with stock_folder():
+                with StockItemDB.checkout('000010') as sidb:
+                    handle = sidb
+                with StockItemDB.checkout('000010') as sidb:
+                    self.assertTrue(sidb is handle)
+                for code in ['000020', '000030']:
+                    with StockItemDB.checkout(code) as sidb:
+                        pass
+                self.assertEqual(len(pool), 2)
+                self.assertTrue(('000010', False) not in pool._handles)
+        finally:
+            pool.size = size
+
+    def test_stockitem_opening(self):
+        pool = StockItemPool()
+        opening, opened = threading.Event(), threading.Event()
+        factory = StockItemDB.factory
+        waited = []
+
+        def slow_factory(code, read_only=False):
+            if code == '000010':
+                opening.set()
+                waited.append(opened.wait(5))
+            return factory(code, read_only)
+
+        def checkout():
+            with StockItemDB.checkout('000010'):
+                pass
+        with stock_folder():
+            StockItemDB.factory = slow_factory
+            try:
+                thread = threading.Thread(target=checkout)
+                thread.start()
+                opening.wait(5)
+                # The other code is not blocked by the opening code.
+                with StockItemDB.checkout('000020'):
+                    self.assertEqual(waited, [])
+                opened.set()
+                thread.join()
+                self.assertEqual(waited, [True])
+            finally:
+                StockItemDB.factory = factory
+            self.assertEqual(pool._openers, {})
+            self.assertIn(('000010', False), pool._handles)
+        db_config = BillConfig().get_value('_config.db.stock_yml')
+        self.assertIsNot(StockItemDB.load_schema(db_config),
+                         StockItemDB.load_schema(db_config))
+
+    def test_stockitem_reader(self):
+        with stock_folder():
+            with self.assertRaises(Exception):
+                with StockItemDB.reader('000010') as sidb:
+                    pass
+            with StockItemDB.checkout('000010') as wdb:
+                wdb.update_candle([StockDay(
+                    finance='Naver', stamp='2019.03.04', start=1, end=1,
+                    high=1, low=1, volume=1)])
+                # The reader goes on while the writer is checked out.
+                with StockItemDB.reader('000010') as sidb:
+                    self.assertTrue(sidb.read_only)
+                    self.assertEqual(len(sidb.query('stock_day')), 1)
+                    with self.assertRaises(Exception):
+                        sidb.session.execute('DELETE FROM stock_day')
+
+    def test_merge_streams(self):
+        with stock_folder():
+            merge = StockDayMerge()
+            merge.add([dict(StockDay(finance='Naver', stamp=x, start=1,
+                                     end=1, high=1, low=1, volume=1))
+                       for x in ['2019.03.04', '2019.03.05']])
+            merge.add([{'stamp': x, 'foreigner': 7, 'frate': 1.0,
+                        'institute': 0, 'person': -7}
+                       for x in ['2019.03.01', '2019.03.04', '2019.03.05']])
+            merge.add([{'stamp': '2019/03/04', 'short': 3,
+                        'shortamount': 30}])
+            # The day without the candle is not stored.
+            self.assertEqual(DataCollection.store_merge('000010', merge), 2)
+            with StockItemDB.checkout('000010') as sidb:
+                self.assertEqual(sidb.pending_days('short'), [20190305])
+                self.assertEqual(sidb.stored_days(
+                    [20190304], 'foreigner', 'short'),
+                    {20190304: {'foreigner': 7, 'short': 3}})
+
+            # The late column is patched, the same values are skipped.
+            merge = StockDayMerge()
+            merge.add([{'stamp': x, 'short': 5, 'shortamount': 50}
+                       for x in ['2019/03/05', '2019/03/04']])
+            self.assertEqual(DataCollection.store_merge('000010', merge), 2)
+            self.assertEqual(DataCollection.store_merge('000010', merge), 0)
+            with StockItemDB.checkout('000010') as sidb:
+                self.assertEqual(sidb.pending_days('short'), [])
+
+    def test_is_current(self):
+        calendar = TradeCalendar()
+        calendar.holidays = set()
+        sunday = datetime.datetime(2024, 1, 7, 12, 0)
+        try:
+            with stock_folder():
+                self.assertFalse(DataCollection.is_current('000010', sunday))
+                merge = StockDayMerge()
+                merge.add([dict(StockDay(finance='Naver', stamp=x, start=1,
+                                         end=1, high=1, low=1, volume=1))
+                           for x in ['2024.01.04', '2024.01.05']])
+                DataCollection.store_merge('000010', merge)
+                # The late columns of the last session are missed.
+                self.assertFalse(DataCollection.is_current('000010', sunday))
+                merge = StockDayMerge()
+                merge.add([{'stamp': '2024.01.05', 'foreigner': 7,
+                            'frate': 1.0, 'institute': 0, 'person': -7,
+                            'short': 3, 'shortamount': 30}])
+                DataCollection.store_merge('000010', merge)
+                self.assertTrue(DataCollection.is_current('000010', sunday))
+        finally:
+            SSingleton._instances.pop(TradeCalendar, None)
+
+    def test_trading_accumulator(self):
+        colnames = ['stamp', 'foreigner', 'institute', 'person',
+                    'shortamount', 'end']
+        fields = [
+            ['2019-01-28', 10, -3, -7, 50, 100],
+            ['2019-01-29', -2, 4, -2, 80, 101],
+            ['2019-01-30', 5, None, None, 90, 102],
+            ['2019-01-31', 1, 1, -2, 0, 103],
+            ['2019-02-01', 3, -1, -2, 120, 104],
+            ['2019-02-07', -4, 2, 2, None, 105],
+            ['2019-02-08', 0, 0, 0, 100, 106],
+        ]
+        tacc = StockQuery.TradingAccumulator(colnames, colnames,
+                                             amount_colname='shortamount')
+        expected = []
+        for field in fields:
+            try:
+                expected.append(tacc.update(field))
+            except StockQuery.ExceptionEndOfData:
+                pass
+        self.assertEqual(expected[-1], ['2019-02-08', 8, 3, -11, -20, 106])
+        # The columns at once are the same as the update of each field.
+        tacc = StockQuery.TradingAccumulator(colnames, colnames,
+                                             amount_colname='shortamount')
+        self.assertEqual(tacc.accumulate(fields), expected)
+
+    def test_iter_raw_data(self):
+        with stock_folder():
+            sidb = StockItemDB.factory('000010')
+            stamps = ['2012.12.{:02d}'.format(x) for x in range(3, 29)]
+            stamps += ['2013.01.{:02d}'.format(x) for x in range(2, 29)]
+            sidb.update_candle([StockDay(
+                finance='Naver', stamp=x, start=i, end=i, high=i, low=i,
+                volume=i) for i, x in enumerate(stamps)])
+            sidb.update_investor([StockDayInvestor(
+                stamp=x, foreigner=i, frate=1.0, institute=-i,
+                person=i % 3) for i, x in enumerate(stamps)])
+            ColdArchive.factory('000010').archive(sidb, until=20130101)
+            colnames = ['stamp', 'foreigner', 'institute', 'person',
+                        'shortamount', 'end']
+            for accmulator in [False, True]:
+                kwargs = {'colnames': colnames, 'sdate': '2012.12.10',
+                          'edate': '2013.01.20',
+                          'accmulator': accmulator}
+                chunks = list(StockQuery.iter_raw_data(
+                    sidb, chunk=7, **kwargs))
+                self.assertTrue(all([len(x) <= 7 for x in chunks]))
+                qdata = StockQuery.raw_data_of_each_colnames(
+                    sidb, **kwargs)
+                self.assertEqual(sum(chunks, []), qdata.fields)
+                self.assertEqual(qdata.fields[0][0], '2012-12-10')
+
+    def test_columnar_query(self):
+        with stock_folder():
+            sidb = StockItemDB.factory('000010')
+            stamps = ['2019.03.{:02d}'.format(x) for x in range(1, 29)]
+            sidb.update_candle([StockDay(
+                finance='Naver', stamp=x, start=i, end=i, high=i, low=i,
+                volume=i) for i, x in enumerate(stamps)])
+            sidb.update_investor([StockDayInvestor(
+                stamp=x, foreigner=i, frate=i/10, institute=-i,
+                person=i % 3) for i, x in enumerate(stamps[:-2])])
+            colnames = ['stamp', 'foreigner', 'institute', 'person',
+                        'shortamount', 'end']
+            for accmulator in [False, True]:
+                kwargs = {'sdate': '2019.03.05', 'edate': '2019.03.31',
+                          'accmulator': accmulator}
+                qdata = StockQuery.raw_data_of_each_colnames(
+                    sidb, colnames, **kwargs)
+                cdata = StockQuery.raw_data_of_each_colnames(
+                    sidb, colnames, columnar=True, **kwargs)
+                self.assertEqual(cdata.get_count(), len(qdata.fields))
+                self.assertEqual(cdata.fields, qdata.fields)
+            self.assertEqual(cdata.columns['end'].dtype.kind, 'i')
+            cdata = StockQuery.raw_data(
+                sidb, colnames=['stamp', 'frate', 'end'], columnar=True,
+                sdate='2019.03.25', edate='2019.03.31')
+            self.assertEqual(cdata.columns['frate'].dtype.kind, 'f')
+            self.assertEqual(cdata.to_dict()['columns'], [
+                ['2019-03-25', '2019-03-26', '2019-03-27', '2019-03-28'],
+                [2.4, 2.5, None, None], [24, 25, 26, 27]])
+            self.assertEqual(ColumnData.cast(cdata.to_dict()).fields,
+                             cdata.fields)
+            self.assertEqual(cdata.to_query().fields, cdata.fields)
+
+    def test_batch_raw_data(self):
+        with stock_folder():
+            codes = ['000010', '000020']
+            for n, code in enumerate(codes):
+                with StockItemDB.checkout(code) as sidb:
+                    sidb.update_candle([StockDay(
+                        finance='Naver', stamp=x, start=n, end=n+i,
+                        high=n, low=n, volume=n)
+                        for i, x in enumerate(['2019.03.04',
+                                               '2019.03.05'])])
+            results = StockQuery.batch_raw_data(
+                codes + ['000030', '000010'], ['stamp', 'end'],
+                sdate='2019.03.01', edate='2019.03.31')
+            self.assertEqual(list(results.keys()), codes + ['000030'])
+            self.assertEqual(results['000020']['value'].fields,
+                             [['2019-03-04', 1], ['2019-03-05', 2]])
+            # The missed code fails alone.
+            self.assertTrue(results['000010']['success'])
+            self.assertFalse(results['000030']['success'])
+            self.assertTrue(results['000030']['message'])
+            self.assertEqual([results[x]['stored'] for x in results],
+                             [True, True, False])
+            # The error of a stored code is not the missed rows.
+            results = StockQuery.batch_raw_data(
+                codes, ['stamp', 'unknown'], sdate='2019.03.01',
+                edate='2019.03.31')
+            self.assertEqual([(x['success'], x['stored'])
+                              for x in results.values()],
+                             [(False, True), (False, True)])
+            with self.assertRaises(StockQuery.Error):
+                StockQuery.batch_raw_data(
+                    [f'{x:06d}' for x in range(StockQuery.BATCH_CODES+1)],
+                    ['stamp'])
+
+    def test_delta_data(self):
+        with stock_folder():
+            stamps = ['2019.03.{:02d}'.format(x) for x in range(1, 32)]
+            rows = [{'finance': 'Naver', 'stamp': x, 'start': i,
+                     'end': i, 'high': i, 'low': i, 'volume': i,
+                     'foreigner': i} for i, x in enumerate(stamps)]
+
+            def store(rows):
+                merge = StockDayMerge()
+                merge.add(rows)
+                DataCollection.store_merge('000010', merge)
+
+            def delta(since, version, **kwargs):
+                kwargs = dict({'sdate': '2019.03.01', 'edate': '2019.03.31'},
+                              **kwargs)
+                with StockItemDB.reader('000010') as sidb:
+                    return StockQuery.delta_data(
+                        sidb, ['stamp', 'end', 'foreigner'], since,
+                        version, **kwargs)
+
+            store(rows[:20])
+            with StockItemDB.reader('000010') as sidb:
+                version = sidb.get_version()
+            qdata, current, reset, start = delta(rows[19]['stamp'], version)
+            self.assertEqual((qdata.fields, current, reset, start),
+                             ([], version, False, '2019-03-01'))
+            # The new days and the late column of a recent day.
+            store(rows[20:22] + [dict(rows[18], foreigner=-1)])
+            qdata, current, reset, _ = delta(rows[19]['stamp'], version)
+            self.assertNotEqual(current, version)
+            self.assertFalse(reset)
+            first = 20 - StockItemDB.PATCH_ROWS
+            self.assertEqual([x[0] for x in qdata.fields],
+                             [x['stamp'].replace('.', '-')
+                              for x in rows[first:22]])
+            self.assertIn(['2019-03-19', 18, -1], qdata.fields)
+            cdata, _, _, _ = delta(rows[19]['stamp'], version,
+                                   columnar=True)
+            self.assertEqual(cdata.fields, qdata.fields)
+            # The accumulated rows are all rows.
+            with StockItemDB.reader('000010') as sidb:
+                _, _, reset, _ = StockQuery.delta_data(
+                    sidb, ['stamp', 'end', 'shortamount'], rows[19]['stamp'],
+                    version, sdate='2019.03.01', edate='2019.03.31',
+                    accmulator=True)
+            self.assertTrue(reset)
+            # The moved range is the delta and the start to trim the rows.
+            moved, _, reset, start = delta(rows[19]['stamp'], version,
+                                           sdate='2019.03.02')
+            self.assertFalse(reset)
+            self.assertEqual(moved.fields, qdata.fields)
+            self.assertEqual(start, '2019-03-02')
+            # The old day resets all rows of the range.
+            version = current
+            store([dict(rows[0], foreigner=-1)])
+            qdata, current, reset, _ = delta(rows[21]['stamp'], version)
+            self.assertTrue(reset)
+            self.assertEqual(len(qdata.fields), 22)
+            self.assertEqual(qdata.fields[0], ['2019-03-01', 0, -1])
+
     def test_billconfig(self):
         bconfig = BillConfig()
         cvalue = bconfig.get_value('folder.user_config')
@@ -17,3 +17,11 @@ class TestHelper(unittest.TestCase):
         for form in date2_forms:
             rv = DateTool.to_strfdate(DateTool.to_datetime(form))
             self.assertEqual(rv, date2_expected)
+
+    def test_datetool_day(self):
+        forms = ['2019.03.04', '2019/03/04', '2019-03-04', '20190304',
+                 '2019. 3. 4', datetime.date(2019, 3, 4),
+                 datetime.datetime(2019, 3, 4), 20190304]
+        for form in forms:
+            self.assertEqual(DateTool.to_day(form), 20190304)
+        self.assertEqual(DateTool.to_stamp(20190304), '2019-03-04')
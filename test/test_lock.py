@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import unittest
+
+from core.lock import CodeLock
+
+
+class TestCodeLock(unittest.TestCase):
+
+    def test_code_lock(self):
+        events = []
+
+        def reader():
+            with CodeLock().read('000010'):
+                events.append('read')
+
+        with CodeLock().read('000010'):
+            # The readers share the lock and the other codes are free.
+            with CodeLock().read('000010'), CodeLock().write('000020'):
+                pass
+        with CodeLock().write('000010'):
+            thread = threading.Thread(target=reader)
+            thread.start()
+            time.sleep(0.1)
+            events.append('write')
+        thread.join()
+        self.assertEqual(events, ['write', 'read'])
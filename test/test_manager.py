@@ -1,15 +1,48 @@
 # -*- coding: utf-8 -*-
 
+import queue
 import time
 import unittest
 
 from pysp.sbasic import SSingleton
 
-from core.manager import Collector
+from core.manager import Collector, _PriorityQueue, _State
 
 
 class TestManager(unittest.TestCase):
 
+    def test_state(self):
+        state = _State()
+        self.assertTrue(state.begin_work('035720'))
+        self.assertTrue(state.begin_work('009150'))
+        self.assertFalse(state.begin_work('035720'))
+        self.assertTrue(state.is_working('009150'))
+        state.end_work('035720')
+        self.assertFalse(state.is_working('035720'))
+        self.assertTrue(state.is_working('009150'))
+
+    def test_priority_queue(self):
+        pq = _PriorityQueue()
+        self.assertTrue(pq.put('000010', Collector.PRIORITY_LOW, 20200103))
+        self.assertTrue(pq.put('000020', Collector.PRIORITY_LOW, 20200101))
+        self.assertTrue(pq.put('000030', Collector.PRIORITY_STALE))
+        self.assertFalse(pq.put('000020', Collector.PRIORITY_LOW))
+        # The queued code is promoted by the higher priority.
+        self.assertTrue(pq.put('000010', Collector.PRIORITY_HIGH))
+        self.assertFalse(pq.put('000010', Collector.PRIORITY_STALE))
+        self.assertEqual(pq.depth(), {0: 1, 1: 1, 2: 1})
+        self.assertTrue('000020' in pq)
+        self.assertEqual([pq.get(0) for _ in range(3)],
+                         ['000010', '000030', '000020'])
+        self.assertEqual(len(pq), 0)
+        with self.assertRaises(queue.Empty):
+            pq.get(0.01)
+        pq.put('000040', Collector.PRIORITY_LOW)
+        pq.close()
+        with self.assertRaises(queue.Empty):
+            pq.get()
+        self.assertFalse(pq.put('000040', Collector.PRIORITY_LOW))
+
     def test_collector_1(self):
         Collector.DEBUG = True
         cm = Collector(Collector.INIT_NO_COLLECT)
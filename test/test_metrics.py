@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+
+from core.metrics import CollectMetrics
+
+
+class TestCollectMetrics(unittest.TestCase):
+
+    def test_metrics(self):
+        metrics = CollectMetrics()
+        job = metrics.begin('035720', queued=time.time()-2)
+        with job.phase('candle'):
+            job.pages += 3
+        job.rows += 20
+        metrics.end(job)
+        self.assertTrue(job.wait >= 2)
+        self.assertTrue('candle' in job.to_dict()['phases'])
+
+        job = metrics.begin('009150')
+        metrics.end(job, error=IOError('Timeout'))
+        item = metrics.get_code('009150')
+        self.assertEqual(item['error'], 'Timeout')
+        self.assertEqual(item['failures'], 1)
+        self.assertTrue(metrics.get_code('035720')['last_success'])
+
+        summary = metrics.get_summary()
+        self.assertEqual(summary['failing'][0]['code'], '009150')
+        self.assertEqual(summary['recent'][0]['code'], '009150')
+        self.assertTrue(summary['gauge']['jobs'] >= 2)
+        self.assertTrue(summary['totals']['pages'] >= 3)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from concurrent.futures.process import BrokenProcessPool
+
+from core.cache import FCache
+from core.connect import FNaver, Http
+from core.pipeline import CollectPipeline
+
+
+def parse_page(raw):
+    return [{'page': raw['page'], 'row': x} for x in range(raw['rows'])]
+
+
+class BrokenPool(object):
+
+    def submit(self, *args):
+        raise BrokenProcessPool('Spawn Failed')
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class TestCollectPipeline(unittest.TestCase):
+
+    def test_pipeline(self):
+        fetched = []
+        stored = []
+
+        def fetch(page):
+            fetched.append(page)
+            return {'page': page, 'rows': 2}
+
+        def store(pages):
+            # The pages from 5 are already stored.
+            for i, rows in enumerate(pages):
+                if rows[0]['page'] >= 5:
+                    return i
+                stored.append(rows[0]['page'])
+            return len(pages)
+
+        count = CollectPipeline().run(fetch, parse_page, store)
+        self.assertEqual(count, 4)
+        self.assertEqual(stored, [1, 2, 3, 4])
+        # The window is 1, 2, 4 and 8 pages, so no more than 15 pages.
+        self.assertTrue(5 <= max(fetched) <= 15)
+        stats = CollectPipeline.get_stats()
+        self.assertTrue(stats['parse']['pages'] >= 5)
+
+    def test_broken_pool(self):
+        CollectPipeline._pools['parse'] = BrokenPool()
+        try:
+            stored = []
+
+            def store(pages):
+                stored.extend(pages)
+                return len(pages) if len(stored) < 3 else 0
+
+            CollectPipeline().run(lambda page: {'page': page, 'rows': 1},
+                                  parse_page, store)
+            self.assertEqual(stored[0], [{'page': 1, 'row': 0}])
+            # The pages are parsed inline from now on.
+            self.assertIsNone(CollectPipeline.get_pool('parse'))
+        finally:
+            CollectPipeline.shutdown()
+
+    def test_fetch_uncached(self):
+        urls = []
+        get = Http.get
+        Http.get = lambda url, **kwargs: urls.append(url) or '<html/>'
+        try:
+            cache = FCache()
+            count = len(cache._cache)
+            for _ in range(2):
+                FNaver.fetch_chunk('day', code='000010', page=1)
+            # The raw pages of a run are not kept in the memory.
+            self.assertEqual(len(urls), 2)
+            self.assertEqual(len(cache._cache), count)
+        finally:
+            Http.get = get
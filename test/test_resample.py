@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import numpy
+import random
+import unittest
+
+from pysp.sbasic import SSingleton
+
+from core.finance import (DataCollection, StockDayMerge, StockItemDB,
+                          StockQuery)
+from core.helper import DateTool
+from core.model import ColumnData
+from core.resample import StockResample
+from test.fixture import stock_folder
+
+
+COLNAMES = ['stamp'] + list(StockResample.AGGREGATE.keys())
+
+
+def make_days(sday, count, seed=0):
+    rand = random.Random(seed)
+    date = datetime.date(sday//10000, sday//100 % 100, sday % 100)
+    rows = []
+    while len(rows) < count:
+        if date.weekday() < 5 and rand.random() > 0.05:
+            end = rand.randint(900, 1100)
+            row = {'stamp': date.strftime('%Y-%m-%d'),
+                   'start': rand.randint(900, 1100), 'end': end,
+                   'high': 1200, 'low': 800,
+                   'volume': rand.randint(0, 10**6),
+                   'foreigner': rand.randint(-10**4, 10**4),
+                   'frate': round(rand.random()*50, 2),
+                   'institute': rand.randint(-10**4, 10**4),
+                   'person': rand.randint(-10**4, 10**4),
+                   'short': rand.randint(0, 100),
+                   'shortamount': rand.randint(0, 10**5)}
+            # The late columns of the recent days.
+            if rand.random() < 0.1:
+                row['foreigner'] = row['frate'] = row['shortamount'] = None
+            rows.append(row)
+        date += datetime.timedelta(days=1)
+    return rows
+
+
+def by_rows(rows, key):
+    '''
+    The bars of each key in order, a row at a time.
+    '''
+    bars = []
+    for row in rows:
+        k = key(row['stamp'])
+        if not bars or bars[-1][0] != k:
+            bars.append((k, []))
+        bars[-1][1].append(row)
+    result = []
+    for k, group in bars:
+        bar = {'stamp': group[-1]['stamp']}
+        for colname, how in StockResample.AGGREGATE.items():
+            values = [x[colname] for x in group if x[colname] is not None]
+            if not values:
+                bar[colname] = None
+            elif how == 'sum':
+                bar[colname] = sum(values)
+            elif how == 'first':
+                bar[colname] = values[0]
+            elif how == 'last':
+                bar[colname] = values[-1]
+            else:
+                bar[colname] = max(values) if how == 'max' else min(values)
+        result.append([bar[x] for x in COLNAMES])
+    return result
+
+
+def to_cdata(rows):
+    return ColumnData.from_columns(
+        COLNAMES, [[x[c] for x in rows] for c in COLNAMES])
+
+
+class TestStockResample(unittest.TestCase):
+
+    def test_resample(self):
+        rows = make_days(20190101, 300)
+        cdata = to_cdata(rows)
+        keys = {
+            'week': lambda x: datetime.date(
+                *[int(v) for v in x.split('-')]).isocalendar()[:2],
+            'month': lambda x: x[:7],
+        }
+        for timeframe, key in keys.items():
+            bars = StockResample.resample(cdata, timeframe)
+            cols = [bars[x] if x != 'stamp' else
+                    [f'{d//10000}-{d//100 % 100:02d}-{d % 100:02d}'
+                     for d in bars['last'].tolist()] for x in COLNAMES]
+            fields = ColumnData.from_columns(COLNAMES, cols).fields
+            self.assertEqual(fields, by_rows(rows, key))
+        # The bars of 5 weekdays are of the weekdays from 1970-01-01.
+        self.assertEqual(StockResample.bar_start(20190107, 'week'), 20190107)
+        self.assertEqual(StockResample.bar_start(20190113, 'week'), 20190107)
+        self.assertEqual(StockResample.bar_start(20190215, 'month'), 20190201)
+        sday = StockResample.bar_start(20190110, '5d')
+        days = [DateTool.to_day(numpy.busday_offset(
+            str(DateTool.to_stamp(sday)), x).item()) for x in range(6)]
+        keys = StockResample.to_keys(days, '5d').tolist()
+        self.assertIn(20190110, days[:5])
+        self.assertEqual(len(set(keys[:5])), 1)
+        self.assertNotEqual(keys[4], keys[5])
+        with self.assertRaises(StockResample.Error):
+            StockResample.to_keys([20190101], 'hour')
+
+    def test_incremental(self):
+        rows = make_days(20190101, 200, seed=1)
+        loads = []
+
+        def load(colnames, sday, eday):
+            loads.append((sday, eday))
+            return to_cdata([x for x in rows if sday <= int(
+                x['stamp'].replace('-', '')) <= eday])
+
+        def fresh(sday, eday):
+            return StockResample().get(None, COLNAMES, sday, eday, 'week',
+                                       load).fields
+
+        resample = StockResample()
+        key = 'test:000010'
+        try:
+            cdata = resample.get(key, COLNAMES, 20190301, 20190430, 'week',
+                                 load)
+            self.assertEqual(cdata.fields, fresh(20190301, 20190430))
+            # The first bar is of the whole week of the first day.
+            self.assertEqual(loads[0], (20190225, 20190430))
+            loads.clear()
+            cdata = resample.get(key, ['stamp', 'end'], 20190311, 20190322,
+                                 'week', load)
+            self.assertEqual(loads, [])
+            self.assertEqual(len(cdata.fields), 2)
+            # The wider range resamples the days out of the bars only.
+            cdata = resample.get(key, COLNAMES, 20190201, 20190531, 'week',
+                                 load)
+            self.assertEqual(loads, [(20190128, 20190224),
+                                     (20190429, 20190531)])
+            self.assertEqual(cdata.fields, fresh(20190201, 20190531))
+            # The stored day drops the bars from it.
+            rows[60]['volume'] += 1000
+            since = int(rows[60]['stamp'].replace('-', ''))
+            resample.invalidate(key, since=since)
+            loads.clear()
+            cdata = resample.get(key, COLNAMES, 20190201, 20190531, 'week',
+                                 load)
+            self.assertEqual(len(loads), 1)
+            self.assertTrue(loads[0][0] < since)
+            self.assertEqual(cdata.fields, fresh(20190201, 20190531))
+            self.assertEqual((resample._locks, resample._gens), ({}, {}))
+        finally:
+            del SSingleton._instances[StockResample]
+
+    def test_null_tail(self):
+        rows = make_days(20190101, 60, seed=3)
+        # The late columns of the recent weeks are not arrived yet.
+        for row in rows[30:]:
+            row['foreigner'] = row['frate'] = row['shortamount'] = None
+
+        def load(colnames, sday, eday):
+            return to_cdata([x for x in rows if sday <= int(
+                x['stamp'].replace('-', '')) <= eday])
+
+        resample = StockResample()
+        try:
+            eday = int(rows[40]['stamp'].replace('-', ''))
+            resample.get('test:000010', COLNAMES, 20190101, eday, 'week',
+                         load)
+            # The tail of no frate is joined to the bars of frate.
+            cdata = resample.get('test:000010', COLNAMES, 20190101,
+                                 20190331, 'week', load)
+            self.assertEqual(cdata.columns['frate'].dtype.kind, 'f')
+            self.assertEqual(cdata.fields, StockResample().get(
+                None, COLNAMES, 20190101, 20190331, 'week', load).fields)
+            frates = [x[COLNAMES.index('frate')] for x in cdata.fields]
+            self.assertIsNone(frates[-1])
+            self.assertTrue(0 <= frates[0] <= 50)
+        finally:
+            del SSingleton._instances[StockResample]
+
+    def test_stockquery(self):
+        with stock_folder():
+            rows = make_days(20190101, 60, seed=2)
+            for row in rows:
+                row['finance'] = 'Naver'
+            merge = StockDayMerge()
+            merge.add(rows[:50])
+            DataCollection.store_merge('000010', merge)
+            kwargs = {'colnames': ['stamp', 'end', 'volume'],
+                      'sdate': '2019.01.01', 'edate': '2019.03.31',
+                      'timeframe': 'month'}
+            with StockItemDB.reader('000010') as sidb:
+                qdata = StockQuery.raw_data(sidb, **kwargs)
+            self.assertEqual(len(qdata.fields), 3)
+            self.assertEqual(qdata.fields[0][0], '2019-01-31')
+            self.assertEqual(qdata.fields[0][2], sum(
+                [x['volume'] for x in rows if x['stamp'] < '2019-02']))
+            # The new days are in the bars.
+            merge = StockDayMerge()
+            merge.add(rows[50:])
+            DataCollection.store_merge('000010', merge)
+            with StockItemDB.reader('000010') as sidb:
+                qdata = StockQuery.raw_data(sidb, **kwargs)
+            self.assertEqual(qdata.fields[-1][0], rows[-1]['stamp'])
+            self.assertEqual(qdata.fields[-1][1], rows[-1]['end'])
+            with StockItemDB.reader('000010') as sidb:
+                with self.assertRaises(StockQuery.Error):
+                    StockQuery.raw_data(sidb, colnames=['finance'],
+                                        timeframe='week')
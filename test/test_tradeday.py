@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import unittest
+
+from pysp.sbasic import SSingleton
+
+from core.tradeday import TradeCalendar
+
+
+class TestTradeCalendar(unittest.TestCase):
+
+    def setUp(self):
+        SSingleton._instances.pop(TradeCalendar, None)
+
+    def tearDown(self):
+        SSingleton._instances.pop(TradeCalendar, None)
+
+    def test_trading_day(self):
+        calendar = TradeCalendar()
+        calendar.holidays = set([20240101])
+        self.assertFalse(calendar.is_trading_day('2024.01.01'))
+        self.assertFalse(calendar.is_trading_day('2024.01.06'))
+        self.assertTrue(calendar.is_trading_day('2024.01.02'))
+        # 2024.02.09 and 2024.02.12 are missed in the stored days.
+        calendar.learn([20240207, 20240208, 20240213], sequence=True)
+        self.assertFalse(calendar.is_trading_day(20240209))
+        self.assertFalse(calendar.is_trading_day(20240212))
+        self.assertEqual(calendar.prev_trading_day(20240213), 20240208)
+        self.assertEqual(calendar.next_trading_day(20240208), 20240213)
+        # The days of a code are not a sequence, it may be suspended.
+        calendar.learn([20240301, 20240305])
+        self.assertTrue(calendar.is_trading_day(20240304))
+
+    def test_session(self):
+        calendar = TradeCalendar()
+        calendar.holidays = set()
+        friday = datetime.datetime(2024, 1, 5, 17, 0)
+        self.assertEqual(calendar.last_session(friday), 20240104)
+        self.assertEqual(calendar.last_session(friday.replace(hour=19)),
+                         20240105)
+        sunday = datetime.datetime(2024, 1, 7, 12, 0)
+        self.assertEqual(calendar.last_session(sunday), 20240105)
+        self.assertTrue(calendar.is_current(20240105, sunday))
+        self.assertFalse(calendar.is_current(None, sunday))
+        self.assertTrue(calendar.is_market_open(friday.replace(hour=10)))
+        self.assertFalse(calendar.is_market_open(sunday))
+        self.assertEqual(calendar.seconds_to_open(sunday), 21*3600)
+        self.assertEqual(calendar.seconds_to_open(friday.replace(hour=10)), 0)